@@ -1,11 +1,45 @@
-from vcd import Event, Module, VCDData, DeltaTrace, AliasedSignals
-from typing import Dict, Tuple, Iterator, Optional
+from vcd import Event, Signal, Module, ModuleIndex, FrozenSlots, SIGNAL_TABLE, VCDData, DeltaTrace, AliasedSignals, \
+    ClockDomain, as_delta_trace
+from automata import TransitionTable, TableAutomaton, BatchedMiner, SignalIndex, prefilter, symbolize, A, B, AB, B_NEXT, FAIL
+from typing import Dict, Tuple, Iterator, Optional, List, Set, Type, Any
+import heapq
 import itertools
+from collections import defaultdict
+import numpy as np
 from dataclasses import dataclass
+from profiling import PROFILE
+
+
+# The mining automata as transition tables over the merged a/b event stream, transcribed from the mine_* functions
+ALTERNATING_TABLE = TransitionTable(2, {
+    (0, AB): (FAIL, 0, True), (1, AB): (FAIL, 0, True),
+    (0, A): (1, 0, True), (1, A): (FAIL, 0, False),
+    (0, B): (FAIL, 0, False), (1, B): (0, 1, False),
+}, falsified_by_identical_traces=True)
+
+NEXT_TABLE = TransitionTable(2, {
+    (0, AB): (1, 0, True), (1, AB): (1, 1, False),
+    (0, A): (1, 0, True), (1, A): (FAIL, 0, False),
+    (1, B): (FAIL, 0, False),
+    (1, B_NEXT): (0, 1, False),
+})
+
+EVENTUAL_TABLE = TransitionTable(3, {
+    (0, AB): (1, 0, True), (1, AB): (2, 1, False),
+    (0, A): (1, 0, True), (2, A): (1, 0, False),
+    (1, B): (0, 1, False), (2, B): (0, 1, False),
+})
+
+UNTIL_TABLE = TransitionTable(2, {
+    (0, AB): (1, 0, True), (1, AB): (1, 1, False),
+    (0, A): (1, 0, True), (1, A): (FAIL, 0, False),
+    (1, B): (0, 1, False),
+})
 
 
 @dataclass(frozen=True)
-class PropertyStats:
+class PropertyStats(FrozenSlots):
+    __slots__ = ('support', 'falsifiable', 'falsified', 'falsified_time')
     support: int
     falsifiable: bool
     falsified: bool
@@ -13,15 +47,42 @@ class PropertyStats:
 
 
 @dataclass(frozen=True)
-class Property:
+class Property(FrozenSlots):
+    # a and b are interned (see vcd.SignalTable) and the hash is computed once, so dict lookups and merges of
+    # properties mostly compare object identities
+    __slots__ = ('a', 'b', '_hash')
     a: AliasedSignals
     b: AliasedSignals
 
+    # The mining automaton as a transition table, used by the single-pass and batched kernels
+    table = None  # type: TransitionTable
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'a', SIGNAL_TABLE.intern(self.a))
+        object.__setattr__(self, 'b', SIGNAL_TABLE.intern(self.b))
+        object.__setattr__(self, '_hash', hash((self.__class__.__name__, self.a, self.b)))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __getstate__(self) -> Tuple[AliasedSignals, AliasedSignals]:
+        return self.a, self.b
+
+    def __setstate__(self, state: Any) -> None:
+        a, b = (state['a'], state['b']) if isinstance(state, dict) else state
+        object.__setattr__(self, 'a', a)
+        object.__setattr__(self, 'b', b)
+        self.__post_init__()
+
     def mine(self, a: DeltaTrace, b: DeltaTrace) -> PropertyStats:
         pass
 
+    @classmethod
+    def automaton(cls) -> TableAutomaton:
+        return TableAutomaton(cls.table)
+
     def clean_set(self, x: AliasedSignals) -> str:
-        return list(x)[0].name
+        return next(iter(x)).name
 
     def __repr__(self) -> str:
         return "{} {} -> {}".format(self.__class__.__name__, self.clean_set(self.a), self.clean_set(self.b))
@@ -30,48 +91,62 @@ class Property:
         return "{} {} -> {}".format(self.__class__.__name__, self.clean_set(self.a), self.clean_set(self.b))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Alternating(Property):
+    __slots__ = ()
+    table = ALTERNATING_TABLE
+
     def mine(self, a: DeltaTrace, b: DeltaTrace) -> PropertyStats: return mine_alternating(a, b)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Next(Property):
+    __slots__ = ()
+    table = NEXT_TABLE
+
     def mine(self, a: DeltaTrace, b: DeltaTrace) -> PropertyStats: return mine_next(a, b)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Until(Property):
+    __slots__ = ()
+    table = UNTIL_TABLE
+
     def mine(self, a: DeltaTrace, b: DeltaTrace) -> PropertyStats: return mine_until(a, b)
 
 
 @dataclass(frozen=True, eq=False)
 class Eventual(Property):
+    __slots__ = ()
+    table = EVENTUAL_TABLE
+
     def mine(self, a: DeltaTrace, b: DeltaTrace) -> PropertyStats: return mine_evenutual(a, b)
 
 
 MinerResult = Dict[Property, PropertyStats]
+PROPERTY_CLASSES = [Alternating, Next, Eventual, Until]  # type: List[Type[Property]]
 
 
-# Combine a and b delta traces into 1 delta trace which consists of tuples indicating
+# Combine a and b delta traces into 1 delta trace which consists of tuples of event times indicating
 # whether a, b, or both occurred at a timestep
-def zip_delta_traces(a: DeltaTrace, b: DeltaTrace) -> Iterator[Tuple[Optional[Event], Optional[Event]]]:
+def zip_delta_traces(a: DeltaTrace, b: DeltaTrace) -> Iterator[Tuple[Optional[int], Optional[int]]]:
+    a_times, b_times = as_delta_trace(a).times.tolist(), as_delta_trace(b).times.tolist()
     a_idx, b_idx = 0, 0
-    while a_idx < len(a) or b_idx < len(b):
+    while a_idx < len(a_times) or b_idx < len(b_times):
         # received an 'a' and 'b' on the same cycle
-        if a_idx < len(a) and b_idx < len(b) and a[a_idx].time == b[b_idx].time:
-            yield (a[a_idx], b[b_idx])
+        if a_idx < len(a_times) and b_idx < len(b_times) and a_times[a_idx] == b_times[b_idx]:
+            yield (a_times[a_idx], b_times[b_idx])
             a_idx = a_idx + 1
             b_idx = b_idx + 1
         # received a 'a' event
-        elif (a_idx < len(a) and b_idx < len(b) and a[a_idx].time < b[b_idx].time) \
-                or (b_idx == len(b) and a_idx < len(a)):
-            yield (a[a_idx], None)
+        elif (a_idx < len(a_times) and b_idx < len(b_times) and a_times[a_idx] < b_times[b_idx]) \
+                or (b_idx == len(b_times) and a_idx < len(a_times)):
+            yield (a_times[a_idx], None)
             a_idx = a_idx + 1
         # received a 'b' event
-        elif a_idx < len(a) and b_idx < len(b) and a[a_idx].time > b[b_idx].time \
-                or (a_idx == len(a) and b_idx < len(b)):
-            yield (None, b[b_idx])
+        elif a_idx < len(a_times) and b_idx < len(b_times) and a_times[a_idx] > b_times[b_idx] \
+                or (a_idx == len(a_times) and b_idx < len(b_times)):
+            yield (None, b_times[b_idx])
             b_idx = b_idx + 1
         else:
             assert False, "should not get here"
@@ -81,38 +156,45 @@ def zip_delta_traces(a: DeltaTrace, b: DeltaTrace) -> Iterator[Tuple[Optional[Ev
 def mine_alternating(a: DeltaTrace, b: DeltaTrace) -> PropertyStats:
     # If a == b, they have identical events, and although are strictly alternating, that
     # strict definition is useless for verification since a and b are identically sourced
-    if a == b:
+    if as_delta_trace(a) == as_delta_trace(b):
         return PropertyStats(support=0, falsifiable=True, falsified=True, falsified_time=0)
     automaton_state = 0
     falsifiable, support = False, 0
     for t in zip_delta_traces(a, b):
         # got a and b, no matter what state we are in, we move to the error state
         if t[0] is not None and t[1] is not None:
-            return PropertyStats(support=support, falsifiable=True, falsified=True, falsified_time=t[0].time)
+            return PropertyStats(support=support, falsifiable=True, falsified=True, falsified_time=t[0])
         elif t[0] is not None and t[1] is None:  # got a, but not b
             if automaton_state == 0:
                 automaton_state = 1
                 falsifiable = True
             elif automaton_state == 1:  # we already got an a before, so this pattern fails
-                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0].time)
+                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0])
         elif t[0] is None and t[1] is not None:  # got b, but not a
             if automaton_state == 1:
                 automaton_state = 0
                 support = support + 1  # a successful completion of the pattern
             elif automaton_state == 0:  # we haven't got an 'a' yet, so b shouldn't go first
-                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[1].time)
+                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[1])
         else:
             assert False, "should not get here"
     return PropertyStats(support=support, falsifiable=falsifiable, falsified=False, falsified_time=0)
 
 
+# b must change on the first clock edge of its domain after a does (or exactly one clk_period after a, without a domain)
 def mine_next(a: DeltaTrace, b: DeltaTrace, clk_period: int = 2) -> PropertyStats:
     automaton_state = 0
     falsifiable, support = False, 0
     a_event_time = 0
+    b = as_delta_trace(b)
+    edges = b.previous_edges()
+    previous_edges = iter(edges.tolist()) if edges is not None else None
     for t in zip_delta_traces(a, b):
+        previous_edge = 0
+        if t[1] is not None:
+            previous_edge = next(previous_edges) if previous_edges is not None else t[1] - clk_period
         if t[0] is not None and t[1] is not None:  # got a and b
-            a_event_time = t[0].time
+            a_event_time = t[0]
             if automaton_state == 0:
                 automaton_state = 1
                 falsifiable = True
@@ -120,18 +202,19 @@ def mine_next(a: DeltaTrace, b: DeltaTrace, clk_period: int = 2) -> PropertyStat
                 automaton_state = 1
                 support = support + 1
         elif t[0] is not None and t[1] is None:  # got a, but not b
-            a_event_time = t[0].time
+            a_event_time = t[0]
             if automaton_state == 0:
                 automaton_state = 1
                 falsifiable = True
             elif automaton_state == 1:
-                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0].time)
+                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0])
         elif t[0] is None and t[1] is not None:  # got b, but not a
-            if automaton_state == 1 and t[1].time == a_event_time + clk_period:
+            next_cycle = a_event_time >= previous_edge if edges is not None else a_event_time == previous_edge
+            if automaton_state == 1 and next_cycle:
                 automaton_state = 0
                 support = support + 1
-            elif automaton_state == 1 and t[1].time != a_event_time + clk_period:
-                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[1].time)
+            elif automaton_state == 1 and not next_cycle:
+                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[1])
         else:
             assert False, "should not get here"
     return PropertyStats(support=support, falsifiable=falsifiable, falsified=False, falsified_time=0)
@@ -191,7 +274,7 @@ def mine_until(a: DeltaTrace, b: DeltaTrace) -> PropertyStats:
             # In state == 1, we have already seen delta a and if we see another delta a without also a delta b,
             # then a didn't remain stable until b toggled
             elif automaton_state == 1:
-                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0].time)
+                return PropertyStats(support=support, falsifiable=falsifiable, falsified=True, falsified_time=t[0])
         elif t[0] is None and t[1] is not None:
             if automaton_state == 0:
                 automaton_state = 0
@@ -203,7 +286,167 @@ def mine_until(a: DeltaTrace, b: DeltaTrace) -> PropertyStats:
     return PropertyStats(support=support, falsifiable=falsifiable, falsified=False, falsified_time=0)
 
 
-def mine_module(module: Module, vcd_data: VCDData) -> MinerResult:
+def _stats(support: int, falsifiable: bool, falsified_time: Optional[int]) -> PropertyStats:
+    return PropertyStats(support=support, falsifiable=falsifiable, falsified=falsified_time is not None,
+                         falsified_time=0 if falsified_time is None else falsified_time)
+
+
+# Single-pass kernel: walks the merged event stream of a and b once and advances the automata of all the given
+# property types together. Each automaton drops out as soon as it is falsified, and the walk stops early once
+# every automaton has been falsified, or once it passes time until (when only falsifications up to then matter).
+def mine_pair(a: DeltaTrace, b: DeltaTrace, property_classes: List[Type[Property]] = PROPERTY_CLASSES,
+              clk_period: int = 2, until: Optional[int] = None) -> Dict[Type[Property], PropertyStats]:
+    a, b = as_delta_trace(a), as_delta_trace(b)
+    automata = [(prop_type, prop_type.automaton()) for prop_type in property_classes]
+    if any([m.table.falsified_by_identical_traces for (_, m) in automata]) and a == b:
+        for (_, m) in automata:
+            if m.table.falsified_by_identical_traces:
+                m.falsify(0)
+    active = [m for (_, m) in automata if m.falsified_time is None]
+    if len(active) > 0:
+        for (symbol, time) in symbolize(zip_delta_traces(a, b), clk_period, b.previous_edges()):
+            if until is not None and time > until:
+                break
+            alive = True
+            for m in active:
+                alive = m.step(symbol, time) and alive
+            if not alive:
+                active = [m for m in active if m.falsified_time is None]
+                if len(active) == 0:
+                    break
+    return {prop_type: _stats(m.support, m.falsifiable, m.falsified_time) for (prop_type, m) in automata}
+
+
+# The falsifiable (property type, pair) jobs mined by mine_pairs: a and b index the traces and prop the property class
+MINED_ROW = np.dtype([('a', np.int64), ('b', np.int64), ('prop', np.int64), ('support', np.int64),
+                      ('falsified', bool), ('falsified_time', np.int64)])
+
+
+def trace_classes(traces: List[DeltaTrace]) -> np.ndarray:
+    # The equivalence class of every trace: traces have the same class id iff they are identical and sampled by the
+    # same clock domain (a Next property counts cycles of the domain of its b signal)
+    groups = {}  # type: Dict[Tuple[bytes, bytes, Optional[int]], int]
+    return np.array([groups.setdefault((t.times.tobytes(), t.values.tobytes(),
+                                        id(t.domain) if t.domain is not None else None), len(groups))
+                     for t in traces], dtype=np.int64)
+
+
+# Batched kernel: mines the given ordered pairs of traces for all the given property types. Cheap bitset pre-filters
+# rule out (property type, pair) jobs first (see automata.prefilter), jobs that are certain to be falsified early are
+# resolved by the single-pass kernel, and the rest are mined by the table-driven BatchedMiner in one walk over the
+# merged events of the signals. The number of jobs each filter removed is added to counters.
+# Returns MINED_ROW rows for the falsifiable jobs, ordered by pair and then by property class.
+def mine_pairs(traces: List[DeltaTrace], pairs_a: np.ndarray, pairs_b: np.ndarray,
+               property_classes: List[Type[Property]] = PROPERTY_CLASSES, clk_period: int = 2,
+               counters: Optional[Dict[str, int]] = None) -> np.ndarray:
+    # Only the signals of the given pairs take part
+    used, local = np.unique(np.concatenate([pairs_a, pairs_b]).astype(np.int64), return_inverse=True)
+    traces = [as_delta_trace(traces[i]) for i in used.tolist()]
+    num_classes = len(property_classes)
+    jobs_a, jobs_b = np.repeat(local[:len(pairs_a)], num_classes), np.repeat(local[len(pairs_a):], num_classes)
+    jobs_table = np.tile(np.arange(num_classes), len(pairs_a))
+    miner = BatchedMiner([p.table for p in property_classes], jobs_a, jobs_b, jobs_table, len(traces), clk_period)
+
+    # Signals with identical traces, which some automata reject outright
+    trace_group = trace_classes(traces)
+    index = SignalIndex([t.times for t in traces])
+    doomed, filter_counts = prefilter(miner, index, trace_group[jobs_a] == trace_group[jobs_b])
+    if counters is not None:
+        for (stage, count) in filter_counts.items():
+            counters[stage] = counters.get(stage, 0) + count
+
+    doomed_pairs = defaultdict(list)  # type: Dict[Tuple[int, int], List[int]]
+    for j in doomed.tolist():
+        doomed_pairs[(int(jobs_a[j]), int(jobs_b[j]))].append(j)
+    doomed_jobs, doomed_stats = [], []  # type: Tuple[List[int], List[PropertyStats]]
+    for ((i, j), jobs) in doomed_pairs.items():
+        pair_stats = mine_pair(traces[i], traces[j], [property_classes[jobs_table[job]] for job in jobs], clk_period)
+        doomed_jobs.extend(jobs)
+        doomed_stats.extend(pair_stats.values())
+    miner.decide(np.array(doomed_jobs, dtype=np.int64), np.array([s.support for s in doomed_stats], dtype=np.int64),
+                 np.array([s.falsifiable for s in doomed_stats], dtype=bool),
+                 np.array([s.falsified for s in doomed_stats], dtype=bool),
+                 np.array([s.falsified_time for s in doomed_stats], dtype=np.int64))
+
+    miner.run([t.times for t in traces], [t.previous_edges() for t in traces])
+    if PROFILE.enabled:
+        _profile_jobs(traces, miner, property_classes, filter_counts)
+
+    mined = np.flatnonzero(miner.falsifiable)
+    rows = np.zeros(len(mined), dtype=MINED_ROW)
+    rows['a'], rows['b'], rows['prop'] = used[jobs_a[mined]], used[jobs_b[mined]], jobs_table[mined]
+    rows['support'], rows['falsified'] = miner.support[mined], miner.falsified[mined]
+    rows['falsified_time'] = np.where(rows['falsified'], miner.falsified_time[mined], 0)
+    return rows
+
+
+def _profile_jobs(traces: List[DeltaTrace], miner: BatchedMiner, property_classes: List[Type[Property]],
+                  filter_counts: Dict[str, int]) -> None:
+    PROFILE.count('pairs', len(miner.jobs_a) // max(len(property_classes), 1))
+    for (stage, count) in filter_counts.items():
+        PROFILE.count('prefilter_' + stage, count)
+    # The automaton steps before falsification are the merged events of a and b up to the falsified time
+    steps = np.zeros(len(miner.jobs_a), dtype=np.int64)
+    for job in np.flatnonzero(miner.falsified).tolist():
+        a, b = traces[miner.jobs_a[job]].times, traces[miner.jobs_b[job]].times
+        num_a = np.searchsorted(a, miner.falsified_time[job], side='right')
+        num_b = np.searchsorted(b, miner.falsified_time[job], side='right')
+        steps[job] = num_a + num_b - len(np.intersect1d(a[:num_a], b[:num_b], assume_unique=True))
+    for (k, prop_type) in enumerate(property_classes):
+        jobs = miner.jobs_table == k
+        PROFILE.count('jobs', int(jobs.sum()), property_type=prop_type.__name__)
+        PROFILE.count('mined', int((jobs & miner.falsifiable).sum()), property_type=prop_type.__name__)
+        PROFILE.count('falsified', int((jobs & miner.falsified).sum()), property_type=prop_type.__name__)
+        PROFILE.count('steps_before_falsification', int(steps[jobs].sum()), property_type=prop_type.__name__)
+
+
+def result_from_rows(keys: List[AliasedSignals], rows: np.ndarray,
+                     property_classes: List[Type[Property]] = PROPERTY_CLASSES) -> MinerResult:
+    result = {}  # type: MinerResult
+    for (i, j, k, support, falsified, falsified_time) in rows.tolist():
+        result[property_classes[k](keys[i], keys[j])] = PropertyStats(
+            support=support, falsifiable=True, falsified=falsified, falsified_time=falsified_time)
+    return result
+
+
+# Mines every ordered pair of the given signals for all the given property types with the batched kernel.
+# Signals with identical traces get identical stats against any other signal, so only one representative of every
+# class of identical traces is paired with the others (plus one pair inside every class with several members), and
+# the mined rows are then expanded back to every member.
+def mine_signals(vcd_data: VCDData, property_classes: List[Type[Property]] = PROPERTY_CLASSES,
+                 clk_period: int = 2, counters: Optional[Dict[str, int]] = None) -> MinerResult:
+    keys = list(vcd_data.keys())
+    traces = [as_delta_trace(vcd_data[k]) for k in keys]
+    classes = trace_classes(traces)
+    _, representatives, sizes = np.unique(classes, return_index=True, return_counts=True)
+    if len(representatives) == len(keys):
+        pairs_a, pairs_b = np.nonzero(~np.eye(len(keys), dtype=bool))
+        rows = mine_pairs(traces, pairs_a, pairs_b, property_classes, clk_period, counters)
+        return result_from_rows(keys, rows, property_classes)
+
+    members = [np.flatnonzero(classes == c) for c in range(len(representatives))]
+    pairs_a, pairs_b = np.nonzero(~np.eye(len(representatives), dtype=bool))
+    shared = np.flatnonzero(sizes > 1)
+    pairs_a = np.concatenate([representatives[pairs_a], [members[c][0] for c in shared]]).astype(np.int64)
+    pairs_b = np.concatenate([representatives[pairs_b], [members[c][1] for c in shared]]).astype(np.int64)
+    if counters is not None:
+        counters['equivalent_pairs'] = counters.get('equivalent_pairs', 0) + len(keys) * (len(keys) - 1) - len(pairs_a)
+    rows = mine_pairs(traces, pairs_a, pairs_b, property_classes, clk_period, counters)
+
+    # Expand every row mined for a pair of classes to all the ordered pairs of their distinct members
+    expanded = [rows[(sizes[classes[rows['a']]] == 1) & (sizes[classes[rows['b']]] == 1)]]
+    for i in np.flatnonzero((sizes[classes[rows['a']]] > 1) | (sizes[classes[rows['b']]] > 1)).tolist():
+        members_a, members_b = members[classes[rows['a'][i]]], members[classes[rows['b'][i]]]
+        a, b = np.repeat(members_a, len(members_b)), np.tile(members_b, len(members_a))
+        row = np.repeat(rows[i:i + 1], int(np.count_nonzero(a != b)))
+        row['a'], row['b'] = a[a != b], b[a != b]
+        expanded.append(row)
+    rows = np.concatenate(expanded)
+    rows = rows[np.lexsort((rows['prop'], rows['b'], rows['a']))]
+    return result_from_rows(keys, rows, property_classes)
+
+
+def scope_module(module: Module, vcd_data: VCDData) -> VCDData:
     # Strip vcd_data so it only contains signals that are directly inside this module
     # and only mine permutations of signals directly inside a given module instance
     def signal_in_module(signal: str, module: str):
@@ -211,37 +454,127 @@ def mine_module(module: Module, vcd_data: VCDData) -> MinerResult:
         signal_root = signal[0:last_dot]
         return signal_root == module
 
-    vcd_data_scoped = {signal_set: trace for (signal_set, trace) in vcd_data.items()
-                       if any([signal_in_module(s.name, module.name) for s in signal_set])}
+    return {signal_set: trace for (signal_set, trace) in vcd_data.items()
+            if any([signal_in_module(s.name, module.name) for s in signal_set])}
 
-    result = {}  # type: MinerResult
-    property_classes = [Alternating, Next, Eventual, Until]
+
+def print_filter_counts(counters: Dict[str, int]) -> None:
+    print("Pre-filters removed: {}".format(", ".join("{} {}".format(k, v) for (k, v) in counters.items())))
+
+
+def mine_module(module: Module, vcd_data: VCDData, index: Optional[ModuleIndex] = None) -> MinerResult:
+    # The signals of the module are looked up in index (built over the keys of vcd_data) when one is given
+    if index is None:
+        vcd_data_scoped = scope_module(module, vcd_data)
+    else:
+        vcd_data_scoped = {index.signals[i]: vcd_data[index.signals[i]] for i in index.module(module.name).tolist()}
     print("Mining module = {} with num signals = {}".format(module.name, len(vcd_data_scoped.keys())))
-    for combo in itertools.permutations(vcd_data_scoped.keys(), 2):
-        for prop_type in property_classes:
-            a = vcd_data_scoped[combo[0]]
-            b = vcd_data_scoped[combo[1]]
-            prop = prop_type(combo[0], combo[1])
-            pattern_stats = prop.mine(a, b)
-            if pattern_stats.falsifiable:
-                result[prop] = pattern_stats
+    filter_counts = {}  # type: Dict[str, int]
+    with PROFILE.timer('mine_module', module=module.name):
+        PROFILE.count('signals', len(vcd_data_scoped))
+        result = mine_signals(vcd_data_scoped, PROPERTY_CLASSES, counters=filter_counts)
+    print_filter_counts(filter_counts)
     print("Mined {} properties".format(len(result.keys())))
     return result
 
 
 def mine_modules_recurse(module: Module, vcd_data: VCDData) -> MinerResult:
     # Walk the module tree with DFS (iterative preorder traversal)
+    index = ModuleIndex(vcd_data.keys())
     module_queue = [module]
     result = {}  # type: MinerResult
     while len(module_queue) > 0:
         module = module_queue.pop()
-        module_mine = mine_module(module, vcd_data)
+        module_mine = mine_module(module, vcd_data, index)
         for (k, v) in module_mine.items():
             result[k] = v
         module_queue.extend(module.children)
     return result
 
 
+def mine_cross_modules(module: Module, vcd_data: VCDData, index: Optional[ModuleIndex] = None) -> MinerResult:
+    """
+    Mines the pairs between the signals of every module and the ports (io_*) of its child instances, in both
+    directions, which per-module mining does not see unless a port is also aliased into the parent.
+    """
+    keys = list(vcd_data.keys())  # type: List[AliasedSignals]
+    if index is None:
+        index = ModuleIndex(keys)
+    traces = [vcd_data[k] for k in keys]
+    module_queue = [module]
+    result = {}  # type: MinerResult
+    while len(module_queue) > 0:
+        module = module_queue.pop()
+        parent = index.module(module.name)
+        for child in module.children:
+            ports = np.setdiff1d(index.module_ports(child.name), parent)
+            if len(parent) == 0 or len(ports) == 0:
+                continue
+            print("Mining ports of {} against module {}".format(child.name, module.name))
+            pairs_a = np.concatenate([np.repeat(parent, len(ports)), np.tile(ports, len(parent))])
+            pairs_b = np.concatenate([np.tile(ports, len(parent)), np.repeat(parent, len(ports))])
+            rows = mine_pairs(traces, pairs_a, pairs_b, PROPERTY_CLASSES)
+            for (k, v) in result_from_rows(keys, rows, PROPERTY_CLASSES).items():
+                result[k] = v
+        module_queue.extend(module.children)
+    return result
+
+
+def support_upper_bound(num_a_events: np.ndarray, num_b_events: np.ndarray) -> np.ndarray:
+    # Holds for every property type: each support increment needs an event of b, and follows its own event of a
+    return np.minimum(num_a_events, num_b_events)
+
+
+def mine_top_k(module: Module, vcd_data: VCDData, top_k: Optional[int] = None, min_support: int = 1,
+               batch_pairs: int = 4096) -> MinerResult:
+    """
+    Mines the unfalsified properties with at least min_support support of every module under module, keeping only
+    the top_k with the highest support (all of them if top_k is None), ordered by decreasing support. Pairs are
+    mined in batches in decreasing order of their support upper bound (support_upper_bound), and the running results
+    are kept in a min-heap: once the bound of the next pair cannot beat the threshold (min_support, or the smallest
+    support in a full heap), none of the remaining pairs are mined.
+    """
+    keys = list(vcd_data.keys())  # type: List[AliasedSignals]
+    traces = [as_delta_trace(vcd_data[k]) for k in keys]
+    index = ModuleIndex(keys)
+    pairs = set()  # type: Set[Tuple[int, int]]
+    module_queue = [module]
+    while len(module_queue) > 0:
+        module = module_queue.pop()
+        signals = index.module(module.name)
+        pairs_a, pairs_b = np.nonzero(~np.eye(len(signals), dtype=bool))
+        pairs.update(zip(signals[pairs_a].tolist(), signals[pairs_b].tolist()))
+        module_queue.extend(module.children)
+
+    pairs_ab = np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+    lengths = np.array([len(t) for t in traces], dtype=np.int64)
+    bounds = support_upper_bound(lengths[pairs_ab[:, 0]], lengths[pairs_ab[:, 1]])
+    order = np.argsort(-bounds, kind='stable')
+    pairs_ab, bounds = pairs_ab[order], bounds[order]
+
+    heap = []  # type: List[Tuple[int, int, Property, PropertyStats]]
+    threshold, seq, mined = min_support, 0, 0
+    while mined < len(pairs_ab) and bounds[mined] >= threshold:
+        batch = pairs_ab[mined:mined + batch_pairs]
+        batch = batch[bounds[mined:mined + batch_pairs] >= threshold]
+        mined += batch_pairs
+        rows = mine_pairs(traces, batch[:, 0], batch[:, 1])
+        for (prop, stats) in result_from_rows(keys, rows[~rows['falsified']]).items():
+            if stats.support < threshold:
+                continue
+            # Ties are broken in favour of the property mined first
+            entry = (stats.support, -seq, prop, stats)
+            seq += 1
+            if top_k is None or len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+            if top_k is not None and len(heap) == top_k:
+                threshold = max(threshold, heap[0][0] + 1)
+    PROFILE.count('pairs_pruned', max(len(pairs_ab) - mined, 0))
+    return {prop: stats for (_, _, prop, stats) in sorted(heap, reverse=True)}
+
+
 if __name__ == "__main__":
     print("TESTING: mine_alternating")
     ma1 = mine_alternating(
@@ -268,6 +601,50 @@ if __name__ == "__main__":
     assert mn2.falsifiable is True
     assert mn2.falsified is True
 
+    # Without a clock domain, b must change exactly one clk_period after a, not merely within it
+    def exact_next(a: List[Event], b: List[Event], clk_period: int = 2) -> PropertyStats:
+        # The original definition of mine_next, for traces that are not sampled on a clock
+        state, falsifiable, support, a_time = 0, False, 0, 0
+        for t in zip_delta_traces(DeltaTrace.from_events(a), DeltaTrace.from_events(b)):
+            if t[0] is not None:
+                a_time = t[0]
+                if state == 1 and t[1] is None:
+                    return PropertyStats(support=support, falsifiable=True, falsified=True, falsified_time=t[0])
+                support, state, falsifiable = support + state, 1, True
+            elif state == 1 and t[1] == a_time + clk_period:
+                state, support = 0, support + 1
+            elif state == 1:
+                return PropertyStats(support=support, falsifiable=True, falsified=True, falsified_time=t[1])
+        return PropertyStats(support=support, falsifiable=falsifiable, falsified=False, falsified_time=0)
+    assert mine_next([Event(4, 1), Event(10, 0)], [Event(5, 1), Event(11, 0)]) == \
+        PropertyStats(support=0, falsifiable=True, falsified=True, falsified_time=5)
+    rng = np.random.RandomState(3)
+    unsampled = [[Event(int(t), int(v)) for (t, v) in zip(np.sort(rng.choice(40, rng.randint(1, 12), replace=False)),
+                                                         rng.randint(0, 2, 12))] for _ in range(12)]
+    data = {'s{}'.format(i): DeltaTrace.from_events(t) for (i, t) in enumerate(unsampled)}
+    batched = mine_signals(data, [Next])
+    for ((na, ta), (nb, tb)) in itertools.permutations(zip(data.keys(), unsampled), 2):
+        expected = exact_next(ta, tb)
+        assert mine_next(ta, tb) == expected and mine_pair(ta, tb, [Next])[Next] == expected
+        assert batched.get(Next(na, nb), expected) == expected and (Next(na, nb) in batched) == expected.falsifiable
+
+    # In a domain with a period of 7, b on the next posedge after a is the next cycle
+    slow = ClockDomain("TOP.slow.clock", [3, 10, 17, 24])
+    a, b = DeltaTrace([3, 17], [0, 1], slow), DeltaTrace([10, 24], [0, 1], slow)
+    assert mine_next(a, b, 2) == PropertyStats(support=2, falsifiable=True, falsified=False, falsified_time=0)
+    assert mine_next(DeltaTrace([3, 17], [0, 1]), DeltaTrace([10, 24], [0, 1]), 2).falsified
+    assert mine_pair(a, b)[Next] == mine_next(a, b) and mine_signals({'a': a, 'b': b})[Next('a', 'b')].support == 2
+    assert mine_next(a, DeltaTrace([24], [1], slow)).falsified_time == 17
+
+    # Identical traces in different domains are not interchangeable as the b signal of a Next
+    fast = ClockDomain("TOP.fast.clock", range(20))
+    a = DeltaTrace([0, 4], [0, 1], fast)
+    x = DeltaTrace([1, 9, 13], [0, 1, 0], ClockDomain("TOP.x.clock", [1, 5, 9, 13]))
+    y = DeltaTrace([1, 9, 13], [0, 1, 0], ClockDomain("TOP.y.clock", [1, 9, 13]))
+    assert mine_next(a, x).falsified_time == 9 and not mine_next(a, y).falsified
+    mined = mine_signals({'a': a, 'x': x, 'y': y})
+    assert mined[Next('a', 'x')] == mine_next(a, x) and mined[Next('a', 'y')] == mine_next(a, y)
+
     print("TESTING: mine_eventual")
     me1 = mine_evenutual(
         [Event(2, 1), Event(20, 0)],
@@ -298,3 +675,61 @@ if __name__ == "__main__":
     )
     assert mu2.falsifiable is True
     assert mu2.falsified is True
+
+    print("TESTING: mine_pair")
+    traces = [
+        [Event(0, 1), Event(5, 0), Event(10, 1)],
+        [Event(1, 0), Event(6, 1), Event(11, 0)],
+        [Event(2, 1), Event(6, 0)],
+        [Event(4, 0), Event(8, 1)],
+        [Event(8, 0)],
+        [Event(2, 1), Event(20, 0)],
+        [Event(4, 1), Event(6, 0), Event(30, 1)],
+        [Event(2, 1), Event(6, 0), Event(20, 1)],
+        [Event(0, 1), Event(8, 0)],
+    ]
+    for (ta, tb) in itertools.product(traces, repeat=2):
+        fused = mine_pair(ta, tb)
+        assert fused[Alternating] == mine_alternating(ta, tb)
+        assert fused[Next] == mine_next(ta, tb)
+        assert fused[Eventual] == mine_evenutual(ta, tb)
+        assert fused[Until] == mine_until(ta, tb)
+
+    print("TESTING: mine_signals")
+    data = {frozenset([Signal("TOP.s{}".format(i), 1)]): DeltaTrace.from_events(t) for (i, t) in enumerate(traces)}
+    data[frozenset([Signal("TOP.copy", 1)])] = DeltaTrace.from_events(traces[0])
+    batched = mine_signals(data)
+    for (sa, sb) in itertools.permutations(data.keys(), 2):
+        for (prop_type, stats) in mine_pair(data[sa], data[sb]).items():
+            if stats.falsifiable:
+                assert batched[prop_type(sa, sb)] == stats
+            else:
+                assert prop_type(sa, sb) not in batched
+
+    # Identical traces are mined once per class and expanded, with the same results as mining every pair
+    data[frozenset([Signal("TOP.copy2", 1)])] = DeltaTrace.from_events(traces[0])
+    data[frozenset([Signal("TOP.copy3", 1)])] = DeltaTrace.from_events(traces[5])
+    keys = list(data.keys())
+    pairs_a, pairs_b = np.nonzero(~np.eye(len(keys), dtype=bool))
+    every_pair = result_from_rows(keys, mine_pairs([data[k] for k in keys], pairs_a, pairs_b))
+    assert list(mine_signals(data).items()) == list(every_pair.items())
+
+    print("TESTING: mine_top_k")
+    top = Module("TOP")
+    every = {p: stats for (p, stats) in mine_signals(data).items() if not stats.falsified and stats.support >= 1}
+    ranked = sorted((stats.support for stats in every.values()), reverse=True)
+    assert mine_top_k(top, data, batch_pairs=3) == every
+    assert [stats.support for stats in mine_top_k(top, data, batch_pairs=3).values()] == ranked
+    assert [stats.support for stats in mine_top_k(top, data, top_k=4, batch_pairs=3).values()] == ranked[:4]
+    assert all(stats.support >= 2 for stats in mine_top_k(top, data, min_support=2).values())
+
+    print("TESTING: mine_cross_modules")
+    top, core = Module("TOP"), Module("TOP.core")
+    top.children.append(core)
+    data = {frozenset([Signal("TOP.a", 1)]): DeltaTrace.from_events(traces[0]),
+            frozenset([Signal("TOP.core.io_b", 1)]): DeltaTrace.from_events(traces[1]),
+            frozenset([Signal("TOP.core.c", 1)]): DeltaTrace.from_events(traces[2])}
+    (a, io_b, c) = data.keys()
+    cross = mine_cross_modules(top, data)
+    assert len(cross) > 0 and cross == {prop_type(sa, sb): stats for (sa, sb) in ((a, io_b), (io_b, a))
+                     for (prop_type, stats) in mine_pair(data[sa], data[sb]).items() if stats.falsifiable}
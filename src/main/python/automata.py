@@ -0,0 +1,350 @@
+from typing import Dict, Tuple, List, Optional, Iterator, Iterable
+import numpy as np
+
+# The alphabet of the merged event stream of a pair of signals (a, b) at one timestep
+NONE = 0    # neither a nor b has a delta event (every automaton stays put)
+A = 1       # got a, but not b
+B = 2       # got b, but not a
+AB = 3      # got a and b
+B_NEXT = 4  # got b, but not a, on the first clock edge (of b's domain) after the latest a event
+NUM_SYMBOLS = 5
+
+FAIL = -1   # the absorbing falsified state in a transition specification
+
+
+class TransitionTable:
+    """
+    A mining automaton described as data. transitions maps (state, symbol) to (next state, support increment,
+    whether the transition makes the property falsifiable). Missing transitions stay in the same state, and
+    B_NEXT behaves like B unless it is given its own transitions. Transitions to FAIL falsify the property at the
+    time of the event.
+    """
+    def __init__(self, num_states: int, transitions: Dict[Tuple[int, int], Tuple[int, int, bool]],
+                 falsified_by_identical_traces: bool = False) -> None:
+        self.num_states = num_states
+        # Identical a and b traces are rejected before looking at any events (see mine_alternating)
+        self.falsified_by_identical_traces = falsified_by_identical_traces
+        # State num_states is FAIL, which loops to itself on every symbol
+        self.next_state = np.tile(np.arange(num_states + 1, dtype=np.int8)[:, None], (1, NUM_SYMBOLS))
+        self.support = np.zeros((num_states + 1, NUM_SYMBOLS), dtype=np.int64)
+        self.falsifiable = np.zeros((num_states + 1, NUM_SYMBOLS), dtype=bool)
+        for state in range(num_states):
+            for symbol in (A, B, AB, B_NEXT):
+                key = (state, symbol)
+                if key not in transitions and symbol == B_NEXT:
+                    key = (state, B)
+                if key in transitions:
+                    next_state, support, falsifiable = transitions[key]
+                    self.next_state[state, symbol] = num_states if next_state == FAIL else next_state
+                    self.support[state, symbol] = support
+                    self.falsifiable[state, symbol] = falsifiable
+        # Plain lists are faster to index from the interpreter in the scalar kernel
+        self.next_state_list = self.next_state.tolist()  # type: List[List[int]]
+        self.support_list = self.support.tolist()  # type: List[List[int]]
+        self.falsifiable_list = self.falsifiable.tolist()  # type: List[List[bool]]
+
+    @property
+    def fail(self) -> int:
+        return self.num_states
+
+
+class TableAutomaton:
+    """
+    One automaton evaluated from its TransitionTable on a single pair, one merged event at a time.
+    """
+    __slots__ = ('table', 'state', 'support', 'falsifiable', 'falsified_time')
+
+    def __init__(self, table: TransitionTable) -> None:
+        self.table = table
+        self.state = 0
+        self.support = 0
+        self.falsifiable = False
+        self.falsified_time = None  # type: Optional[int]
+
+    # Returns False once the automaton has been falsified, after which it must not be stepped again
+    def step(self, symbol: int, time: int) -> bool:
+        table, state = self.table, self.state
+        self.support += table.support_list[state][symbol]
+        self.falsifiable = self.falsifiable or table.falsifiable_list[state][symbol]
+        self.state = table.next_state_list[state][symbol]
+        if self.state == table.fail:
+            self.falsified_time = time
+            return False
+        return True
+
+    def falsify(self, time: int) -> None:
+        self.state = self.table.fail
+        self.falsifiable = True
+        self.falsified_time = time
+
+
+# Convert a merged (a time, b time) event stream into (symbol, time). previous_edges holds the clock edge before every
+# b event (see DeltaTrace.previous_edges): b is B_NEXT if a changed since then. Without them, b is B_NEXT only if it
+# comes exactly clk_period after a changed.
+def symbolize(merged: Iterator[Tuple[Optional[int], Optional[int]]], clk_period: int,
+              previous_edges: Optional[Iterable[int]] = None) -> Iterator[Tuple[int, int]]:
+    edges = iter(previous_edges) if previous_edges is not None else None
+    a_event_time = None  # type: Optional[int]
+    for (a_time, b_time) in merged:
+        edge = 0
+        if b_time is not None:
+            edge = next(edges) if edges is not None else b_time - clk_period
+        if a_time is None:
+            next_cycle = a_event_time is not None and \
+                (a_event_time >= edge if edges is not None else a_event_time == edge)
+            yield (B_NEXT if next_cycle else B), b_time
+        else:
+            a_event_time = a_time
+            yield (A if b_time is None else AB), a_time
+
+
+def _csr(keys: np.ndarray, num_keys: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Group the positions of keys by key: positions of key k are index[ptr[k]:ptr[k+1]]
+    index = np.argsort(keys, kind='stable')
+    ptr = np.searchsorted(keys[index], np.arange(num_keys + 1))
+    return ptr, index
+
+
+def _csr_gather(ptr: np.ndarray, index: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    starts, lengths = ptr[keys], ptr[keys + 1] - ptr[keys]
+    total = int(lengths.sum())
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return index[np.arange(total) + offsets]
+
+
+class BatchedMiner:
+    """
+    Evaluates TransitionTables over many (property type, a, b) jobs in one batched array computation: every job is
+    one entry of the state arrays. The merged event stream of all the signals is walked once, and at each timestep the
+    live jobs touching a signal with an event are advanced with a single gathered table lookup. When few jobs are
+    touched only those are gathered, otherwise all the live jobs are advanced at once (jobs without events see NONE,
+    which leaves them unchanged). Falsified jobs stop independently: they are periodically dropped from the live set.
+    Jobs start in state 0 with no earlier events, unless initial_state and the last_event_time of every signal
+    before the first step are given (to resume the walk of a trace from the middle). A b event is B_NEXT if a changed
+    at or after the clock edge before it (the previous posedge of b's domain), or, for a b without clock edges, if a
+    changed exactly one clk_period earlier.
+    """
+    def __init__(self, tables: List[TransitionTable], jobs_a: np.ndarray, jobs_b: np.ndarray, jobs_table: np.ndarray,
+                 num_signals: int, clk_period: int = 2, initial_state: Optional[np.ndarray] = None,
+                 last_event_time: Optional[np.ndarray] = None) -> None:
+        self.tables = tables
+        self.jobs_a = np.asarray(jobs_a, dtype=np.int64)
+        self.jobs_b = np.asarray(jobs_b, dtype=np.int64)
+        self.jobs_table = np.asarray(jobs_table, dtype=np.int64)
+        self.num_signals = num_signals
+        self.clk_period = clk_period
+        num_jobs = len(self.jobs_a)
+
+        # Pad every table to the same number of states, with FAIL as the last one, and pack each transition into
+        # one int64: next state in bits 0-7, falsifiable in bit 8 and the support increment from bit 16
+        self.num_states = max([t.num_states for t in tables] + [0]) + 1
+        self.fail = self.num_states - 1
+        lut = np.tile(np.arange(self.num_states, dtype=np.int64)[None, :, None], (len(tables), 1, NUM_SYMBOLS))
+        for (k, t) in enumerate(tables):
+            next_state = t.next_state[:t.num_states].astype(np.int64)
+            lut[k, :t.num_states] = np.where(next_state == t.fail, self.fail, next_state) \
+                | (t.falsifiable[:t.num_states].astype(np.int64) << 8) | (t.support[:t.num_states] << 16)
+        self.lut = lut.reshape(-1)
+        self.lut_base = self.jobs_table * self.num_states * NUM_SYMBOLS
+
+        self.state = np.zeros(num_jobs, dtype=np.int64)
+        if initial_state is not None:
+            self.state[:] = initial_state
+        self.support = np.zeros(num_jobs, dtype=np.int64)
+        self.falsifiable = np.zeros(num_jobs, dtype=bool)
+        self.falsified_time = np.zeros(num_jobs, dtype=np.int64)
+        self.live = np.ones(num_jobs, dtype=bool)
+
+        self.has_event = np.zeros(num_signals, dtype=bool)
+        self.previous_edge = np.zeros(num_signals, dtype=np.int64)
+        self.exact_edge = np.ones(num_signals, dtype=bool)
+        self.last_event_time = np.full(num_signals, np.iinfo(np.int64).min // 2, dtype=np.int64)
+        if last_event_time is not None:
+            self.last_event_time[:] = last_event_time
+        self._index_live()
+
+    def _index_live(self) -> None:
+        # Index the live jobs by their a and b signals
+        self.active = np.flatnonzero(self.live & (self.state != self.fail))
+        ptr, index = _csr(self.jobs_a[self.active], self.num_signals)
+        self.by_a = ptr, self.active[index]
+        ptr, index = _csr(self.jobs_b[self.active], self.num_signals)
+        self.by_b = ptr, self.active[index]
+        self.job_counts = np.diff(self.by_a[0]) + np.diff(self.by_b[0])
+        self.num_failed = 0
+
+    def decide(self, jobs: np.ndarray, support: np.ndarray, falsifiable: np.ndarray, falsified: np.ndarray,
+               falsified_time: np.ndarray) -> None:
+        """
+        Records the stats of jobs that were resolved without the batched walk and removes them from the live set
+        (which is re-indexed by the next run).
+        """
+        self.support[jobs] = support
+        self.falsifiable[jobs] = falsifiable
+        self.state[jobs] = np.where(falsified, self.fail, 0)
+        self.falsified_time[jobs] = np.where(falsified, falsified_time, 0)
+        self.live[jobs] = False
+
+    def step(self, time: int, signals: np.ndarray, previous_edges: Optional[np.ndarray] = None,
+             exact: Optional[np.ndarray] = None) -> None:
+        """
+        Advances every live job touching one of the given signals, which all have a delta event at time.
+        previous_edges holds the clock edge before the event of each signal, except for the signals marked in exact (by
+        default all of them if there are no previous_edges, and none otherwise), whose edge is time - clk_period and
+        which a must have changed exactly on.
+        """
+        self.has_event[signals] = True
+        if exact is None:
+            exact = np.full(len(signals), previous_edges is None)
+        self.previous_edge[signals] = np.where(exact, time - self.clk_period,
+                                               0 if previous_edges is None else previous_edges)
+        self.exact_edge[signals] = exact
+        if 4 * int(self.job_counts[signals].sum()) < len(self.active):
+            # Jobs whose a has an event see A or AB, jobs where only b has an event see B or B_NEXT
+            jobs_with_b = _csr_gather(*self.by_b, signals)
+            jobs_with_b = jobs_with_b[~self.has_event[self.jobs_a[jobs_with_b]]]
+            jobs = np.concatenate([_csr_gather(*self.by_a, signals), jobs_with_b])
+        else:
+            jobs = self.active
+        jobs_a, jobs_b = self.jobs_a[jobs], self.jobs_b[jobs]
+        symbols = self.has_event[jobs_a] * A + self.has_event[jobs_b] * B
+        last_a, edge_b = self.last_event_time[jobs_a], self.previous_edge[jobs_b]
+        symbols[(symbols == B) & (last_a >= edge_b) & ((last_a == edge_b) | ~self.exact_edge[jobs_b])] = B_NEXT
+        self.has_event[signals] = False
+        self.last_event_time[signals] = time
+
+        state = self.state[jobs]
+        code = self.lut[self.lut_base[jobs] + state * NUM_SYMBOLS + symbols]
+        new_state = code & 0xFF
+        self.support[jobs] += code >> 16
+        self.falsifiable[jobs] |= (code & 0x100) != 0
+        failed = (new_state == self.fail) & (state != self.fail)
+        self.state[jobs] = new_state
+        if failed.any():
+            self.falsified_time[jobs[failed]] = time
+            self.num_failed += int(failed.sum())
+            if self.num_failed > max(64, len(self.active) // 4):
+                self._index_live()
+
+    def run(self, times: List[np.ndarray], previous_edges: Optional[List[Optional[np.ndarray]]] = None) -> None:
+        """
+        Steps through the merged delta event times of all the signals (times[i] are the event times of signal i,
+        previous_edges[i] the clock edges before them, or None for a signal without clock edges, see step).
+        """
+        self._index_live()
+        signals = np.repeat(np.arange(len(times)), [len(t) for t in times])
+        all_times = np.concatenate(times) if len(times) > 0 else np.zeros(0, dtype=np.int64)
+        order = np.argsort(all_times, kind='stable')
+        all_times, signals = all_times[order], signals[order]
+        if previous_edges is None:
+            previous_edges = [None] * len(times)
+        edges = np.concatenate([np.zeros(len(t), dtype=np.int64) if e is None else e
+                                for (t, e) in zip(times, previous_edges)] + [np.zeros(0, dtype=np.int64)])[order]
+        exact = np.repeat(np.array([e is None for e in previous_edges], dtype=bool), [len(t) for t in times])[order]
+        bounds = np.flatnonzero(np.diff(all_times)) + 1
+        starts = np.concatenate([[0], bounds]).tolist()
+        ends = np.concatenate([bounds, [len(all_times)]]).tolist()
+        for (i, j) in zip(starts, ends):
+            if len(self.active) == 0:
+                break
+            if i < j:
+                self.step(int(all_times[i]), signals[i:j], edges[i:j], exact[i:j])
+
+    @property
+    def falsified(self) -> np.ndarray:
+        return self.state == self.fail
+
+
+class SignalIndex:
+    """
+    Per-signal packed bitsets over the event grid of a set of signals (the distinct times at which any of them has a
+    delta event): bit g of a signal is set if it has a delta event at grid step g.
+    """
+    def __init__(self, times: List[np.ndarray]) -> None:
+        self.grid = np.unique(np.concatenate(times)) if len(times) > 0 else np.zeros(0, dtype=np.int64)
+        self.bits = np.zeros((len(times), (len(self.grid) + 7) // 8), dtype=np.uint8)
+        self.first = np.full(len(times), len(self.grid), dtype=np.int64)
+        for (i, t) in enumerate(times):
+            steps = np.searchsorted(self.grid, t)
+            row = np.zeros(len(self.grid), dtype=bool)
+            row[steps] = True
+            self.bits[i] = np.packbits(row)
+            if len(steps) > 0:
+                self.first[i] = steps[0]
+
+    def window(self, num_steps: int) -> np.ndarray:
+        return self.bits[:, :(num_steps + 7) // 8]
+
+
+_LEADING_ZEROS = np.array([8 - x.bit_length() for x in range(256)], dtype=np.int64)
+
+
+def _first_set_bit(rows: np.ndarray) -> np.ndarray:
+    # Index of the first set bit of every packed row, or the row length in bits if no bit is set
+    nonzero = rows != 0
+    byte = np.argmax(nonzero, axis=1) if rows.shape[1] > 0 else np.zeros(len(rows), dtype=np.int64)
+    found = nonzero[np.arange(len(rows)), byte] if rows.shape[1] > 0 else np.zeros(len(rows), dtype=bool)
+    first = byte * 8 + _LEADING_ZEROS[rows[np.arange(len(rows)), byte]] if rows.shape[1] > 0 else byte
+    return np.where(found, first, rows.shape[1] * 8)
+
+
+def _next_step(rows: np.ndarray) -> np.ndarray:
+    # Shift packed rows by one bit so that bit g holds bit g + 1
+    carry = np.zeros_like(rows)
+    carry[:, :-1] = rows[:, 1:] >> 7
+    return (rows << 1) | carry
+
+
+def prefilter(miner: BatchedMiner, index: SignalIndex, identical: np.ndarray, window: int = 512) \
+        -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Rules out live jobs of the miner with cheap set operations on the signal index before any automaton runs:
+      identical:   a and b have identical traces, for tables that reject identical traces (decided, falsified at 0)
+      first_event: the table fails on the first merged event, from the first set bits (decided)
+      coincident:  a and b have an event on the same grid step within the window, for tables that fail on AB from
+                   every state
+      shifted_and: a has events on two consecutive grid steps without b on the second one (a shifted AND) within the
+                   window, for tables that fail on A right after A or AB
+    Decided jobs get their exact stats. Jobs caught by the last two stages are certain to be falsified within the
+    window; they are removed from the miner and returned, so they can be resolved by the single-pass kernel, which
+    stops at the falsification. Also returns how many jobs each stage removed.
+    """
+    counters = {}  # type: Dict[str, int]
+    tables = miner.tables
+    fail_on_ab = np.array([all(t.next_state[q, AB] == t.fail for q in range(t.num_states)) for t in tables])
+    fail_on_repeated_a = np.array([
+        all(t.next_state[s, A] == t.fail for q in range(t.num_states)
+            for s in (t.next_state[q, A], t.next_state[q, AB]) if s != t.fail)
+        for t in tables])
+
+    jobs = np.flatnonzero(miner.live & identical & np.array([t.falsified_by_identical_traces for t in tables],
+                                                            dtype=bool)[miner.jobs_table])
+    ones, zeros = np.ones(len(jobs), dtype=bool), np.zeros(len(jobs), dtype=np.int64)
+    miner.decide(jobs, zeros, ones, ones, zeros)
+    counters['identical'] = len(jobs)
+
+    jobs = np.flatnonzero(miner.live)
+    first_a, first_b = index.first[miner.jobs_a[jobs]], index.first[miner.jobs_b[jobs]]
+    symbols = np.where(first_a == first_b, AB, np.where(first_a < first_b, A, B))
+    code = miner.lut[miner.lut_base[jobs] + symbols]
+    decided = ((code & 0xFF) == miner.fail) & (np.minimum(first_a, first_b) < len(index.grid))
+    jobs, first = jobs[decided], np.minimum(first_a, first_b)[decided]
+    miner.decide(jobs, code[decided] >> 16, (code[decided] & 0x100) != 0, np.ones(len(jobs), dtype=bool),
+                 index.grid[first])
+    counters['first_event'] = len(jobs)
+
+    window = min(window, len(index.grid))
+    bits = index.window(window)
+    doomed = []  # type: List[np.ndarray]
+    for (stage, applies) in (('coincident', fail_on_ab), ('shifted_and', fail_on_repeated_a)):
+        jobs = np.flatnonzero(miner.live & applies[miner.jobs_table])
+        a_bits, b_bits = bits[miner.jobs_a[jobs]], bits[miner.jobs_b[jobs]]
+        if stage == 'coincident':
+            hits = a_bits & b_bits
+        else:
+            hits = a_bits & _next_step(a_bits) & ~_next_step(b_bits)
+        jobs = jobs[_first_set_bit(hits) < window]
+        miner.live[jobs] = False
+        doomed.append(jobs)
+        counters[stage] = len(jobs)
+    return np.concatenate(doomed), counters
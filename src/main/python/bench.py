@@ -0,0 +1,206 @@
+# Synthetic VCD generator and end-to-end benchmark of the mining flow
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Any, Callable, Tuple
+from vcd import Module, ModuleIndex, VCDData, read_vcd, read_vcd_clean, sample_signals, _clean_symbols, read_vcd_header
+from analysis import mine_modules_recurse, MinerResult
+from merger import merge_props
+from checker import check_props
+
+
+def _symbols():
+    # VCD identifier codes: printable ASCII 33..126, little-endian base 94
+    n = 0
+    while True:
+        x, code = n, ''
+        while True:
+            code += chr(33 + x % 94)
+            x //= 94
+            if x == 0:
+                break
+        yield code
+        n += 1
+
+
+def generate_vcd(path: str, num_signals: int = 64, depth: int = 2, alias_fanout: int = 1, cycles: int = 10000,
+                 toggle_density: float = 0.2, seed: int = 0) -> None:
+    """
+    Writes a synthetic VCD with a clock (period 2), a reset and num_signals data signals spread over a chain of depth
+    nested modules. Each data signal has alias_fanout names and a width of 1 to 4 bits, every 4th signal also has a
+    Chisel temporary alias, and each signal changes value on a cycle with probability toggle_density (scaled per
+    signal so that both busy and quiet signals occur). Changes mostly happen on the falling clock edge.
+    """
+    rnd = random.Random(seed)
+    codes = _symbols()
+    clock, reset = next(codes), next(codes)
+    lines = ["$timescale 1ps $end", "$scope module TOP $end",
+             "$var wire 1 {} clock $end".format(clock), "$var wire 1 {} reset $end".format(reset)]
+    signals = []  # type: List[Tuple[str, int, float]]
+    per_module = -(-num_signals // max(depth, 1))
+    for d in range(max(depth, 1)):
+        lines.append("$scope module m{} $end".format(d))
+        for i in range(d * per_module, min((d + 1) * per_module, num_signals)):
+            code, width = next(codes), rnd.choice([1, 1, 1, 2, 4])
+            for k in range(alias_fanout):
+                lines.append("$var wire {} {} sig{}{} $end".format(width, code, i, "" if k == 0 else "_a{}".format(k)))
+            if i % 4 == 0:
+                lines.append("$var wire {} {} _T_{} $end".format(width, code, i))
+            signals.append((code, width, min(1.0, toggle_density * 2 * rnd.random())))
+    lines.extend(["$upscope $end"] * (max(depth, 1) + 1))
+    lines.append("$enddefinitions $end")
+
+    def change(code: str, width: int, value: int) -> str:
+        return "{}{}".format(value, code) if width == 1 else "b{} {}".format(bin(value)[2:], code)
+
+    values = [0] * len(signals)
+    lines.extend(["#0", "$dumpvars", "0" + clock, "1" + reset] + [change(c, w, 0) for (c, w, _) in signals] + ["$end"])
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+        for cycle in range(cycles):
+            lines = ["#{}".format(2 * cycle + 1), "1" + clock]
+            if cycle == 4:
+                lines.append("0" + reset)
+            lines.append("#{}".format(2 * cycle + 2))
+            lines.append("0" + clock)
+            for (i, (code, width, density)) in enumerate(signals):
+                if rnd.random() < density:
+                    values[i] = (values[i] + rnd.randrange(1, 1 << width)) % (1 << width) if width > 1 \
+                        else 1 - values[i]
+                    lines.append(change(code, width, values[i]))
+            f.write("\n".join(lines) + "\n")
+
+
+def max_rss_kb() -> int:
+    # The high-water mark of the resident set of this process so far, which never goes down
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _timed(stage: str, fn: Callable[[], Any], results: List[Dict[str, Any]]) -> Tuple[Any, Dict[str, Any], float]:
+    # Stages share the process, so only how far a stage raised the high-water mark is its own
+    rss_before = max_rss_kb()
+    start = time.perf_counter()
+    value = fn()
+    seconds = time.perf_counter() - start
+    rss_after = max_rss_kb()
+    entry = {'stage': stage, 'seconds': seconds, 'max_rss_kb': rss_after,
+             'max_rss_growth_kb': rss_after - rss_before}  # type: Dict[str, Any]
+    results.append(entry)
+    return value, entry, seconds
+
+
+def run_benchmark(vcd_files: List[str], start_time: int, signal_bit_limit: int) -> List[Dict[str, Any]]:
+    """
+    Times the stages of the flow separately on the given VCDs (the first one is also the checked trace):
+    read_vcd (parse), sample_signal (clock sampling of the parsed traces), read_vcd_clean (streamed parse and sample),
+    mine_modules_recurse, merge_props and check. Rates are per second of the stage's wall time. Memory is reported as
+    the process-wide RSS high-water mark after each stage (cumulative over the stages run so far) and how much the
+    stage raised it.
+    """
+    results = []  # type: List[Dict[str, Any]]
+    mined = []  # type: List[MinerResult]
+    for path in vcd_files:
+        (module_tree, raw), entry, seconds = _timed('read_vcd', lambda: read_vcd(path), results)
+        events = sum(len(t) for t in raw.values())
+        entry.update(file=path, events=events, events_per_s=events / seconds)
+
+        with open(path) as f:
+            _, symbols = read_vcd_header(f)
+        clocks, kept, _ = _clean_symbols(symbols, signal_bit_limit)
+        clock = raw[frozenset(symbols[next(iter(clocks))])]
+        traces = {k: raw[frozenset(symbols[s])] for (s, k) in kept.items()}
+        _, entry, seconds = _timed('sample_signal', lambda: sample_signals(clock, traces), results)
+        events = sum(len(t) for t in traces.values()) + len(clock)
+        entry.update(file=path, events=events, events_per_s=events / seconds)
+        del raw, traces
+
+        (module_tree, vcd_data), entry, seconds = _timed(
+            'read_vcd_clean', lambda: read_vcd_clean(path, start_time, signal_bit_limit), results)
+        events = sum(len(t) for t in vcd_data.values())
+        entry.update(file=path, signals=len(vcd_data), events=events, events_per_s=events / seconds)
+
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            props, entry, seconds = _timed('mine_modules_recurse', lambda: mine_modules_recurse(module_tree, vcd_data),
+                                           results)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        pairs = _module_pairs(module_tree, vcd_data)
+        entry.update(file=path, pairs=pairs, pairs_per_s=pairs / seconds, properties=len(props))
+        mined.append(props)
+
+    merged, entry, seconds = _timed('merge_props', lambda: merge_props(mined), results)
+    entry.update(properties_in=sum(len(m) for m in mined), properties=len(merged),
+                 properties_per_s=sum(len(m) for m in mined) / seconds)
+
+    to_check = [p for (p, s) in merged.items() if not s.falsified]
+    module_tree, vcd_data = read_vcd_clean(vcd_files[0], start_time, signal_bit_limit)
+    checked, entry, seconds = _timed('check', lambda: check_props(to_check, vcd_data), results)
+    pairs = len({(p.a, p.b) for p in to_check})
+    entry.update(file=vcd_files[0], properties=len(to_check), pairs=pairs, pairs_per_s=pairs / seconds,
+                 violations=sum(not ok for (ok, _) in checked.values()))
+    return results
+
+
+def _module_pairs(module_tree: Module, vcd_data: VCDData) -> int:
+    pairs, queue, index = 0, [module_tree], ModuleIndex(vcd_data.keys())
+    while len(queue) > 0:
+        module = queue.pop()
+        n = len(index.module(module.name))
+        pairs += n * (n - 1)
+        queue.extend(module.children)
+    return pairs
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the mining flow on synthetic VCDs')
+    parser.add_argument('--signals', type=int, default=64, help='Number of data signals')
+    parser.add_argument('--depth', type=int, default=2, help='Number of nested modules the signals are spread over')
+    parser.add_argument('--aliases', type=int, default=1, help='Names per signal (alias fan-out)')
+    parser.add_argument('--cycles', type=int, default=10000)
+    parser.add_argument('--density', type=float, default=0.2, help='Mean probability that a signal toggles on a cycle')
+    parser.add_argument('--traces', type=int, default=2, help='Number of traces to mine and merge')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-time', type=int, default=10)
+    parser.add_argument('--signal-bit-limit', type=int, default=5)
+    parser.add_argument('--vcd-dir', type=str, help='Keep the generated VCDs in this directory')
+    parser.add_argument('--output', type=str, default='bench.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+    print("Benchmark called with arguments: {}".format(args))
+
+    vcd_dir = args.vcd_dir if args.vcd_dir is not None else tempfile.mkdtemp(prefix='spec-mining-bench-')
+    os.makedirs(vcd_dir, exist_ok=True)
+    vcd_files = []  # type: List[str]
+    for i in range(args.traces):
+        path = os.path.join(vcd_dir, 'bench_{}.vcd'.format(i))
+        generate_vcd(path, args.signals, args.depth, args.aliases, args.cycles, args.density, args.seed + i)
+        vcd_files.append(path)
+
+    stages = run_benchmark(vcd_files, args.start_time, args.signal_bit_limit)
+    for entry in stages:
+        rates = ", ".join("{} {:.0f}".format(k, v) for (k, v) in entry.items() if k.endswith('_per_s'))
+        print("{:<22} {:8.3f}s  max RSS so far {} KB (+{} KB)  {}".format(
+            entry['stage'], entry['seconds'], entry['max_rss_kb'], entry['max_rss_growth_kb'], rates))
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': _git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': vars(args),
+                   'stages': stages}, f, indent=2)
+    if args.vcd_dir is None:
+        for path in vcd_files:
+            os.remove(path)
+        os.rmdir(vcd_dir)
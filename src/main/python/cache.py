@@ -0,0 +1,501 @@
+from vcd import Module, ModuleIndex, Signal, AliasedSignals, VCDData, DeltaTrace, ClockDomain, SignalFilter, \
+    SIGNAL_TABLE, as_delta_trace, module_of, read_vcd_clean
+from analysis import Property, PropertyStats, MinerResult, PROPERTY_CLASSES, mine_modules_recurse
+from propstore import PropertyStore, write_props
+from collections import defaultdict
+from typing import Dict, List, Tuple, Type, Callable, Iterable, Optional, Any
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump whenever the cleaning/sampling in read_vcd_clean or the entry layout changes, so stale entries are never read
+CACHE_VERSION = 2
+# Bump whenever mining or checking computes something else from the same traces, so stale results are never read
+RESULT_VERSION = 1
+DEFAULT_MAX_BYTES = 2 << 30
+_MAGIC = b'SPECTRC1'
+# Sampled traces, mined properties of a module and check verdicts of a trace, which share one size bound
+_ENTRY_SUFFIXES = ('.trc', '.res', '.chk')
+
+
+def default_cache_dir() -> str:
+    return os.environ.get('SPEC_MINING_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'spec-mining'))
+
+
+def _module_to_json(module: Module) -> Dict[str, Any]:
+    return {'name': module.name, 'children': [_module_to_json(c) for c in module.children]}
+
+
+def _module_from_json(node: Dict[str, Any]) -> Module:
+    module = Module(node['name'])
+    module.children = [_module_from_json(c) for c in node['children']]
+    return module
+
+
+class TraceCache:
+    """
+    An on-disk cache of the module tree and sampled traces that read_vcd_clean produces, keyed by the content hash of
+    the VCD plus start_time, signal_bit_limit and the SignalFilter (if not the default one). Each entry is one binary file: a magic number, a JSON header (module
+    tree, signal aliases, trace offsets) and then the event times (int64) and values (uint64) of every trace back to
+    back, which are memory-mapped on load instead of being read. Values wider than 64 bits are kept in the header.
+    The posedges of every clock domain follow the traces, as extra traces whose values are unused.
+    Content hashes are remembered per (path, size, mtime) so a hit does not re-read the VCD. When the entries (with
+    those of a ResultCache in the same directory) grow past max_bytes, the least recently used ones are evicted.
+    """
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.directory = default_cache_dir() if directory is None else directory
+        self.max_bytes = max_bytes
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _write_atomic(self, name: str, data: List[bytes]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for d in data:
+                    f.write(d)
+            os.replace(tmp_path, self._path(name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def content_hash(self, vcd_file_path: str) -> str:
+        path = os.path.abspath(vcd_file_path)
+        st = os.stat(path)
+        try:
+            with open(self._path('hashes.json'), 'r') as f:
+                hashes = json.load(f)  # type: Dict[str, List[Any]]
+        except (OSError, ValueError):
+            hashes = {}
+        if hashes.get(path, [None, None, None])[:2] == [st.st_size, st.st_mtime_ns]:
+            return hashes[path][2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        hashes[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        self._write_atomic('hashes.json', [json.dumps(hashes).encode()])
+        return h.hexdigest()
+
+    def key(self, vcd_file_path: str, start_time: int, signal_bit_limit: int,
+            signal_filter: Optional[SignalFilter] = None) -> str:
+        key = "{}-{}-{}".format(self.content_hash(vcd_file_path), start_time, signal_bit_limit)
+        if signal_filter is not None and not signal_filter.is_default:
+            key += "-" + hashlib.sha256(repr(signal_filter).encode()).hexdigest()[:16]
+        return "{}-v{}".format(key, CACHE_VERSION)
+
+    def load(self, key: str) -> Optional[Tuple[Module, VCDData]]:
+        path = self._path(key + '.trc')
+        try:
+            with open(path, 'rb') as f:
+                magic, header_len = f.read(len(_MAGIC)), struct.unpack('<Q', f.read(8))[0]
+                if magic != _MAGIC:
+                    return None
+                header = json.loads(f.read(header_len).decode())
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, struct.error):
+            return None
+
+        offsets = header['offsets']
+        data_offset = len(_MAGIC) + 8 + header_len
+        data_offset += -data_offset % 8
+        if offsets[-1] > 0:
+            data = np.memmap(path, dtype=np.int64, mode='r', offset=data_offset, shape=(2, offsets[-1]))
+        else:
+            data = np.zeros((2, 0), dtype=np.int64)
+        num_signals = len(header['signals'])
+        domains = [ClockDomain(clock, data[0, offsets[num_signals + d]:offsets[num_signals + d + 1]])
+                   for (d, clock) in enumerate(header['domains'])]
+        vcd_data = {}  # type: VCDData
+        for (i, aliases) in enumerate(header['signals']):
+            lo, hi = offsets[i], offsets[i + 1]
+            wide = header['wide'].get(str(i))
+            values = np.array([int(v, 16) for v in wide], dtype=object) if wide is not None \
+                else data[1, lo:hi].view(np.uint64)
+            aliases = SIGNAL_TABLE.intern(frozenset(Signal(name, width) for (name, width) in aliases))
+            domain = header['signal_domains'][i]
+            vcd_data[aliases] = DeltaTrace(data[0, lo:hi], values, domains[domain] if domain is not None else None)
+        return _module_from_json(header['module_tree']), vcd_data
+
+    def store(self, key: str, module_tree: Module, vcd_data: VCDData) -> None:
+        traces = list(vcd_data.values())
+        domains = list({id(t.domain): t.domain for t in traces if t.domain is not None}.values())
+        domain_ids = {id(d): i for (i, d) in enumerate(domains)}
+        segments = traces + [DeltaTrace(d.posedges, np.zeros(len(d.posedges), dtype=np.uint64)) for d in domains]
+        offsets = np.concatenate([[0], np.cumsum([len(t) for t in segments])]).astype(np.int64)
+        wide = {str(i): [hex(v) for v in t.values.tolist()] for (i, t) in enumerate(traces) if t.values.dtype == object}
+        header = json.dumps({
+            'module_tree': _module_to_json(module_tree),
+            'signals': [sorted([s.name, s.width] for s in aliases) for aliases in vcd_data.keys()],
+            'domains': [d.clock for d in domains],
+            'signal_domains': [domain_ids[id(t.domain)] if t.domain is not None else None for t in traces],
+            'offsets': offsets.tolist(),
+            'wide': wide,
+        }).encode()
+        padding = b'\0' * (-(len(_MAGIC) + 8 + len(header)) % 8)
+        values = [np.zeros(len(t), dtype=np.int64) if t.values.dtype == object else t.values.view(np.int64)
+                  for t in segments]
+        times_bytes = np.concatenate([t.times for t in segments] + [np.zeros(0, dtype=np.int64)]).tobytes()
+        values_bytes = np.concatenate(values + [np.zeros(0, dtype=np.int64)]).tobytes()
+        self._write_atomic(key + '.trc', [_MAGIC, struct.pack('<Q', len(header)), header, padding, times_bytes,
+                                          values_bytes])
+        self.evict(keep=key + '.trc')
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        entries = []  # type: List[Tuple[float, int, str]]
+        for name in os.listdir(self.directory):
+            if name.endswith(_ENTRY_SUFFIXES):
+                try:
+                    st = os.stat(self._path(name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name != keep:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+                total -= size
+
+
+def cacheable(vcd_file_path: str) -> bool:
+    # Standard input and named pipes can only be read once, so they are never hashed and cached
+    return vcd_file_path != '-' and os.path.isfile(vcd_file_path)
+
+
+def read_vcd_cached(vcd_file_path: str, start_time: int, signal_bit_limit: int,
+                    cache: Optional[TraceCache] = None,
+                    signal_filter: Optional[SignalFilter] = None) -> Tuple[Module, VCDData]:
+    """
+    read_vcd_clean through a TraceCache; without a cache, or for a VCD that is not cacheable, this is just
+    read_vcd_clean.
+    """
+    if cache is None or not cacheable(vcd_file_path):
+        return read_vcd_clean(vcd_file_path, start_time, signal_bit_limit, signal_filter=signal_filter)
+    key = cache.key(vcd_file_path, start_time, signal_bit_limit, signal_filter)
+    cached = cache.load(key)
+    if cached is not None:
+        return cached
+    module_tree, vcd_data = read_vcd_clean(vcd_file_path, start_time, signal_bit_limit, signal_filter=signal_filter)
+    cache.store(key, module_tree, vcd_data)
+    return module_tree, vcd_data
+
+
+def pattern_fingerprint(property_classes: List[Type[Property]]) -> str:
+    # Changes whenever a property type is added, removed, reordered or gets another automaton
+    h = hashlib.sha256()
+    for p in property_classes:
+        table = p.table
+        h.update(json.dumps([p.__name__, table.num_states, table.falsified_by_identical_traces]).encode())
+        for array in (table.next_state, table.support, table.falsifiable):
+            h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def _props_digest(props: Iterable[Property]) -> str:
+    names = [[type(p).__name__, sorted(s.name for s in p.a), sorted(s.name for s in p.b)] for p in props]
+    return hashlib.sha256(json.dumps(sorted(names)).encode()).hexdigest()
+
+
+class ResultCache(TraceCache):
+    """
+    An on-disk cache of what is computed from sampled traces, next to the traces in a TraceCache directory and evicted
+    together with them: the properties mined from every module, keyed by a fingerprint of the names and sampled
+    traces of its signals and of the property types (so a module is only mined again when its own inputs change),
+    and the check verdicts of a trace, keyed by the content hash of the VCD, start_time, signal_bit_limit and the
+    property types. Both are stored as property stores (see propstore.write_props).
+    """
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES,
+                 property_classes: List[Type[Property]] = PROPERTY_CLASSES) -> None:
+        super().__init__(directory, max_bytes)
+        self.patterns = pattern_fingerprint(property_classes)
+
+    def _load_props(self, name: str) -> Optional[MinerResult]:
+        path = self._path(name)
+        try:
+            props = PropertyStore(path).load()
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, KeyError, struct.error):
+            return None
+        return props
+
+    def _store_props(self, name: str, props: MinerResult) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        os.close(fd)
+        try:
+            write_props(tmp_path, props)
+            os.replace(tmp_path, self._path(name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict(keep=name)
+
+    def module_key(self, module_name: str, signal_digests: List[bytes]) -> str:
+        h = hashlib.sha256(json.dumps([RESULT_VERSION, self.patterns, module_name]).encode())
+        for digest in signal_digests:
+            h.update(digest)
+        return h.hexdigest()
+
+    def load_module(self, key: str) -> Optional[MinerResult]:
+        return self._load_props(key + '.res')
+
+    def store_module(self, key: str, props: MinerResult) -> None:
+        self._store_props(key + '.res', props)
+
+    def check_key(self, vcd_file_path: str, start_time: int, signal_bit_limit: int) -> str:
+        return "{}-{}-{}-{}-r{}".format(self.content_hash(vcd_file_path), start_time, signal_bit_limit,
+                                        self.patterns[:16], RESULT_VERSION)
+
+    def _verdict_entries(self, key: str) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(self.directory)
+                          if name.startswith(key + '-') and name.endswith('.chk'))
+        except OSError:
+            return []
+
+    def load_verdicts(self, key: str) -> Dict[Property, Tuple[bool, int]]:
+        # The verdicts (not violated, falsified_time) of every property checked so far against the trace of key
+        verdicts = {}  # type: Dict[Property, Tuple[bool, int]]
+        for name in self._verdict_entries(key):
+            for (prop, stats) in (self._load_props(name) or {}).items():
+                verdicts[prop] = (not stats.falsified, stats.falsified_time)
+        return verdicts
+
+    def store_verdicts(self, key: str, verdicts: Dict[Property, Tuple[bool, int]]) -> None:
+        # Merges the new verdicts and the stored ones into one entry and removes the entries it merged. Processes
+        # checking different properties against the same trace never lose each other's verdicts: each writes its own
+        # entry (named by its properties) and only removes the ones it read, which the next store merges again.
+        names = self._verdict_entries(key)
+        props = {}  # type: MinerResult
+        for name in names:
+            props.update(self._load_props(name) or {})
+        props.update({prop: PropertyStats(support=0, falsifiable=True, falsified=not not_violated,
+                                          falsified_time=falsified_time)
+                      for (prop, (not_violated, falsified_time)) in verdicts.items()})
+        merged = "{}-{}.chk".format(key, _props_digest(props.keys())[:16])
+        self._store_props(merged, props)
+        for name in names:
+            if name != merged:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+
+def _signal_digest(aliases: AliasedSignals, trace: DeltaTrace, domain_digests: Dict[int, bytes]) -> bytes:
+    # A fingerprint of the names of a signal, its sampled trace and the posedges of its clock domain
+    h = hashlib.sha256(json.dumps(sorted([s.name, s.width] for s in aliases)).encode())
+    h.update(struct.pack('<Q', len(trace)))
+    h.update(np.ascontiguousarray(trace.times).tobytes())
+    if trace.values.dtype == object:
+        h.update(json.dumps([hex(v) for v in trace.values.tolist()]).encode())
+    else:
+        h.update(np.ascontiguousarray(trace.values).tobytes())
+    if trace.domain is not None:
+        if id(trace.domain) not in domain_digests:
+            domain_digests[id(trace.domain)] = hashlib.sha256(
+                trace.domain.clock.encode() + trace.domain.posedges.tobytes()).digest()
+        h.update(domain_digests[id(trace.domain)])
+    return h.digest()
+
+
+def mine_modules_cached(module: Module, vcd_data: VCDData, result_cache: ResultCache,
+                        mine: Callable[[Module, VCDData], MinerResult] = mine_modules_recurse) -> MinerResult:
+    """
+    Mines the same modules as mine_modules_recurse and returns the same MinerResult, taking the properties of every
+    module whose signals are unchanged from result_cache and mining only the other modules, all at once with mine (any of
+    the mine_modules_* functions). The newly mined properties are then stored per module for the next run.
+    """
+    keys = list(vcd_data.keys())  # type: List[AliasedSignals]
+    traces = [as_delta_trace(vcd_data[k]) for k in keys]
+    index = ModuleIndex(keys)
+    signal_digests = {}  # type: Dict[int, bytes]
+    domain_digests = {}  # type: Dict[int, bytes]
+
+    # The modules in the order mine_modules_recurse visits them; modules without a pair of signals mine nothing
+    modules = []  # type: List[Tuple[Module, Optional[str]]]
+    module_queue = [module]
+    while len(module_queue) > 0:
+        m = module_queue.pop()
+        signals = index.module(m.name).tolist()
+        key = None
+        if len(signals) > 1:
+            for i in signals:
+                if i not in signal_digests:
+                    signal_digests[i] = _signal_digest(keys[i], traces[i], domain_digests)
+            key = result_cache.module_key(m.name, [signal_digests[i] for i in signals])
+        modules.append((m, key))
+        module_queue.extend(m.children)
+
+    module_props = {}  # type: Dict[str, MinerResult]
+    missing = []  # type: List[Tuple[Module, str]]
+    for (m, key) in modules:
+        if key is None:
+            continue
+        props = result_cache.load_module(key)
+        if props is None:
+            missing.append((m, key))
+        else:
+            print("Loaded module = {} from the result cache ({} properties)".format(m.name, len(props)))
+            module_props[m.name] = props
+
+    if len(missing) > 0:
+        # A chain of childless copies of the missing modules makes mine visit exactly them, in the same order
+        chain = [Module(m.name) for (m, _) in missing]
+        for (parent, child) in zip(chain[:-1], chain[1:]):
+            parent.children = [child]
+        mined = mine(chain[0], vcd_data)
+
+        # Split the properties back per module, in the (a, b, property type) order that mine_signals returns
+        by_module = defaultdict(list)  # type: Dict[str, List[Tuple[Property, PropertyStats]]]
+        for (prop, stats) in mined.items():
+            for name in {module_of(s.name) for s in prop.a} & {module_of(s.name) for s in prop.b}:
+                by_module[name].append((prop, stats))
+        class_ids = {p: k for (k, p) in enumerate(PROPERTY_CLASSES)}
+        for (m, key) in missing:
+            props = sorted(by_module[m.name], key=lambda x: (index.ids[x[0].a], index.ids[x[0].b],
+                                                              class_ids[type(x[0])]))
+            module_props[m.name] = dict(props)
+            result_cache.store_module(key, module_props[m.name])
+
+    result = {}  # type: MinerResult
+    for (m, _) in modules:
+        result.update(module_props.get(m.name, {}))
+    return result
+
+
+if __name__ == "__main__":
+    print("TESTING: TraceCache")
+    with tempfile.TemporaryDirectory() as tmp:
+        vcd_path = os.path.join(tmp, 'test.vcd')
+        with open(vcd_path, 'w') as f:
+            f.write("\n".join([
+                "$scope module TOP $end", "$var wire 1 ! clock $end", "$var wire 4 \" count $end",
+                "$var wire 80 # wide $end", "$upscope $end", "$enddefinitions $end",
+                "#0", "0!", "b0 \"", "b0 #", "#1", "1!", "#2", "0!", "b11 \"", "b{} #".format(bin(1 << 70)[2:]),
+                "#3", "1!", "#4", "0!", "b101 \"", "#5", "1!", ""]))
+        cache = TraceCache(os.path.join(tmp, 'cache'))
+        module_tree, vcd_data = read_vcd_cached(vcd_path, 0, 128, cache)
+        cached_tree, cached_data = read_vcd_cached(vcd_path, 0, 128, cache)
+        assert str(cached_tree) == str(module_tree)
+        assert list(cached_data.keys()) == list(vcd_data.keys())
+        assert all(cached_data[k] == vcd_data[k] for k in vcd_data.keys())
+        assert all(np.array_equal(cached_data[k].domain.posedges, vcd_data[k].domain.posedges) for k in vcd_data.keys())
+        assert len(os.listdir(cache.directory)) == 2
+
+        # A different bit limit is a different entry, and the oldest entry is evicted once over the size bound
+        cache.max_bytes = os.path.getsize(cache._path(cache.key(vcd_path, 0, 128) + '.trc'))
+        os.utime(cache._path(cache.key(vcd_path, 0, 128) + '.trc'), (0, 0))
+        read_vcd_cached(vcd_path, 0, 4, cache)
+        assert cache.load(cache.key(vcd_path, 0, 128)) is None
+        assert cache.load(cache.key(vcd_path, 0, 4)) is not None
+
+        # A signal filter is part of the key, and its scope is the cached root module
+        assert cache.key(vcd_path, 0, 4, SignalFilter()) == cache.key(vcd_path, 0, 4)
+        module_tree, vcd_data = read_vcd_cached(vcd_path, 0, 128, cache, SignalFilter(exclude=['wide']))
+        assert [sorted(s.name for s in k) for k in vcd_data.keys()] == [['TOP.count']]
+        assert list(read_vcd_cached(vcd_path, 0, 128, cache, SignalFilter(exclude=['wide']))[1].keys()) == \
+            list(vcd_data.keys())
+
+    print("TESTING: ResultCache")
+    with tempfile.TemporaryDirectory() as tmp:
+        vcd_path = os.path.join(tmp, 'test.vcd')
+
+        def write_vcd(child_values):
+            lines = ["$scope module TOP $end", "$var wire 1 ! clock $end", "$var wire 1 \" a $end",
+                     "$var wire 1 # b $end", "$scope module child $end", "$var wire 1 $ c $end",
+                     "$var wire 1 % d $end", "$upscope $end", "$upscope $end", "$enddefinitions $end"]
+            for t in range(40):
+                lines.append("#{}".format(2 * t))
+                lines.append("0!")
+                lines.append("{}\"".format(t % 2))
+                lines.append("{}#".format((t // 2) % 2))
+                lines.append("{}$".format(child_values[t % len(child_values)]))
+                lines.append("{}%".format((t // 3) % 2))
+                lines.append("#{}".format(2 * t + 1))
+                lines.append("1!")
+            with open(vcd_path, 'w') as f:
+                f.write("\n".join(lines + [""]))
+
+        from analysis import Next
+        write_vcd([0, 1])
+        result_cache = ResultCache(os.path.join(tmp, 'cache'))
+        module_tree, vcd_data = read_vcd_clean(vcd_path, 0, 8)
+        expected = mine_modules_recurse(module_tree, vcd_data)
+        assert list(mine_modules_cached(module_tree, vcd_data, result_cache).items()) == list(expected.items())
+        assert sorted(n[-4:] for n in os.listdir(result_cache.directory)) == ['.res', '.res']
+
+        # A second run loads every module instead of mining it again
+        def no_mining(m, d):
+            raise AssertionError("mined module {}".format(m.name))
+        assert list(mine_modules_cached(module_tree, vcd_data, result_cache, no_mining).items()) == \
+            list(expected.items())
+
+        # Changing the trace of one signal only mines its module again
+        write_vcd([0, 0, 1])
+        module_tree, vcd_data = read_vcd_clean(vcd_path, 0, 8)
+        mined = []  # type: List[str]
+
+        def recording(m, d):
+            mined.extend(child.name for child in [m] + m.children)
+            return mine_modules_recurse(m, d)
+        assert list(mine_modules_cached(module_tree, vcd_data, result_cache, recording).items()) == \
+            list(mine_modules_recurse(module_tree, vcd_data).items())
+        assert mined == ['TOP.child']
+
+        # Verdicts are kept per trace, and those of several property sets are combined
+        key = result_cache.check_key(vcd_path, 0, 8)
+        a, b, c = [k for k in vcd_data.keys()][:3]
+        result_cache.store_verdicts(key, {Next(a, b): (True, 0)})
+        result_cache.store_verdicts(key, {Next(b, c): (False, 12)})
+        assert result_cache.load_verdicts(key) == {Next(a, b): (True, 0), Next(b, c): (False, 12)}
+        result_cache.store_verdicts(key, {Next(c, a): (True, 0)})
+        assert result_cache.load_verdicts(key) == \
+            {Next(a, b): (True, 0), Next(b, c): (False, 12), Next(c, a): (True, 0)}
+        assert len([n for n in os.listdir(result_cache.directory) if n.endswith('.chk')]) == 1
+        assert result_cache.load_verdicts(result_cache.check_key(vcd_path, 0, 4)) == {}
+
+    print("TESTING: standard input and named pipes skip the cache")
+    import subprocess
+    import sys
+    import threading
+    with tempfile.TemporaryDirectory() as tmp:
+        vcd_path = os.path.join(tmp, 'test.vcd')
+        lines = ["$scope module TOP $end", "$var wire 1 ! clock $end", "$var wire 1 \" a $end", "$var wire 1 # b $end",
+                 "$upscope $end", "$enddefinitions $end"]
+        for t in range(20):
+            lines.extend(["#{}".format(2 * t), "0!", "{}\"".format(t % 2), "{}#".format((t // 2) % 2),
+                          "#{}".format(2 * t + 1), "1!"])
+        with open(vcd_path, 'w') as f:
+            f.write("\n".join(lines + [""]))
+        fifo_path = os.path.join(tmp, 'test.fifo')
+        os.mkfifo(fifo_path)
+        miner = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'miner.py')
+        env = dict(os.environ, SPEC_MINING_CACHE=os.path.join(tmp, 'cache'))
+
+        def mined(vcd_arg: str, stdin: Any = None) -> List[str]:
+            out = subprocess.run([sys.executable, miner, vcd_arg], stdin=stdin, env=env, stdout=subprocess.PIPE,
+                                 check=True, timeout=60).stdout.decode().splitlines()
+            return out[out.index("Top 10 properties:"):]
+
+        def write_fifo() -> None:
+            with open(fifo_path, 'w') as fifo:
+                fifo.write("\n".join(lines + [""]))
+        expected = mined(vcd_path)
+        with open(vcd_path, 'rb') as f:
+            assert mined('-', f) == expected
+        writer = threading.Thread(target=write_fifo)
+        writer.start()
+        assert mined(fifo_path) == expected
+        writer.join()
@@ -1,9 +1,13 @@
 import sys
-from typing import Tuple, List
-from analysis import Property, MinerResult, Eventual, PropertyStats
-from vcd import VCDData, read_vcd_clean
+from typing import Tuple, List, Dict, Iterable, Iterator, Optional
+from collections import defaultdict
+from analysis import Property, MinerResult, Eventual, PropertyStats, mine_pair
+from vcd import VCDData, AliasedSignals, SignalFilter, read_vcd_clean
+from cache import TraceCache, ResultCache, cacheable
+from propstore import read_props
+from profiling import PROFILE, profiled
 import argparse
-import pickle
+import multiprocessing
 
 
 # Check whether property p isn't violated after traces a and b have been extracted from it
@@ -23,24 +27,227 @@ def check(p: Property, vcd_data: VCDData) -> Tuple[bool, int]:
         return True, 0
 
 
+# Checks many properties at once, with the same results as check: properties are grouped by their (a, b) signal pair
+# and the merged event stream of each pair is walked once for all of them. With first_only, walks stop as soon as
+# they pass the earliest violation found so far, so only the earliest violations are guaranteed to be reported.
+def check_props(props: Iterable[Property], vcd_data: VCDData, first_only: bool = False) \
+        -> Dict[Property, Tuple[bool, int]]:
+    results = {}  # type: Dict[Property, Tuple[bool, int]]
+    pairs = defaultdict(list)  # type: Dict[Tuple[AliasedSignals, AliasedSignals], List[Property]]
+    for p in props:
+        if p.__class__ == Eventual or p.a not in vcd_data.keys() or p.b not in vcd_data.keys():
+            results[p] = check(p, vcd_data)
+        else:
+            pairs[(p.a, p.b)].append(p)
+
+    with PROFILE.timer('check'):
+        PROFILE.count('pairs_walked', len(pairs))
+        earliest = None  # type: Optional[int]
+        for ((a, b), pair_props) in pairs.items():
+            stats = mine_pair(vcd_data[a], vcd_data[b], [p.__class__ for p in pair_props],
+                              until=earliest if first_only else None)
+            for p in pair_props:
+                s = stats[p.__class__]
+                results[p] = (not s.falsified, s.falsified_time)
+                if s.falsified and (earliest is None or s.falsified_time < earliest):
+                    earliest = s.falsified_time
+    if PROFILE.enabled:
+        for (p, (not_violated, _)) in results.items():
+            PROFILE.count('checked', property_type=p.__class__.__name__)
+            PROFILE.count('violations', 0 if not_violated else 1, property_type=p.__class__.__name__)
+    return results
+
+
+def read_vcd_for_props(vcd_file: str, start_time: int, signal_bit_limit: int, props: Iterable[Property],
+                       cache: Optional[TraceCache] = None) -> VCDData:
+    # Use the whole cached trace set if there is one with every signal the properties mention (it lacks the signals
+    # only named by Chisel temporaries), otherwise only parse those signals
+    cached = cache.load(cache.key(vcd_file, start_time, signal_bit_limit)) \
+        if cache is not None and cacheable(vcd_file) else None
+    if cached is not None and all(prop.a in cached[1] and prop.b in cached[1] for prop in props):
+        return cached[1]
+    signals_needed = {s.name for prop in props for s in prop.a | prop.b}
+    return read_vcd_clean(vcd_file, start_time, signal_bit_limit, signals_needed)[1]
+
+
+def check_trace(vcd_file: str, props: Iterable[Property], start_time: int, signal_bit_limit: int,
+                cache: Optional[TraceCache] = None, result_cache: Optional[ResultCache] = None,
+                first_only: bool = False) \
+        -> Dict[Property, Tuple[bool, int]]:
+    """
+    check_props against the trace of vcd_file, taking the verdicts of properties already checked against the same
+    trace from result_cache (when given) and storing the new ones there, so the trace is only read when some properties
+    have never been checked against it. Verdicts of a first_only check may be incomplete and are not stored, and nothing
+    is cached for standard input or named pipes.
+    """
+    props = list(props)
+    if result_cache is None or not cacheable(vcd_file):
+        vcd_data = read_vcd_for_props(vcd_file, start_time, signal_bit_limit, props, cache)
+        return check_props(props, vcd_data, first_only)
+    key = result_cache.check_key(vcd_file, start_time, signal_bit_limit)
+    known = result_cache.load_verdicts(key)
+    verdicts = {p: known[p] for p in props if p in known}  # type: Dict[Property, Tuple[bool, int]]
+    missing = [p for p in props if p not in known]
+    if len(missing) > 0:
+        vcd_data = read_vcd_for_props(vcd_file, start_time, signal_bit_limit, missing, cache)
+        verdicts.update(check_props(missing, vcd_data, first_only))
+        if not first_only:
+            result_cache.store_verdicts(key, {p: verdicts[p] for p in missing})
+    # Violations come out in the order check_props finds them: by signal pair, in the order pairs first appear
+    pair_order = {}  # type: Dict[Tuple[AliasedSignals, AliasedSignals], int]
+    for p in props:
+        if p.__class__ != Eventual:
+            pair_order.setdefault((p.a, p.b), len(pair_order))
+    return {p: verdicts[p] for p in sorted(props, key=lambda p: pair_order.get((p.a, p.b), -1))}
+
+
+# The properties checked by each regression worker process, set up once by the pool initializer
+_regression_props = []  # type: List[Property]
+
+
+def _init_regression(props: List[Property]) -> None:
+    global _regression_props
+    _regression_props = props
+
+
+def _check_shard(task: Tuple[str, int, int, int, int, Optional[TraceCache], Optional[ResultCache]]) \
+        -> List[Tuple[Property, int]]:
+    vcd_file, lo, hi, start_time, signal_bit_limit, cache, result_cache = task
+    verdicts = check_trace(vcd_file, _regression_props[lo:hi], start_time, signal_bit_limit, cache, result_cache)
+    return [(prop, falsified_time) for (prop, (not_violated, falsified_time)) in verdicts.items() if not not_violated]
+
+
+def check_regression(vcd_files: List[str], props: List[Property], start_time: int, signal_bit_limit: int,
+                     cache: Optional[TraceCache] = None, jobs: int = 1,
+                     result_cache: Optional[ResultCache] = None) \
+        -> Iterator[Tuple[str, List[Tuple[Property, int]]]]:
+    """
+    Checks props against every trace in vcd_files on a pool of jobs worker processes, yielding each trace with its
+    violations (property, falsified_time), sorted by time, in the order of vcd_files. Work is split into
+    (trace, property shard) tasks, with enough shards per trace to keep every worker busy. Each task reads just its
+    trace (only the signals its shard needs, unless the trace is cached), so traces are never all held in memory.
+    With a result_cache, verdicts already known for a trace are reused (see check_trace).
+    """
+    num_shards = max(1, -(-jobs // max(len(vcd_files), 1)))
+    shard_size = max(1, -(-len(props) // num_shards))
+    bounds = list(range(0, len(props), shard_size)) + [len(props)]
+    tasks = [(vcd_file, lo, hi, start_time, signal_bit_limit, cache, result_cache)
+             for vcd_file in vcd_files for (lo, hi) in zip(bounds[:-1], bounds[1:])]
+    shards_per_trace = len(bounds) - 1
+
+    _init_regression(props)
+    pool = multiprocessing.Pool(jobs, initializer=_init_regression, initargs=(props,)) if jobs > 1 else None
+    try:
+        results = pool.imap(_check_shard, tasks) if pool is not None else map(_check_shard, tasks)
+        for vcd_file in vcd_files:
+            violations = []  # type: List[Tuple[Property, int]]
+            for _ in range(shards_per_trace):
+                violations.extend(next(results))
+            yield vcd_file, sorted(violations, key=lambda v: v[1])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _self_test() -> None:
+    import os
+    import tempfile
+    from bench import generate_vcd
+    from analysis import mine_modules_recurse
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Properties mined from a short trace, which the longer trace of the same design violates
+        short_vcd, long_vcd = os.path.join(tmp, 'short.vcd'), os.path.join(tmp, 'long.vcd')
+        generate_vcd(short_vcd, num_signals=16, cycles=300, seed=1)
+        generate_vcd(long_vcd, num_signals=16, cycles=2000, seed=1)
+        module_tree, vcd_data = read_vcd_clean(short_vcd, 0, 5)
+        props = [p for (p, s) in mine_modules_recurse(module_tree, vcd_data).items() if not s.falsified]
+        vcd_data = read_vcd_clean(long_vcd, 0, 5)[1]
+
+        print("TESTING: check_props")
+        results = check_props(props, vcd_data)
+        assert results == {p: check(p, vcd_data) for p in props}
+        violations = {p: t for (p, (not_violated, t)) in results.items() if not not_violated}
+        assert len(violations) > 1 and len(set(violations.values())) > 1
+
+        # first_only reports every earliest violation, and only real violations at their real time
+        earliest = min(violations.values())
+        first = {p: t for (p, (not_violated, t)) in check_props(props, vcd_data, first_only=True).items()
+                 if not not_violated}
+        assert all(violations[p] == t for (p, t) in first.items())
+        assert {p for (p, t) in violations.items() if t == earliest} <= set(first.keys())
+
+        print("TESTING: checking properties mined with a signal filter")
+        # A filter selects whole signals, so the mined properties are checked against the same aliased signals
+        filtered_vcd, filtered_long_vcd = os.path.join(tmp, 'filtered.vcd'), os.path.join(tmp, 'filtered_long.vcd')
+        generate_vcd(filtered_vcd, num_signals=16, alias_fanout=2, cycles=300, seed=1)
+        generate_vcd(filtered_long_vcd, num_signals=16, alias_fanout=2, cycles=2000, seed=1)
+        mined = {}  # type: Dict[bool, List[Property]]
+        for use_filter in (False, True):
+            signal_filter = SignalFilter(include=['sig[0-9]*[02468]$']) if use_filter else None
+            module_tree, vcd_data = read_vcd_clean(filtered_vcd, 0, 5, signal_filter=signal_filter)
+            mined[use_filter] = [p for (p, s) in mine_modules_recurse(module_tree, vcd_data).items() if not s.falsified]
+        assert 0 < len(mined[True]) < len(mined[False]) and set(mined[True]) <= set(mined[False])
+        all_violations = check_props(mined[False], read_vcd_clean(filtered_long_vcd, 0, 5)[1])
+        filtered_violations = check_trace(filtered_long_vcd, mined[True], 0, 5)
+        assert filtered_violations == {p: all_violations[p] for p in filtered_violations}
+        assert sum(not not_violated for (not_violated, _) in filtered_violations.values()) > 0
+
+        print("TESTING: check_regression")
+        vcd_files = [long_vcd]
+        for seed in (2, 3):
+            vcd_files.append(os.path.join(tmp, 'seed{}.vcd'.format(seed)))
+            generate_vcd(vcd_files[-1], num_signals=16, cycles=1000, seed=seed)
+        expected = [{p: t for (p, (not_violated, t)) in check_props(props, read_vcd_clean(f, 0, 5)[1]).items()
+                     if not not_violated} for f in vcd_files]
+        # More jobs than traces splits the properties of every trace into several shards
+        for jobs in (1, 2, 7):
+            checked = list(check_regression(vcd_files, props, 0, 5, jobs=jobs))
+            assert [f for (f, _) in checked] == vcd_files
+            for ((_, found), trace_violations) in zip(checked, expected):
+                assert dict(found) == trace_violations and len(found) == len(trace_violations)
+                assert [t for (_, t) in found] == sorted(t for (_, t) in found)
+
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--self-test']:
+        _self_test()
+        sys.exit(0)
     parser = argparse.ArgumentParser()
     parser.add_argument('--start-time', type=int, default=0)
     parser.add_argument('--signal-bit-limit', type=int, default=5)
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of the sampled trace cache (default: $SPEC_MINING_CACHE or ~/.cache/spec-mining)')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the VCD instead of using the trace cache')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='Check every property instead of reusing the verdicts cached for the same trace')
+    parser.add_argument('--module', type=str, help='Only check the properties of signals directly inside this module')
+    parser.add_argument('--signal', type=str, help='Only check the properties involving this signal')
+    parser.add_argument('--first-failure', action='store_true', help='Only report the earliest violations')
+    parser.add_argument('--profile', type=str, help='Write a JSON report of per-stage times and counters to this file')
+    parser.add_argument('--cprofile', type=str, help='Write cProfile stats of the run to this file')
     parser.add_argument('vcd_file', type=str, nargs=1)
     parser.add_argument('prop_file', type=str, nargs=1)
     args = parser.parse_args()
     print("Checker called with arguments: {}".format(args))
 
-    module_tree, vcd_data = read_vcd_clean(args.vcd_file[0], args.start_time, args.signal_bit_limit)
+    props = read_props(args.prop_file[0], args.module, args.signal)  # type: MinerResult
+    props = {prop: stats for (prop, stats) in props.items() if stats.falsified is False}
+
+    cache = None if args.no_cache else TraceCache(args.cache_dir)
+    result_cache = None if args.no_cache or args.no_result_cache else ResultCache(args.cache_dir)
+    with profiled(args.profile, args.cprofile):
+        results = check_trace(args.vcd_file[0], props.keys(), args.start_time, args.signal_bit_limit, cache,
+                              result_cache, args.first_failure)
+
     violated_props = []  # type: List[Tuple[Property, PropertyStats, int]]
-    with open(args.prop_file[0], 'rb') as prop_f:
-        props = pickle.load(prop_f)  # type: MinerResult
-        for (prop, stats) in props.items():
-            if stats.falsified is False:
-                not_violated, falsified_time = check(prop, vcd_data)
-                if not not_violated:
-                    violated_props.append((prop, stats, falsified_time))
+    for (prop, (not_violated, falsified_time)) in results.items():
+        if not not_violated:
+            violated_props.append((prop, props[prop], falsified_time))
+    if args.first_failure and len(violated_props) > 0:
+        first_time = min(falsified_time for (_, _, falsified_time) in violated_props)
+        violated_props = [v for v in violated_props if v[2] == first_time]
 
     violated_props_sorted = sorted(violated_props, key=lambda x: x[2])
     for (prop, stats, falsified_time) in violated_props_sorted:
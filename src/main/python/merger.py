@@ -1,43 +1,137 @@
+import sys
 import argparse
-import pickle
-from typing import List
-from analysis import PropertyStats, MinerResult
+import multiprocessing
+from typing import List, Iterable, Tuple
+from analysis import Property, PropertyStats, MinerResult
+from propstore import read_props, write_props
+from profiling import PROFILE, profiled
 
 
-def merge_props(props: List[MinerResult]) -> MinerResult:
+# Merging is commutative and associative, so the merged result does not depend on the order the dumps are folded in:
+# supports add up, and a property is falsified (at its earliest falsified_time) if any dump falsified it
+def merge_stats(x: PropertyStats, y: PropertyStats) -> PropertyStats:
+    falsified_times = [s.falsified_time for s in (x, y) if s.falsified]
+    return PropertyStats(support=x.support + y.support, falsifiable=x.falsifiable or y.falsifiable,
+                         falsified=len(falsified_times) > 0, falsified_time=min(falsified_times, default=0))
+
+
+def merge_into(merged_props: MinerResult, props: MinerResult) -> MinerResult:
+    for (new_prop, new_stats) in props.items():
+        old_stats = merged_props.get(new_prop)
+        # If prop is found it means a, b, and the property type match
+        merged_props[new_prop] = new_stats if old_stats is None else merge_stats(old_stats, new_stats)
+    return merged_props
+
+
+def prop_sort_key(prop: Property) -> Tuple[str, List[Tuple[str, int]], List[Tuple[str, int]]]:
+    # Aliased signals with the same names but other widths are different signals, so widths break the tie
+    return type(prop).__name__, sorted((s.name, s.width) for s in prop.a), sorted((s.name, s.width) for s in prop.b)
+
+
+def canonical_order(props: MinerResult) -> MinerResult:
+    return {prop: props[prop] for prop in sorted(props.keys(), key=prop_sort_key)}
+
+
+def merge_props(props: Iterable[MinerResult]) -> MinerResult:
     merged_props = {}  # type: MinerResult
     for propset in props:
-        for (new_prop, new_stats) in propset.items():
-            if new_prop not in merged_props:
-                merged_props[new_prop] = new_stats
-            # If prop is found it means a, b, and the property type match
-            else:
-                old_prop_stats = merged_props[new_prop]
-                if new_stats.falsified:
-                    merged_props[new_prop] = \
-                        PropertyStats(support=old_prop_stats.support, falsifiable=True,
-                                      falsified=True, falsified_time=new_stats.falsified_time)
-                else:
-                    merged_props[new_prop] = \
-                        PropertyStats(support=old_prop_stats.support+new_stats.support,
-                                      falsifiable=True, falsified=old_prop_stats.falsified, falsified_time=0)
+        merge_into(merged_props, propset)
+    return canonical_order(merged_props)
+
+
+def _merge_files(prop_files: List[str]) -> MinerResult:
+    # Streams the dumps in, so only the running merge and one dump are in memory at a time
+    merged_props = {}  # type: MinerResult
+    for prop_file in prop_files:
+        merge_into(merged_props, read_props(prop_file))
+    return merged_props
+
+
+def merge_files(prop_files: List[str], jobs: int = 1) -> MinerResult:
+    """
+    Merges property dumps as a tree reduction: the dumps are split into one shard per worker process, each worker
+    streams its shard into a partial merge, and the partial merges are folded together as they finish.
+    """
+    with PROFILE.timer('merge'):
+        PROFILE.count('dumps', len(prop_files))
+        if jobs <= 1 or len(prop_files) <= 1:
+            merged_props = canonical_order(_merge_files(prop_files))
+        else:
+            shards = [prop_files[i::jobs] for i in range(jobs) if i < len(prop_files)]
+            pool = multiprocessing.Pool(len(shards))
+            try:
+                merged_props = merge_props(pool.imap_unordered(_merge_files, shards))
+            finally:
+                pool.close()
+                pool.join()
+        PROFILE.count('properties_merged', len(merged_props))
     return merged_props
 
 
+def _self_test() -> None:
+    import os
+    import random
+    import tempfile
+    from vcd import Signal
+    from analysis import PROPERTY_CLASSES
+
+    print("TESTING: merge_stats")
+    rnd = random.Random(0)
+
+    def random_stats() -> PropertyStats:
+        falsified = rnd.random() < 0.5
+        return PropertyStats(support=rnd.randrange(10), falsifiable=falsified or rnd.random() < 0.5,
+                             falsified=falsified, falsified_time=rnd.randrange(1, 100) if falsified else 0)
+    for _ in range(200):
+        x, y, z = random_stats(), random_stats(), random_stats()
+        assert merge_stats(x, y) == merge_stats(y, x)
+        assert merge_stats(merge_stats(x, y), z) == merge_stats(x, merge_stats(y, z))
+
+    print("TESTING: canonical_order")
+    # The same names with another width are another signal, which must not tie with the first one
+    narrow, wide = frozenset([Signal("TOP.a", 1)]), frozenset([Signal("TOP.a", 4)])
+    b = frozenset([Signal("TOP.b", 1), Signal("TOP.c.b", 1)])
+    props = [(p(a, b), random_stats()) for p in PROPERTY_CLASSES for a in (narrow, wide)]
+    expected = list(canonical_order(dict(props)).items())
+    for _ in range(20):
+        rnd.shuffle(props)
+        assert list(canonical_order(dict(props)).items()) == expected
+
+    print("TESTING: merge_files")
+    signals = [frozenset([Signal("TOP.s{}".format(i), 1 + i % 2)]) for i in range(6)] + [wide, narrow]
+    with tempfile.TemporaryDirectory() as tmp:
+        prop_files = []  # type: List[str]
+        for d in range(5):
+            path = os.path.join(tmp, 'dump{}.props'.format(d))
+            write_props(path, {p(a, b): random_stats() for p in PROPERTY_CLASSES for a in signals for b in signals
+                               if a != b and rnd.random() < 0.6})
+            prop_files.append(path)
+        write_props(os.path.join(tmp, 'expected.props'), merge_files(prop_files))
+        with open(os.path.join(tmp, 'expected.props'), 'rb') as f:
+            expected_bytes = f.read()
+        for jobs in (1, 2, 3):
+            rnd.shuffle(prop_files)
+            write_props(os.path.join(tmp, 'merged.props'), merge_files(prop_files, jobs))
+            with open(os.path.join(tmp, 'merged.props'), 'rb') as f:
+                assert f.read() == expected_bytes
+
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--self-test']:
+        _self_test()
+        sys.exit(0)
     parser = argparse.ArgumentParser()
     parser.add_argument('--dump-file', type=str)
+    parser.add_argument('--jobs', type=int, default=1, help='Merge shards of the dumps on this many processes')
+    parser.add_argument('--profile', type=str, help='Write a JSON report of per-stage times and counters to this file')
+    parser.add_argument('--cprofile', type=str, help='Write cProfile stats of the run to this file')
     parser.add_argument('property_dump', type=str, nargs='+')
     args = parser.parse_args()
     print("Merger called with arguments: {}".format(args))
 
-    prop_list = []  # type: List[MinerResult]
-    for prop_file in args.property_dump:
-        with open(prop_file, 'rb') as f:
-            prop_list.append(pickle.load(f))
-
-    aggregate_props = merge_props(prop_list)
+    with profiled(args.profile, args.cprofile):
+        aggregate_props = merge_files(args.property_dump, args.jobs)
+    print("Merged {} properties".format(len(aggregate_props)))
 
     if args.dump_file is not None:
-        with open(args.dump_file, 'wb') as f:
-            pickle.dump(aggregate_props, f)
+        write_props(args.dump_file, aggregate_props)
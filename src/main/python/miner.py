@@ -1,27 +1,84 @@
-from vcd import read_vcd_clean
-from analysis import mine_modules_recurse
+from vcd import SignalFilter, DEFAULT_EXCLUDE
+from cache import TraceCache, ResultCache, read_vcd_cached, mine_modules_cached
+from analysis import mine_modules_recurse, mine_cross_modules, mine_top_k
+from parallel import mine_modules_parallel, mine_modules_sharded
+from propstore import write_props
+from profiling import profiled
+from functools import partial
 import argparse
-import pickle
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--start-time', type=int, default=0)
     parser.add_argument('--signal-bit-limit', type=int, default=5)
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of the sampled trace cache (default: $SPEC_MINING_CACHE or ~/.cache/spec-mining)')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the VCD instead of using the trace cache')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='Mine every module instead of reusing the properties cached for unchanged modules')
+    parser.add_argument('--scope', type=str, help='Only mine the signals inside this module, e.g. TOP.Tile.core')
+    parser.add_argument('--include', type=str, action='append',
+                        help='Only mine signals whose full name matches this regex (repeatable)')
+    parser.add_argument('--exclude', type=str, action='append',
+                        help='Also skip signals whose full name matches this regex (repeatable)')
+    parser.add_argument('--no-default-exclude', action='store_true',
+                        help='Keep the Chisel temporary signals ({}) that are skipped by default'.format(
+                            ', '.join(DEFAULT_EXCLUDE)))
     parser.add_argument('--dump-file', type=str)
+    parser.add_argument('--jobs', type=int, default=1, help='Mine chunks of signal pairs on this many processes')
+    parser.add_argument('--time-shards', type=int, default=1,
+                        help='Split the trace into this many time windows, mined concurrently on the --jobs processes')
+    parser.add_argument('--cross-module', action='store_true',
+                        help='Also mine the signals of every module against the ports of its child instances')
+    parser.add_argument('--top-k', type=int,
+                        help='Only mine the unfalsified properties with the k highest supports, pruning pairs whose '
+                             'support cannot reach them (serial and uncached; not with --cross-module, nor with '
+                             '--dump-file, since merging and checking need the falsified properties too)')
+    parser.add_argument('--min-support', type=int,
+                        help='Only mine the unfalsified properties with at least this support, pruning pairs whose '
+                             'support cannot reach it (same restrictions as --top-k)')
+    parser.add_argument('--profile', type=str, help='Write a JSON report of per-stage times and counters to this file')
+    parser.add_argument('--cprofile', type=str, help='Write cProfile stats of the run to this file')
     parser.add_argument('vcd_file', type=str, nargs=1)
     args = parser.parse_args()
     print("Miner called with arguments: {}".format(args))
+    if args.top_k is not None or args.min_support is not None:
+        # The pruned result lacks the falsified properties, and pruning works across all the pairs of one process
+        # (which do not include the cross-module pairs)
+        for (flag, value) in [('--dump-file', args.dump_file is not None), ('--jobs', args.jobs > 1),
+                              ('--time-shards', args.time_shards > 1), ('--cross-module', args.cross_module)]:
+            if value:
+                parser.error("{} cannot be combined with --top-k or --min-support".format(flag))
 
-    module_tree, vcd_data = read_vcd_clean(args.vcd_file[0], args.start_time, args.signal_bit_limit)
-    props = mine_modules_recurse(module_tree, vcd_data)
+    exclude = ([] if args.no_default_exclude else DEFAULT_EXCLUDE) + (args.exclude or [])
+    signal_filter = SignalFilter(args.include, exclude, args.scope)
+    cache = None if args.no_cache else TraceCache(args.cache_dir)
+    result_cache = None if args.no_cache or args.no_result_cache else ResultCache(args.cache_dir)
+    with profiled(args.profile, args.cprofile):
+        module_tree, vcd_data = read_vcd_cached(args.vcd_file[0], args.start_time, args.signal_bit_limit, cache,
+                                                 signal_filter)
+        if args.top_k is not None or args.min_support is not None:
+            props = mine_top_k(module_tree, vcd_data, args.top_k, args.min_support or 1)
+        else:
+            if args.time_shards > 1:
+                mine = partial(mine_modules_sharded, jobs=args.jobs, time_shards=args.time_shards)
+            elif args.jobs > 1:
+                mine = partial(mine_modules_parallel, jobs=args.jobs)
+            else:
+                mine = mine_modules_recurse
+            if result_cache is not None:
+                props = mine_modules_cached(module_tree, vcd_data, result_cache, mine)
+            else:
+                props = mine(module_tree, vcd_data)
+        if args.cross_module:
+            props.update(mine_cross_modules(module_tree, vcd_data))
     print("Top 10 properties:")
     sorted_props = sorted(props.items(), key=lambda x: x[1].support, reverse=True)[:30]
     for (prop, stats) in sorted_props:
         print("{}, support: {}".format(prop, stats.support))
 
     if args.dump_file is not None:
-        with open(args.dump_file, "wb") as f:
-            pickle.dump(props, f)
+        write_props(args.dump_file, props)
 
 
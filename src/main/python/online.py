@@ -0,0 +1,227 @@
+from vcd import Module, ModuleIndex, VCDData, AliasedSignals, ClockDomain, SignalFilter, DEFAULT_EXCLUDE, \
+    stream_vcd_clean
+from analysis import Property, PropertyStats, MinerResult, PROPERTY_CLASSES
+from automata import BatchedMiner
+from propstore import write_props
+from typing import Dict, List, Tuple, Type, Iterator, Optional
+import sys
+import argparse
+import numpy as np
+
+# Multipliers of the per-signal rolling trace hash (64-bit, wrapping)
+_HASH_STEP = np.uint64(0x100000001B3)
+_HASH_TIME = np.uint64(0x9E3779B97F4A7C15)
+_HASH_VALUE = np.uint64(0xC2B2AE3D27D4EB4F)
+
+
+class OnlineMiner:
+    """
+    Mines a trace incrementally while it is being produced. Sampled events are fed chunk by chunk (as yielded by
+    vcd.stream_vcd_clean), every (property type, pair) automaton of every module keeps its state in one BatchedMiner,
+    falsified automata are dropped from the live set as they fail, and snapshot() returns the MinerResult that
+    mine_modules_recurse would return for the trace seen so far. Nothing but the automaton state and a few counters
+    per signal is kept, so the trace itself is never stored. domains gives the ClockDomain of every signal, whose
+    posedges must have been added up to the end of every fed chunk (as stream_vcd_clean does).
+    """
+    def __init__(self, module_tree: Module, signals: List[AliasedSignals],
+                 property_classes: List[Type[Property]] = PROPERTY_CLASSES, clk_period: int = 2,
+                 domains: Optional[List[ClockDomain]] = None) -> None:
+        self.signals = signals
+        self.property_classes = property_classes
+        self.clk_period = clk_period
+        # The distinct domains, and the position of every signal's domain among them
+        self.domains = list({id(d): d for d in domains or []}.values())  # type: List[ClockDomain]
+        domain_ids = {id(d): i for (i, d) in enumerate(self.domains)}
+        self.signal_domains = np.array([domain_ids[id(d)] for d in domains or []], dtype=np.int64)
+        index = ModuleIndex(signals)
+
+        # The signals of every module, in the order mine_modules_recurse visits the modules
+        self.module_signals = []  # type: List[np.ndarray]
+        module_queue = [module_tree]
+        while len(module_queue) > 0:
+            module = module_queue.pop()
+            self.module_signals.append(index.module(module.name))
+            module_queue.extend(module.children)
+
+        # One job per property type for every ordered pair of signals that share a module
+        self.pair_ids = {}  # type: Dict[Tuple[int, int], int]
+        for module_signals in self.module_signals:
+            pairs_a, pairs_b = np.nonzero(~np.eye(len(module_signals), dtype=bool))
+            for pair in zip(module_signals[pairs_a].tolist(), module_signals[pairs_b].tolist()):
+                self.pair_ids.setdefault(pair, len(self.pair_ids))
+        pairs = np.array(list(self.pair_ids.keys()), dtype=np.int64).reshape(-1, 2)
+        num_classes = len(property_classes)
+        self.miner = BatchedMiner([p.table for p in property_classes], np.repeat(pairs[:, 0], num_classes),
+                                  np.repeat(pairs[:, 1], num_classes), np.tile(np.arange(num_classes), len(pairs)),
+                                  len(signals), clk_period)
+
+        self.counts = np.zeros(len(signals), dtype=np.int64)
+        self.hashes = np.zeros(len(signals), dtype=np.uint64)
+        self.last_time = None  # type: Optional[int]
+
+    def feed(self, times: np.ndarray, ids: np.ndarray, values: np.ndarray) -> None:
+        """
+        Advances every live automaton over a chunk of sampled events (times, signal indices, values), which must come
+        after all the events fed so far.
+        """
+        order = np.lexsort((ids, times))
+        times, ids, values = times[order], ids[order], values[order]
+        if values.dtype == object:
+            values = np.array([hash(v) for v in values.tolist()], dtype=np.int64).view(np.uint64)
+        previous_edges = np.zeros(len(times), dtype=np.int64)
+        exact = np.ones(len(times), dtype=bool)
+        for (d, domain) in enumerate(self.domains):
+            in_domain = self.signal_domains[ids] == d
+            previous_edges[in_domain] = domain.previous_edges(times[in_domain])
+            exact[in_domain] = False
+        bounds = np.flatnonzero(np.diff(times)) + 1
+        starts = np.concatenate([[0], bounds]).tolist()
+        ends = np.concatenate([bounds, [len(times)]]).tolist()
+        with np.errstate(over='ignore'):
+            mixed = times.astype(np.uint64) * _HASH_TIME ^ values.astype(np.uint64) * _HASH_VALUE
+            for (i, j) in zip(starts, ends):
+                if i == j:
+                    continue
+                signals = ids[i:j]
+                self.miner.step(int(times[i]), signals, previous_edges[i:j], exact[i:j])
+                self.hashes[signals] = self.hashes[signals] * _HASH_STEP + mixed[i:j]
+        np.add.at(self.counts, ids, 1)
+        if len(times) > 0:
+            self.last_time = int(times[-1])
+
+    @property
+    def num_live(self) -> int:
+        # The number of (property type, pair) automata that have not been falsified yet
+        return int(np.count_nonzero(~self.miner.falsified))
+
+    def snapshot(self) -> MinerResult:
+        """
+        The properties mined from the events fed so far. As in read_vcd_clean, signals with at most one sampled event
+        are left out, and signals with identical traces (compared by a rolling hash) falsify the automata that reject
+        identical traces at time 0.
+        """
+        miner = self.miner
+        support, falsifiable, falsified_time = miner.support.tolist(), miner.falsifiable.tolist(), \
+            miner.falsified_time.tolist()
+        falsified = miner.falsified.tolist()
+        rejects_identical = [p.table.falsified_by_identical_traces for p in self.property_classes]
+        num_classes = len(self.property_classes)
+
+        result = {}  # type: MinerResult
+        for module_signals in self.module_signals:
+            kept = module_signals[self.counts[module_signals] > 1].tolist()
+            for a in kept:
+                for b in kept:
+                    if a == b:
+                        continue
+                    identical = self.counts[a] == self.counts[b] and self.hashes[a] == self.hashes[b]
+                    base = self.pair_ids[(a, b)] * num_classes
+                    for (k, prop_type) in enumerate(self.property_classes):
+                        job = base + k
+                        if identical and rejects_identical[k]:
+                            stats = PropertyStats(support=0, falsifiable=True, falsified=True, falsified_time=0)
+                        elif falsifiable[job]:
+                            stats = PropertyStats(support=support[job], falsifiable=True, falsified=falsified[job],
+                                                  falsified_time=falsified_time[job] if falsified[job] else 0)
+                        else:
+                            continue
+                        result[prop_type(self.signals[a], self.signals[b])] = stats
+        return result
+
+
+def mine_online(vcd_file_path: str, start_time: int, signal_bit_limit: int, snapshot_cycles: Optional[int] = None,
+                chunk_size: int = 4096, clk_period: int = 2, signal_filter: Optional[SignalFilter] = None) \
+        -> Iterator[Tuple[int, OnlineMiner]]:
+    """
+    Mines a VCD (which may be a named pipe or '-' for standard input) as it is read, yielding (time, miner) after the
+    first chunk past every snapshot_cycles clock cycles, and once more at the end of the trace (unless the last chunk
+    was just yielded).
+    """
+    module_tree, kept, domains, chunks = stream_vcd_clean(vcd_file_path, start_time, signal_bit_limit,
+                                                          chunk_size=chunk_size, signal_filter=signal_filter)
+    miner = OnlineMiner(module_tree, list(kept.values()), clk_period=clk_period,
+                        domains=[domains[symbol] for symbol in kept])
+    next_snapshot = None  # type: Optional[int]
+    yielded = None  # type: Optional[int]
+    for (times, ids, values) in chunks:
+        miner.feed(times, ids, values)
+        if snapshot_cycles is not None and miner.last_time is not None:
+            if next_snapshot is None:
+                next_snapshot = miner.last_time + snapshot_cycles * clk_period
+            elif miner.last_time >= next_snapshot:
+                next_snapshot = miner.last_time + snapshot_cycles * clk_period
+                yielded = miner.last_time
+                yield miner.last_time, miner
+    if yielded is None or yielded != miner.last_time:
+        yield (miner.last_time or 0), miner
+
+
+def _self_test() -> None:
+    import os
+    import tempfile
+    from bench import generate_vcd
+    from vcd import read_vcd_clean
+    from analysis import mine_modules_recurse
+
+    with tempfile.TemporaryDirectory() as tmp:
+        vcd_path = os.path.join(tmp, 'test.vcd')
+        generate_vcd(vcd_path, num_signals=12, cycles=300, seed=3)
+        module_tree, vcd_data = read_vcd_clean(vcd_path, 10, 5)
+        keys = list(vcd_data.keys())
+
+        print("TESTING: OnlineMiner")
+        # Every snapshot is what batch mining returns for the traces cut at the time fed so far
+        miner = OnlineMiner(module_tree, keys, domains=[vcd_data[k].domain for k in keys])
+        times = np.concatenate([vcd_data[k].times for k in keys])
+        ids = np.concatenate([np.full(len(vcd_data[k]), i, dtype=np.int64) for (i, k) in enumerate(keys)])
+        values = np.concatenate([vcd_data[k].values for k in keys])
+        fed = np.iinfo(np.int64).min
+        for cut in np.quantile(np.unique(times), [0.1, 0.3, 0.5, 0.8, 1.0]).astype(np.int64).tolist():
+            chunk = (times > fed) & (times <= cut)
+            miner.feed(times[chunk], ids[chunk], values[chunk])
+            fed = cut
+            truncated = {k: vcd_data[k][:int(np.searchsorted(vcd_data[k].times, cut, side='right'))] for k in keys}
+            truncated = {k: t for (k, t) in truncated.items() if len(t) > 1}
+            assert miner.snapshot() == mine_modules_recurse(module_tree, truncated)
+
+        print("TESTING: mine_online")
+        # Small chunks put a snapshot on the last chunk, which must not be yielded twice
+        snapshots = [(time, miner.snapshot()) for (time, miner) in mine_online(vcd_path, 10, 5, 1, chunk_size=64)]
+        assert len(snapshots) > 2
+        assert all(t0 < t1 for ((t0, _), (t1, _)) in zip(snapshots[:-1], snapshots[1:]))
+        assert snapshots[-1][1] == mine_modules_recurse(module_tree, vcd_data)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['--self-test']:
+        _self_test()
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='Mine properties while a VCD is being written')
+    parser.add_argument('--start-time', type=int, default=0)
+    parser.add_argument('--signal-bit-limit', type=int, default=5)
+    parser.add_argument('--snapshot-cycles', type=int, help='Report the mined properties every this many cycles')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='Value changes sampled per batch')
+    parser.add_argument('--scope', type=str, help='Only mine the signals inside this module, e.g. TOP.Tile.core')
+    parser.add_argument('--include', type=str, action='append',
+                        help='Only mine signals whose full name matches this regex (repeatable)')
+    parser.add_argument('--exclude', type=str, action='append',
+                        help='Also skip signals whose full name matches this regex (repeatable)')
+    parser.add_argument('--no-default-exclude', action='store_true',
+                        help='Keep the Chisel temporary signals ({}) that are skipped by default'.format(
+                            ', '.join(DEFAULT_EXCLUDE)))
+    parser.add_argument('--dump-file', type=str, help='Write the final properties here')
+    parser.add_argument('vcd_file', type=str, nargs=1, help="VCD file, named pipe or '-' for standard input")
+    args = parser.parse_args()
+    print("Online miner called with arguments: {}".format(args))
+
+    exclude = ([] if args.no_default_exclude else DEFAULT_EXCLUDE) + (args.exclude or [])
+    signal_filter = SignalFilter(args.include, exclude, args.scope)
+    props = {}  # type: MinerResult
+    for (time, miner) in mine_online(args.vcd_file[0], args.start_time, args.signal_bit_limit, args.snapshot_cycles,
+                                     args.chunk_size, signal_filter=signal_filter):
+        props = miner.snapshot()
+        print("Time {}: {} properties, {} unfalsified, {} live automata".format(
+            time, len(props), sum(not s.falsified for s in props.values()), miner.num_live))
+
+    if args.dump_file is not None:
+        write_props(args.dump_file, props)
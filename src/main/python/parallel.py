@@ -0,0 +1,333 @@
+from vcd import Module, ModuleIndex, VCDData, DeltaTrace, AliasedSignals, ClockDomain, as_delta_trace
+from analysis import Property, MinerResult, PROPERTY_CLASSES, MINED_ROW, mine_pairs, result_from_rows, \
+    trace_classes, print_filter_counts
+from automata import BatchedMiner
+from profiling import PROFILE
+from typing import Dict, List, Tuple, Type, Iterable, Iterator, Optional, Any
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+
+
+class SharedTraces:
+    """
+    The sampled traces of a VCD written once into a memory-mapped file (in /dev/shm when it exists) that worker
+    processes map read-only, instead of each receiving a pickled copy. Times and values are stored as two int64 rows;
+    the values of signals wider than 64 bits (object arrays) and the clock domains of the traces are kept aside and
+    travel with the SharedTraces itself.
+    """
+    def __init__(self, traces: List[DeltaTrace], directory: Optional[str] = None) -> None:
+        self.offsets = np.concatenate([[0], np.cumsum([len(t) for t in traces])]).astype(np.int64)
+        self.wide = {}  # type: Dict[int, np.ndarray]
+        self.domains = [t.domain for t in traces]  # type: List[Optional[ClockDomain]]
+        if directory is None and os.path.isdir('/dev/shm'):
+            directory = '/dev/shm'
+        fd, self.path = tempfile.mkstemp(prefix='spec-mining-', suffix='.traces', dir=directory)
+        os.close(fd)
+        data = np.memmap(self.path, dtype=np.int64, mode='w+', shape=self._shape())
+        for (i, trace) in enumerate(traces):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            data[0, lo:hi] = trace.times
+            if trace.values.dtype == object:
+                self.wide[i] = trace.values
+            else:
+                data[1, lo:hi] = trace.values.view(np.int64)
+        data.flush()
+        del data
+
+    def _shape(self) -> Tuple[int, int]:
+        return 2, max(int(self.offsets[-1]), 1)
+
+    def open(self) -> List[DeltaTrace]:
+        data = np.memmap(self.path, dtype=np.int64, mode='r', shape=self._shape())
+        bounds = zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+        return [DeltaTrace(data[0, lo:hi], self.wide[i] if i in self.wide else data[1, lo:hi].view(np.uint64),
+                           self.domains[i]) for (i, (lo, hi)) in enumerate(bounds)]
+
+    def close(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self) -> 'SharedTraces':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+# The traces mapped by each worker process, set up once by the pool initializer
+_worker_traces = []  # type: List[DeltaTrace]
+
+
+def _init_worker(shared: SharedTraces, profile: bool = False) -> None:
+    global _worker_traces
+    _worker_traces = shared.open()
+    # Workers profile when the parent does, and send back the report of every task (see Profile.merge)
+    PROFILE.enabled = profile
+
+
+def _mine_chunk(task: Tuple[np.ndarray, int, int]) -> Tuple[np.ndarray, Dict[str, int], Optional[Dict[str, Any]]]:
+    # Mines pairs [lo, hi) of the ordered pairs (in serial order) of the given signals
+    signals, lo, hi = task
+    pairs_a, pairs_b = np.nonzero(~np.eye(len(signals), dtype=bool))
+    counters = {}  # type: Dict[str, int]
+    PROFILE.reset()
+    with PROFILE.timer('mine_chunk'):
+        rows = mine_pairs(_worker_traces, signals[pairs_a[lo:hi]], signals[pairs_b[lo:hi]], PROPERTY_CLASSES,
+                          counters=counters)
+    return rows, counters, PROFILE.report() if PROFILE.enabled else None
+
+
+def _module_signals(module: Module, index: ModuleIndex) -> List[Tuple[Module, np.ndarray]]:
+    # The modules in the same order as mine_modules_recurse, with the ids of the signals directly inside them
+    modules = []  # type: List[Tuple[Module, np.ndarray]]
+    module_queue = [module]
+    while len(module_queue) > 0:
+        module = module_queue.pop()
+        modules.append((module, index.module(module.name)))
+        module_queue.extend(module.children)
+    return modules
+
+
+def mine_modules_parallel(module: Module, vcd_data: VCDData, jobs: int,
+                          chunk_pairs: Optional[int] = None) -> MinerResult:
+    """
+    Mines the same modules as mine_modules_recurse and returns the same MinerResult, but splits the ordered pairs of
+    every module into chunks of chunk_pairs pairs which a pool of jobs worker processes mines. Chunks from all the
+    modules are queued together, so small modules are mined concurrently and large ones are spread over every worker.
+    """
+    keys = list(vcd_data.keys())  # type: List[AliasedSignals]
+    modules, scoped = zip(*_module_signals(module, ModuleIndex(keys)))
+
+    num_pairs = [len(s) * (len(s) - 1) for s in scoped]
+    if chunk_pairs is None:
+        chunk_pairs = max(256, -(-sum(num_pairs) // (8 * jobs)))
+    tasks = []  # type: List[Tuple[np.ndarray, int, int]]
+    num_tasks = []  # type: List[int]
+    for (signals, n) in zip(scoped, num_pairs):
+        bounds = list(range(0, n, chunk_pairs)) + [n]
+        tasks.extend((signals, lo, hi) for (lo, hi) in zip(bounds[:-1], bounds[1:]))
+        num_tasks.append(len(bounds) - 1)
+
+    result = {}  # type: MinerResult
+    with SharedTraces([as_delta_trace(vcd_data[k]) for k in keys]) as shared, PROFILE.timer('mine_modules_parallel'):
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(shared, PROFILE.enabled))
+        try:
+            chunks = pool.imap(_mine_chunk, tasks)
+            for (m, signals, n) in zip(modules, scoped, num_tasks):
+                print("Mining module = {} with num signals = {}".format(m.name, len(signals)))
+                PROFILE.count('signals', len(signals), module=m.name)
+                rows, filter_counts = [np.zeros(0, dtype=MINED_ROW)], {}  # type: List[np.ndarray], Dict[str, int]
+                for _ in range(n):
+                    (chunk_rows, chunk_counts, report) = next(chunks)
+                    rows.append(chunk_rows)
+                    for (stage, count) in chunk_counts.items():
+                        filter_counts[stage] = filter_counts.get(stage, 0) + count
+                    if report is not None:
+                        PROFILE.merge(report, module=m.name)
+                module_mine = result_from_rows(keys, np.concatenate(rows), PROPERTY_CLASSES)
+                print_filter_counts(filter_counts)
+                print("Mined {} properties".format(len(module_mine.keys())))
+                for (k, v) in module_mine.items():
+                    result[k] = v
+        finally:
+            pool.close()
+            pool.join()
+    return result
+
+
+# A time window of one trace: the events of the given signals at times in [lo, hi)
+WindowTask = Tuple[np.ndarray, int, int, int]
+# The transfer function of a window: per (job, start state), the end state (-1 once falsified), the support added,
+# whether the window made the job falsifiable and the time it was falsified at
+Transfer = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def _window_jobs(num_signals: int, property_classes: List[Type[Property]]) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # The (pair, property type) jobs in the order of mine_pairs, each repeated once per state of its table: returns
+    # the a, b, table and start state of every repetition, and the position of each job's first repetition
+    pairs_a, pairs_b = np.nonzero(~np.eye(num_signals, dtype=bool))
+    num_classes = len(property_classes)
+    num_states = np.array([p.table.num_states for p in property_classes], dtype=np.int64)
+    jobs_table = np.tile(np.arange(num_classes), len(pairs_a))
+    repeats = num_states[jobs_table]
+    offsets = np.cumsum(repeats) - repeats
+    start = np.arange(int(repeats.sum())) - np.repeat(offsets, repeats)
+    return np.repeat(np.repeat(pairs_a, num_classes), repeats), np.repeat(np.repeat(pairs_b, num_classes), repeats), \
+        np.repeat(jobs_table, repeats), start, offsets
+
+
+def _mine_window(task: WindowTask) -> Tuple[Transfer, Optional[Dict[str, Any]]]:
+    # Runs every job from each of its states over one window, resuming the B_NEXT context from the events before it
+    signals, lo, hi, clk_period = task
+    PROFILE.reset()
+    with PROFILE.timer('mine_window'):
+        transfer = _run_window(signals, lo, hi, clk_period)
+    return transfer, PROFILE.report() if PROFILE.enabled else None
+
+
+def _run_window(signals: np.ndarray, lo: int, hi: int, clk_period: int) -> Transfer:
+    jobs_a, jobs_b, jobs_table, start, _ = _window_jobs(len(signals), PROPERTY_CLASSES)
+    times, previous_edges, last_event_time = [], [], []  # type: List[np.ndarray], List[Optional[np.ndarray]], List[int]
+    for i in signals.tolist():
+        t = _worker_traces[i].times
+        i_lo, i_hi = np.searchsorted(t, [lo, hi]).tolist()
+        window = _worker_traces[i][i_lo:i_hi]
+        times.append(np.asarray(window.times))
+        previous_edges.append(window.previous_edges())
+        last_event_time.append(int(t[i_lo - 1]) if i_lo > 0 else np.iinfo(np.int64).min // 2)
+    miner = BatchedMiner([p.table for p in PROPERTY_CLASSES], jobs_a, jobs_b, jobs_table, len(signals), clk_period,
+                         start, np.array(last_event_time, dtype=np.int64))
+    miner.run(times, previous_edges)
+    PROFILE.count('window_jobs', len(jobs_a))
+    PROFILE.count('window_events', sum(len(t) for t in times))
+    return np.where(miner.falsified, -1, miner.state), miner.support, miner.falsifiable, miner.falsified_time
+
+
+def compose_windows(transfers: Iterable[Transfer], offsets: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Chains the transfer functions of consecutive windows, starting every job in state 0: the state a job ends a
+    window in selects its start state in the next one, and supports are summed along the way. Returns the final
+    state (-1 if falsified), support, falsifiable and falsified time of every job.
+    """
+    state = np.zeros(len(offsets), dtype=np.int64)
+    support = np.zeros(len(offsets), dtype=np.int64)
+    falsifiable = np.zeros(len(offsets), dtype=bool)
+    falsified_time = np.zeros(len(offsets), dtype=np.int64)
+    for (end, window_support, window_falsifiable, window_time) in transfers:
+        jobs = np.flatnonzero(state >= 0)
+        k = offsets[jobs] + state[jobs]
+        support[jobs] += window_support[k]
+        falsifiable[jobs] |= window_falsifiable[k]
+        state[jobs] = end[k]
+        failed = end[k] < 0
+        falsified_time[jobs[failed]] = window_time[k][failed]
+    return state, support, falsifiable, falsified_time
+
+
+def mine_modules_sharded(module: Module, vcd_data: VCDData, jobs: int, time_shards: int,
+                         clk_period: int = 2) -> MinerResult:
+    """
+    Mines the same modules as mine_modules_recurse and returns the same MinerResult, but splits the trace of every
+    module into time_shards windows with about as many timesteps each, which a pool of jobs worker processes mines
+    concurrently. As a window does not know the automaton states it is entered in, every automaton is run over it
+    from each of its states; the resulting transfer functions are then chained in time order (compose_windows).
+    This pays off on long traces, where mining is bound by the number of timesteps rather than of pairs.
+    """
+    keys = list(vcd_data.keys())  # type: List[AliasedSignals]
+    traces = [as_delta_trace(vcd_data[k]) for k in keys]
+    modules = _module_signals(module, ModuleIndex(keys))
+
+    tasks = []  # type: List[WindowTask]
+    num_tasks = []  # type: List[int]
+    for (_, signals) in modules:
+        if len(signals) < 2:
+            num_tasks.append(0)
+            continue
+        grid = np.unique(np.concatenate([traces[i].times for i in signals.tolist()]))
+        n = max(1, min(time_shards, len(grid)))
+        bounds = [np.iinfo(np.int64).min] + grid[(np.arange(1, n) * len(grid)) // n].tolist() \
+            + [np.iinfo(np.int64).max]
+        tasks.extend((signals, lo, hi, clk_period) for (lo, hi) in zip(bounds[:-1], bounds[1:]))
+        num_tasks.append(n)
+
+    rejects_identical = np.array([p.table.falsified_by_identical_traces for p in PROPERTY_CLASSES], dtype=bool)
+    trace_group = trace_classes(traces)
+    result = {}  # type: MinerResult
+    with SharedTraces(traces) as shared, PROFILE.timer('mine_modules_sharded'):
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(shared, PROFILE.enabled))
+        try:
+            windows = pool.imap(_mine_window, tasks)
+
+            def module_transfers(name: str, n: int) -> Iterator[Transfer]:
+                for _ in range(n):
+                    (transfer, report) = next(windows)
+                    if report is not None:
+                        PROFILE.merge(report, module=name)
+                    yield transfer
+
+            for ((m, signals), n) in zip(modules, num_tasks):
+                print("Mining module = {} with num signals = {} in {} time windows".format(m.name, len(signals), n))
+                PROFILE.count('signals', len(signals), module=m.name)
+                jobs_a, jobs_b, jobs_table, _, offsets = _window_jobs(len(signals), PROPERTY_CLASSES)
+                jobs_a, jobs_b = signals[jobs_a[offsets]], signals[jobs_b[offsets]]
+                jobs_table = jobs_table[offsets]
+                state, support, falsifiable, falsified_time = compose_windows(module_transfers(m.name, n), offsets)
+
+                # As in mine_pairs, identical traces falsify the automata that reject them at time 0
+                identical = (trace_group[jobs_a] == trace_group[jobs_b]) & rejects_identical[jobs_table]
+                state[identical], support[identical], falsifiable[identical] = -1, 0, True
+                falsified_time[identical] = 0
+
+                mined = np.flatnonzero(falsifiable)
+                rows = np.zeros(len(mined), dtype=MINED_ROW)
+                rows['a'], rows['b'], rows['prop'] = jobs_a[mined], jobs_b[mined], jobs_table[mined]
+                rows['support'], rows['falsified'] = support[mined], state[mined] < 0
+                rows['falsified_time'] = np.where(rows['falsified'], falsified_time[mined], 0)
+                if PROFILE.enabled:
+                    PROFILE.count('pairs', len(signals) * (len(signals) - 1), module=m.name)
+                    for (k, prop_type) in enumerate(PROPERTY_CLASSES):
+                        jobs_k = jobs_table == k
+                        PROFILE.count('jobs', int(jobs_k.sum()), property_type=prop_type.__name__)
+                        PROFILE.count('mined', int((jobs_k & falsifiable).sum()), property_type=prop_type.__name__)
+                        PROFILE.count('falsified', int((jobs_k & (state < 0)).sum()), property_type=prop_type.__name__)
+                module_mine = result_from_rows(keys, rows, PROPERTY_CLASSES)
+                print("Mined {} properties".format(len(module_mine.keys())))
+                for (k, v) in module_mine.items():
+                    result[k] = v
+        finally:
+            pool.close()
+            pool.join()
+    return result
+
+
+if __name__ == "__main__":
+    from vcd import Signal, Event
+    from analysis import mine_modules_recurse
+
+    print("TESTING: SharedTraces")
+    traces = [DeltaTrace.from_events([Event(1, 3), Event(5, 0)]), DeltaTrace.from_events([]),
+              DeltaTrace.from_events([Event(3, 1 << 70)])]
+    with SharedTraces(traces) as shared:
+        assert shared.open() == traces
+    assert not os.path.exists(shared.path)
+
+    print("TESTING: mine_modules_parallel")
+    rng = np.random.RandomState(0)
+    top, child = Module("TOP"), Module("TOP.child")
+    top.children.append(child)
+    vcd_data = {}  # type: VCDData
+    for name in ["TOP.s{}".format(i) for i in range(6)] + ["TOP.child.s{}".format(i) for i in range(5)]:
+        times = np.flatnonzero(rng.rand(200) < 0.3) * 2 + 1
+        vcd_data[frozenset([Signal(name, 1)])] = DeltaTrace(times, np.arange(len(times)) % 2)
+    serial = mine_modules_recurse(top, vcd_data)
+    parallel = mine_modules_parallel(top, vcd_data, 2, chunk_pairs=7)
+    assert list(parallel.items()) == list(serial.items())
+
+    print("TESTING: mine_modules_sharded")
+    for time_shards in (1, 3, 50):
+        sharded = mine_modules_sharded(top, vcd_data, 2, time_shards)
+        assert list(sharded.items()) == list(serial.items())
+
+    print("TESTING: profiling worker processes")
+    PROFILE.enabled = True
+    mine_modules_recurse(top, vcd_data)
+    expected = PROFILE.report()
+    PROFILE.reset()
+    mine_modules_parallel(top, vcd_data, 2, chunk_pairs=7)
+    report = PROFILE.report()
+    assert report['counters'] == expected['counters'] and report['property_types'] == expected['property_types']
+    for name in ("TOP", "TOP.child"):
+        assert {k: v for (k, v) in report['modules'][name].items() if k != 'seconds'} == \
+            {k: v for (k, v) in expected['modules'][name].items() if k != 'seconds'}
+    assert report['stages']['mine_chunk']['calls'] > 2 and 'mine_modules_parallel' in report['stages']
+    PROFILE.reset()
+    mine_modules_sharded(top, vcd_data, 2, 3)
+    report = PROFILE.report()
+    assert report['modules']['TOP']['pairs'] == 30 and report['stages']['mine_window']['calls'] == 6
+    assert {p: {k: c[k] for k in ('jobs', 'mined', 'falsified')} for (p, c) in expected['property_types'].items()} \
+        == report['property_types']
+    PROFILE.enabled = False
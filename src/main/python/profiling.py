@@ -0,0 +1,157 @@
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Any, TypeVar
+
+T = TypeVar('T')
+
+
+class Profile:
+    """
+    Opt-in instrumentation of the mining flow: wall time per stage and counters (lines parsed, events kept and
+    dropped, pairs evaluated, automaton steps before falsification, ...). Counters are totalled, and also broken
+    down per module (while a module's timer is running) and per property type. Everything is a no-op until enabled.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.stages = {}  # type: Dict[str, Dict[str, float]]
+        self.counters = {}  # type: Dict[str, int]
+        self.modules = {}  # type: Dict[str, Dict[str, float]]
+        self.property_types = {}  # type: Dict[str, Dict[str, int]]
+        self.module = None  # type: Optional[str]
+
+    @contextmanager
+    def timer(self, stage: str, module: Optional[str] = None) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        outer_module = self.module
+        if module is not None:
+            self.module = module
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.module = outer_module
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+            if module is not None:
+                module_entry = self.modules.setdefault(module, {})
+                module_entry['seconds'] = module_entry.get('seconds', 0.0) + seconds
+
+    def count(self, name: str, n: int = 1, property_type: Optional[str] = None, module: Optional[str] = None) -> None:
+        # Counters go to the module whose timer is running, unless another module is given
+        if not self.enabled:
+            return
+        if property_type is not None:
+            counters = self.property_types.setdefault(property_type, {})
+            counters[name] = counters.get(name, 0) + n
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        module = self.module if module is None else module
+        if module is not None:
+            module_entry = self.modules.setdefault(module, {})
+            module_entry[name] = module_entry.get(name, 0) + n
+
+    def merge(self, report: Dict[str, Any], module: Optional[str] = None) -> None:
+        """
+        Adds the report of another Profile, e.g. of a worker process that mined part of a module: stage times and
+        calls, counters (also attributed to module, if given), per-module and per-property type counters add up.
+        """
+        if not self.enabled:
+            return
+        for (stage, entry) in report['stages'].items():
+            own = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            own['seconds'] += entry['seconds']
+            own['calls'] += entry['calls']
+        for (name, n) in report['counters'].items():
+            self.count(name, n, module=module)
+        for (other_module, counters) in report['modules'].items():
+            module_entry = self.modules.setdefault(other_module, {})
+            for (name, n) in counters.items():
+                module_entry[name] = module_entry.get(name, 0) + n
+        for (property_type, counters) in report['property_types'].items():
+            for (name, n) in counters.items():
+                self.count(name, n, property_type=property_type)
+
+    def counted(self, items: Iterable[T], name: str) -> Iterator[T]:
+        # Passes items through, counting them under name once the iteration ends
+        n = 0
+        try:
+            for item in items:
+                n += 1
+                yield item
+        finally:
+            self.count(name, n)
+
+    def report(self) -> Dict[str, Any]:
+        return {'stages': self.stages, 'counters': self.counters, 'modules': self.modules,
+                'property_types': self.property_types}
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+# The instrumentation shared by all the modules of the flow
+PROFILE = Profile()
+
+
+@contextmanager
+def profiled(report_path: Optional[str] = None, cprofile_path: Optional[str] = None) -> Iterator[None]:
+    """
+    Runs the body with PROFILE enabled (writing its JSON report to report_path) and/or under cProfile (writing the
+    stats, for pstats or snakeviz, to cprofile_path). Does nothing if neither path is given.
+    """
+    if report_path is not None:
+        PROFILE.enabled = True
+    profiler = cProfile.Profile() if cprofile_path is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        if report_path is not None:
+            PROFILE.write(report_path)
+            PROFILE.enabled = False
+
+
+if __name__ == "__main__":
+    print("TESTING: Profile")
+    profile = Profile()
+    with profile.timer('off'):
+        profile.count('ignored')
+    assert profile.report() == {'stages': {}, 'counters': {}, 'modules': {}, 'property_types': {}}
+
+    profile.enabled = True
+    with profile.timer('mine_module', module='TOP'):
+        profile.count('pairs', 6)
+        assert list(profile.counted(range(3), 'events')) == [0, 1, 2]
+        profile.count('falsified', 2, property_type='Next')
+    profile.count('pairs', 1)
+    assert profile.counters == {'pairs': 7, 'events': 3}
+    assert profile.modules['TOP']['pairs'] == 6 and profile.modules['TOP']['events'] == 3
+    assert profile.property_types == {'Next': {'falsified': 2}}
+    assert profile.stages['mine_module']['calls'] == 1
+
+    # A worker's report adds up, with its counters attributed to the module it mined
+    worker = Profile()
+    worker.enabled = True
+    with worker.timer('mine_chunk'):
+        worker.count('pairs', 4)
+        worker.count('falsified', 1, property_type='Next')
+    profile.merge(worker.report(), module='TOP.child')
+    profile.merge(worker.report(), module='TOP.child')
+    assert profile.counters == {'pairs': 15, 'events': 3}
+    assert profile.modules['TOP.child'] == {'pairs': 8}
+    assert profile.property_types == {'Next': {'falsified': 4}}
+    assert profile.stages['mine_chunk']['calls'] == 2
@@ -0,0 +1,187 @@
+from vcd import Signal, AliasedSignals, SIGNAL_TABLE
+from analysis import Property, PropertyStats, MinerResult, PROPERTY_CLASSES
+from typing import Dict, List, Tuple, Optional, Type
+import json
+import struct
+import pickle
+import numpy as np
+
+# One row per property: type id, a and b as signal ids, support, flags (FALSIFIABLE | FALSIFIED) and falsified_time
+PROPERTY_ROW = np.dtype([('type', np.uint8), ('a', np.uint32), ('b', np.uint32), ('flags', np.uint8),
+                         ('support', np.int64), ('falsified_time', np.int64)])
+FALSIFIABLE = 1
+FALSIFIED = 2
+_MAGIC = b'SPECPRP1'
+_PROPERTY_TYPES = {p.__name__: p for p in PROPERTY_CLASSES}  # type: Dict[str, Type[Property]]
+
+
+def signal_modules(aliases: AliasedSignals) -> List[str]:
+    # The modules a signal lives directly inside, one per alias (as in analysis.scope_module)
+    return sorted(set(s.name[0:s.name.rfind('.')] for s in aliases))
+
+
+def _csr(keys: List[List[int]], num_keys: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Row ids grouped by key: rows of key k are index[ptr[k]:ptr[k + 1]]
+    counts = np.zeros(num_keys + 1, dtype=np.int64)
+    rows = [(k, row) for (row, row_keys) in enumerate(keys) for k in row_keys]
+    rows.sort()
+    index = np.array([row for (_, row) in rows], dtype=np.uint32)
+    np.add.at(counts, np.array([k for (k, _) in rows], dtype=np.int64) + 1, 1)
+    return np.cumsum(counts), index
+
+
+def write_props(path: str, props: MinerResult) -> None:
+    """
+    Writes props as a property store: a JSON header with the property type names, the table of aliased signals
+    (each name stored once) and the module names, followed by the property table (PROPERTY_ROW) and two CSR indexes
+    from signal id and from module id to property rows, all as raw little-endian arrays.
+    """
+    signal_ids = {}  # type: Dict[AliasedSignals, int]
+    type_ids = {}  # type: Dict[str, int]
+    rows = np.zeros(len(props), dtype=PROPERTY_ROW)
+    for (i, (prop, stats)) in enumerate(props.items()):
+        rows[i] = (type_ids.setdefault(type(prop).__name__, len(type_ids)),
+                   signal_ids.setdefault(prop.a, len(signal_ids)), signal_ids.setdefault(prop.b, len(signal_ids)),
+                   (FALSIFIABLE if stats.falsifiable else 0) | (FALSIFIED if stats.falsified else 0),
+                   stats.support, stats.falsified_time)
+    signals = list(signal_ids.keys())
+
+    module_ids = {}  # type: Dict[str, int]
+    modules_of = [[module_ids.setdefault(m, len(module_ids)) for m in signal_modules(s)] for s in signals]
+    # A property belongs to the modules that both of its signals are directly inside
+    signal_ptr, signal_index = _csr([sorted({a, b}) for (a, b) in zip(rows['a'].tolist(), rows['b'].tolist())],
+                                    len(signals))
+    module_ptr, module_index = _csr([sorted(set(modules_of[a]) & set(modules_of[b]))
+                                     for (a, b) in zip(rows['a'].tolist(), rows['b'].tolist())], len(module_ids))
+
+    arrays = [('properties', rows), ('signal_ptr', signal_ptr), ('signal_index', signal_index),
+              ('module_ptr', module_ptr), ('module_index', module_index)]
+    sections = {}  # type: Dict[str, List[int]]
+    offset = 0
+    for (name, array) in arrays:
+        sections[name] = [offset, len(array)]
+        offset += array.nbytes
+    header = json.dumps({
+        'property_types': list(type_ids.keys()),
+        'signals': [sorted([s.name, s.width] for s in aliases) for aliases in signals],
+        'modules': list(module_ids.keys()),
+        'sections': sections,
+    }).encode()
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (-(len(_MAGIC) + 8 + len(header)) % 8))
+        for (_, array) in arrays:
+            f.write(array.astype(array.dtype.newbyteorder('<')).tobytes())
+
+
+class PropertyStore:
+    """
+    A property store written by write_props, with the property table and indexes memory-mapped so that the properties
+    of a single module or signal can be loaded without materializing the rest.
+    """
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("{} is not a property store".format(path))
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len).decode())
+        data_offset = len(_MAGIC) + 8 + header_len
+        data_offset += -data_offset % 8
+
+        self.property_types = [_PROPERTY_TYPES[name] for name in header['property_types']]
+        self.signals = [SIGNAL_TABLE.intern(frozenset(Signal(name, width) for (name, width) in aliases))
+                        for aliases in header['signals']]  # type: List[AliasedSignals]
+        self.modules = header['modules']  # type: List[str]
+        self.signal_names = {s.name: i for (i, aliases) in enumerate(self.signals) for s in aliases}
+        self.module_ids = {m: i for (i, m) in enumerate(self.modules)}
+
+        def section(name: str, dtype: np.dtype) -> np.ndarray:
+            offset, length = header['sections'][name]
+            if length == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=data_offset + offset, shape=(length,))
+        self.rows = section('properties', PROPERTY_ROW)
+        self.signal_ptr, self.signal_index = section('signal_ptr', np.int64), section('signal_index', np.uint32)
+        self.module_ptr, self.module_index = section('module_ptr', np.int64), section('module_index', np.uint32)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def load(self, rows: Optional[np.ndarray] = None) -> MinerResult:
+        # The properties in the given rows (all of them by default), in the order they were written
+        selected = self.rows if rows is None else self.rows[np.sort(rows)]
+        result = {}  # type: MinerResult
+        for (t, a, b, flags, support, falsified_time) in selected.tolist():
+            result[self.property_types[t](self.signals[a], self.signals[b])] = PropertyStats(
+                support=support, falsifiable=(flags & FALSIFIABLE) != 0, falsified=(flags & FALSIFIED) != 0,
+                falsified_time=falsified_time)
+        return result
+
+    def module(self, name: str) -> MinerResult:
+        # The properties between signals directly inside module name
+        m = self.module_ids.get(name)
+        if m is None:
+            return {}
+        return self.load(self.module_index[self.module_ptr[m]:self.module_ptr[m + 1]])
+
+    def signal(self, name: str) -> MinerResult:
+        # The properties that involve the signal with the given name (or one of its aliases)
+        s = self.signal_names.get(name)
+        if s is None:
+            return {}
+        return self.load(self.signal_index[self.signal_ptr[s]:self.signal_ptr[s + 1]])
+
+
+def read_props(path: str, module: Optional[str] = None, signal: Optional[str] = None) -> MinerResult:
+    """
+    Reads a property store, or a legacy pickled MinerResult, optionally keeping only the properties of one module
+    and/or one signal.
+    """
+    with open(path, 'rb') as f:
+        is_store = f.read(len(_MAGIC)) == _MAGIC
+    if is_store:
+        store = PropertyStore(path)
+        if module is None and signal is None:
+            return store.load()
+        props = store.module(module) if module is not None else store.signal(signal)
+    else:
+        with open(path, 'rb') as f:
+            props = pickle.load(f)  # type: MinerResult
+        if module is not None:
+            props = {p: s for (p, s) in props.items()
+                     if module in signal_modules(p.a) and module in signal_modules(p.b)}
+    if signal is not None:
+        props = {p: s for (p, s) in props.items() if any(x.name == signal for x in p.a | p.b)}
+    return props
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from analysis import Alternating, Next, Eventual, Until
+
+    print("TESTING: property store")
+    a, b = frozenset([Signal("TOP.a", 1)]), frozenset([Signal("TOP.b", 1), Signal("TOP.child.b", 1)])
+    c = frozenset([Signal("TOP.child.c", 4)])
+    props = {
+        Next(a, b): PropertyStats(support=10, falsifiable=True, falsified=False, falsified_time=0),
+        Until(b, a): PropertyStats(support=2, falsifiable=True, falsified=True, falsified_time=42),
+        Eventual(b, c): PropertyStats(support=1 << 40, falsifiable=True, falsified=False, falsified_time=0),
+        Alternating(c, a): PropertyStats(support=0, falsifiable=False, falsified=False, falsified_time=0),
+    }  # type: MinerResult
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'test.props')
+        write_props(path, props)
+        assert list(read_props(path).items()) == list(props.items())
+        assert list(read_props(path, module="TOP").keys()) == [Next(a, b), Until(b, a)]
+        assert list(read_props(path, module="TOP.child").keys()) == [Eventual(b, c)]
+        assert list(read_props(path, signal="TOP.child.c").keys()) == [Eventual(b, c), Alternating(c, a)]
+        assert read_props(path, module="TOP.other") == {}
+
+        legacy_path = os.path.join(tmp, 'legacy.props')
+        with open(legacy_path, 'wb') as f:
+            pickle.dump(props, f)
+        assert read_props(legacy_path) == props
+        assert list(read_props(legacy_path, signal="TOP.child.c").keys()) == [Eventual(b, c), Alternating(c, a)]
@@ -1,50 +1,143 @@
 # Analyze riscv-mini via spec mining and combining
 import sys
 import os
-from vcd import read_vcd_clean
+import glob
+import threading
+import multiprocessing
+from cache import TraceCache, ResultCache, read_vcd_cached, mine_modules_cached
 from miner import mine_modules_recurse
-from merger import merge_props
-from joblib import Parallel, delayed
-from checker import check
+from merger import merge_into, canonical_order
+from checker import check_regression
+from propstore import write_props
+from analysis import MinerResult
+from typing import Optional, List, Tuple, Iterator
+import heapq
 import argparse
-import pickle
+
+# The riscv-tests ISA suites mined by default: user-level and machine-level tests on physical memory
+DEFAULT_TESTS = ['rv32ui-p-', 'rv32mi-p-']
+
+
+def find_tests(vcd_root: str, tests: List[str], globs: List[str]) -> List[str]:
+    # The VCDs in vcd_root whose name contains one of tests, and the files matching one of the glob patterns
+    # (relative to vcd_root), in sorted order
+    found = {os.path.join(vcd_root, f) for f in os.listdir(vcd_root) if 'vcd' in f and any(t in f for t in tests)}
+    for pattern in globs:
+        found.update(glob.glob(os.path.join(vcd_root, pattern)))
+    return sorted(found)
+
+
+# A trace to mine: its path, start time, signal bit limit and the trace and result caches
+MineTask = Tuple[str, int, int, Optional[TraceCache], Optional[ResultCache]]
+
+
+def mine_vcd(task: MineTask) -> Tuple[str, MinerResult]:
+    # Parse and mine one trace in a worker, so only its properties come back to the parent
+    vcd_file, start_time, bit_limit, cache, result_cache = task
+    module, data = read_vcd_cached(vcd_file, start_time, bit_limit, cache)
+    if result_cache is not None:
+        return vcd_file, mine_modules_cached(module, data, result_cache)
+    return vcd_file, mine_modules_recurse(module, data)
+
+
+def mine_regression(vcd_files: List[str], start_time: int, bit_limit: int, cache: Optional[TraceCache],
+                    jobs: int, window: int, result_cache: Optional[ResultCache] = None) \
+        -> Iterator[Tuple[str, MinerResult]]:
+    """
+    Parses and mines every trace on a pool of jobs worker processes, yielding (vcd_file, properties) in the order of
+    vcd_files, so they can be folded into a running merge that does not depend on which worker finishes first. Every
+    worker mines a trace right after parsing it, so the parsing of a trace overlaps with the mining of the ones before
+    it. At most window traces are in flight (being parsed or mined, or mined but not yet consumed), which bounds
+    memory however many traces there are. With a result_cache, only the modules whose signals changed are mined.
+    """
+    tasks = [(vcd_file, start_time, bit_limit, cache, result_cache) for vcd_file in vcd_files]
+    if jobs <= 1:
+        yield from map(mine_vcd, tasks)
+        return
+
+    slots = threading.Semaphore(window)
+    stopped = threading.Event()
+
+    def throttled() -> Iterator[MineTask]:
+        # Pulled by the pool's task feeder thread, which blocks here while window traces are in flight
+        for task in tasks:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield task
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(mine_vcd, throttled()):
+            yield result
+            slots.release()
+    finally:
+        stopped.set()
+        slots.release()
+        pool.close()
+        pool.join()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--dump-file', type=str)
     parser.add_argument('--vcd-root', type=str)
+    parser.add_argument('--test', type=str, action='append',
+                        help='Mine the VCDs whose name contains this, e.g. rv32ui-p-add (repeatable, default: {}, '
+                             'unless --glob is given)'.format(', '.join(DEFAULT_TESTS)))
+    parser.add_argument('--glob', type=str, action='append',
+                        help='Also mine the files matching this glob pattern under --vcd-root (repeatable)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of the sampled trace cache (default: $SPEC_MINING_CACHE or ~/.cache/spec-mining)')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the VCD instead of using the trace cache')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='Mine and check everything instead of reusing the cached properties and verdicts')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--window', type=int, help='Most traces in flight at once (default: 2 per worker process)')
+    parser.add_argument('--top-k', type=int, default=30,
+                        help='Number of highest-support properties to print (selected after the full merge; unlike '
+                             'miner.py, nothing is pruned while mining)')
+    parser.add_argument('--min-support', type=int, default=1,
+                        help='Drop merged properties with less support (after the full merge; unlike miner.py, '
+                             'nothing is pruned while mining)')
     args = parser.parse_args()
     print("riscv-mini analysis called with arguments: {}".format(args))
 
-    vcd_files = list(filter(lambda f: 'vcd' in f and (('rv32ui-p-' in f) or ('rv32mi-p-' in f)), os.listdir(args.vcd_root)))
+    tests = args.test if args.test is not None else ([] if args.glob is not None else DEFAULT_TESTS)
+    vcd_files = find_tests(args.vcd_root, tests, args.glob or [])
     start_time = 12
     bit_limit = 5
 
-    vcd_data = Parallel(n_jobs=4)(delayed(read_vcd_clean)(args.vcd_root + vcd, start_time, bit_limit) for vcd in vcd_files)
-    props = Parallel(n_jobs=4)(delayed(mine_modules_recurse)(module, data) for (module, data) in vcd_data)
-
-    print("Merging mined properties")
-    merged_props = merge_props(props)
+    cache = None if args.no_cache else TraceCache(args.cache_dir)
+    result_cache = None if args.no_cache or args.no_result_cache else ResultCache(args.cache_dir)
+    window = args.window if args.window is not None else 2 * args.jobs
+    print("Mining and merging {} traces".format(len(vcd_files)))
+    merged_props = {}  # type: MinerResult
+    for (vcd, props) in mine_regression(vcd_files, start_time, bit_limit, cache, args.jobs, window,
+                                         result_cache):
+        merge_into(merged_props, props)
+        print("{}: {} properties, {} merged".format(vcd, len(props), len(merged_props)))
+    merged_props = canonical_order(merged_props)
 
     # After everything's been merged, strip away properties that have been falsified
     stripped_props = {prop: stats for (prop, stats) in merged_props.items()
-                      if stats.falsifiable and not stats.falsified and stats.support > 0}
-    # Sort from highest to lowest support
-    sorted_props = sorted(stripped_props.items(), key=lambda x: x[1].support, reverse=True)[:30]
-    print("Top 30 properties")
+                      if stats.falsifiable and not stats.falsified and stats.support >= args.min_support}
+    # Only the highest supports are sorted, through a heap
+    sorted_props = heapq.nlargest(args.top_k, stripped_props.items(), key=lambda x: x[1].support)
+    print("Top {} properties".format(args.top_k))
     for (prop, stats) in sorted_props:
         print("{}, support: {}".format(prop, stats.support))
 
     print("Checking mined properties against golden traces")
     good = True
-    for (module, data) in vcd_data:
-        for p in stripped_props.keys():
-            if not check(p, data):
-                good = False
-                print("ERROR on property {}".format(p))
+    for (vcd, violations) in check_regression(vcd_files, list(stripped_props.keys()), start_time, bit_limit, cache,
+                                              args.jobs, result_cache):
+        print("{}: {} violations".format(vcd, len(violations)))
+        for (p, falsified_time) in violations:
+            good = False
+            print("ERROR on property {} at time {}".format(p, falsified_time))
     if not good:
         sys.exit(1)
 
     if args.dump_file is not None:
-        with open(args.dump_file, 'wb') as f:
-            pickle.dump(stripped_props, f)
+        write_props(args.dump_file, stripped_props)
@@ -1,18 +1,53 @@
+import io
 import os.path
+import re
+import sys
+import bz2
+import gzip
+import lzma
+import mmap
+import stat
 import logging
-from typing import List, Dict, Tuple, FrozenSet, Set
+import itertools
+from typing import List, Dict, Tuple, FrozenSet, Set, Iterator, Iterable, Optional, Any, BinaryIO, Union, Sequence
 from collections import defaultdict
+from array import array
 from dataclasses import dataclass
+import numpy as np
+from profiling import PROFILE
+
+try:
+    import zstandard  # optional, only needed to read zstd-compressed VCDs
+except ImportError:
+    zstandard = None
+
+
+class FrozenSlots:
+    """
+    Pickling for frozen dataclasses with __slots__, which have no __dict__ and refuse attribute assignment: the state
+    is the tuple of slot values. A dict state (pickled before the class had slots) is accepted too.
+    """
+    __slots__ = ()
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state: Any) -> None:
+        items = state.items() if isinstance(state, dict) else zip(self.__slots__, state)
+        for (f, v) in items:
+            object.__setattr__(self, f, v)
 
 
 @dataclass(frozen=True)
-class Event:
+class Event(FrozenSlots):
+    __slots__ = ('time', 'value')
     time: int
     value: int
 
 
 @dataclass(frozen=True)
-class Signal:
+class Signal(FrozenSlots):
+    __slots__ = ('name', 'width')
     name: str
     width: int
 
@@ -37,185 +72,936 @@ class Module:
         return self.str_helper(1)
 
 
+# The previous edge of an event on the first posedge of its clock domain: any earlier a event precedes it
+NO_EDGE = np.iinfo(np.int64).min // 2 + 1
+
+
+class ClockDomain:
+    """
+    One clock of the design and its posedges after the start time, at which the signals of its domain are sampled.
+    The posedges are appended while the VCD is sampled. A Next property counts cycles of the domain of its b signal:
+    b must change on the first posedge after the latest change of a.
+    """
+    __slots__ = ('clock', '_posedges', '_size')
+
+    def __init__(self, clock: str, posedges: Iterable[int] = ()) -> None:
+        self.clock = clock
+        self._posedges = np.array(posedges, dtype=np.int64)
+        self._size = len(self._posedges)
+
+    @property
+    def posedges(self) -> np.ndarray:
+        return self._posedges[:self._size]
+
+    def extend(self, posedges: np.ndarray) -> None:
+        # Appends later posedges, growing the buffer geometrically so that streaming stays linear
+        if self._size + len(posedges) > len(self._posedges):
+            buffer = np.zeros(max(2 * len(self._posedges), self._size + len(posedges), 1024), dtype=np.int64)
+            buffer[:self._size] = self.posedges
+            self._posedges = buffer
+        self._posedges[self._size:self._size + len(posedges)] = posedges
+        self._size += len(posedges)
+
+    def previous_edges(self, times: np.ndarray) -> np.ndarray:
+        # The last posedge strictly before each time, or NO_EDGE
+        posedges = self.posedges
+        k = np.searchsorted(posedges, times, side='left') - 1
+        return np.where(k >= 0, posedges[np.maximum(k, 0)] if len(posedges) > 0 else NO_EDGE, NO_EDGE)
+
+    def __getstate__(self):
+        return self.clock, self.posedges.copy()
+
+    def __setstate__(self, state) -> None:
+        self.__init__(*state)
+
+    def __repr__(self) -> str:
+        return "ClockDomain({}, {} posedges)".format(self.clock, self._size)
+
+
+class DeltaTrace:
+    """
+    A delta event trace stored column-wise: event times as int64 and values as uint64 (16 bytes per event).
+    Values of signals wider than 64 bits fall back to an object array of Python ints.
+    Indexing and iterating yield Events, so a DeltaTrace can be used wherever a List[Event] was.
+    A trace sampled from a VCD also refers to the ClockDomain it was sampled on (shared by all the traces of the
+    domain), which is not part of its equality.
+    """
+    __slots__ = ('times', 'values', 'domain')
+
+    def __init__(self, times, values, domain: Optional[ClockDomain] = None) -> None:
+        self.times = np.asarray(times, dtype=np.int64)  # type: np.ndarray
+        if isinstance(values, np.ndarray):
+            self.values = values  # type: np.ndarray
+        else:
+            try:
+                self.values = np.asarray(values, dtype=np.uint64)
+            except OverflowError:
+                self.values = np.asarray(values, dtype=object)
+        self.domain = domain
+        assert self.times.shape == self.values.shape
+
+    @staticmethod
+    def from_events(events: Iterable[Event]) -> 'DeltaTrace':
+        events = list(events)
+        return DeltaTrace([e.time for e in events], [e.value for e in events])
+
+    def previous_edges(self) -> Optional[np.ndarray]:
+        # The clock edge before every event (the previous posedge of the trace's domain), or None for a trace without a
+        # domain, whose events only follow an event of another signal if they come exactly one clk_period after it
+        return self.domain.previous_edges(self.times) if self.domain is not None else None
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return DeltaTrace(self.times[idx], self.values[idx], self.domain)
+        return Event(int(self.times[idx]), int(self.values[idx]))
+
+    def __iter__(self) -> Iterator[Event]:
+        return (Event(t, v) for (t, v) in zip(self.times.tolist(), self.values.tolist()))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DeltaTrace):
+            return np.array_equal(self.times, other.times) and np.array_equal(self.values, other.values)
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return "DeltaTrace({})".format(list(self))
+
+
+def as_delta_trace(trace) -> DeltaTrace:
+    return trace if isinstance(trace, DeltaTrace) else DeltaTrace.from_events(trace)
+
+
 AliasedSignals = FrozenSet[Signal]
-DeltaTrace = List[Event]
 VCDData = Dict[AliasedSignals, DeltaTrace]
 
 
+class SignalTable:
+    """
+    Interns aliased signal groups: every distinct group is stored once, as the canonical object equal groups map to.
+    Traces, property stores and properties built from interned groups share the same objects, so comparing two
+    groups (e.g. looking a Property up in a dict) stops at an identity check instead of comparing their Signals.
+    """
+    def __init__(self) -> None:
+        self.groups = {}  # type: Dict[AliasedSignals, AliasedSignals]
+
+    def intern(self, aliases: AliasedSignals) -> AliasedSignals:
+        return self.groups.setdefault(aliases, aliases)
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+
+# The signal groups of every VCD, property store and trace cache entry read by this process
+SIGNAL_TABLE = SignalTable()
+
+
+def module_of(signal_name: str) -> str:
+    # The module a signal is declared directly inside
+    return signal_name[0:signal_name.rfind('.')]
+
+
+class ModuleIndex:
+    """
+    The signals directly inside every module, as integer signal ids (positions in signals, e.g. the keys of a VCDData).
+    A signal is inside every module one of its aliases is declared in. The index is built in one pass over the aliases,
+    so finding the signals of a module is a dict lookup instead of a scan of every signal.
+    """
+    def __init__(self, signals: Iterable[AliasedSignals]) -> None:
+        self.signals = list(signals)  # type: List[AliasedSignals]
+        self.ids = {s: i for (i, s) in enumerate(self.signals)}  # type: Dict[AliasedSignals, int]
+        modules = defaultdict(list)  # type: Dict[str, List[int]]
+        ports = defaultdict(list)  # type: Dict[str, List[int]]
+        for (i, aliases) in enumerate(self.signals):
+            for m in {module_of(s.name) for s in aliases}:
+                modules[m].append(i)
+            for m in {module_of(s.name) for s in aliases if s.name[s.name.rfind('.') + 1:].startswith('io_')}:
+                ports[m].append(i)
+        self.modules = {m: np.array(ids, dtype=np.int64)
+                        for (m, ids) in modules.items()}  # type: Dict[str, np.ndarray]
+        self.ports = {m: np.array(ids, dtype=np.int64) for (m, ids) in ports.items()}  # type: Dict[str, np.ndarray]
+
+    def module(self, name: str) -> np.ndarray:
+        # Ids of the signals directly inside module name, in increasing order
+        return self.modules.get(name, np.zeros(0, dtype=np.int64))
+
+    def module_ports(self, name: str) -> np.ndarray:
+        # Ids of the signals of module name that are Chisel ports (io_*), in increasing order
+        return self.ports.get(name, np.zeros(0, dtype=np.int64))
+
+
 # There is a bug in the original version of read_vcd where if the clock symbol appears before the signal of interest
 # clock_value = 1 will be updated too late, and the signal toggle won't be caught (for signals driven on
 # negative edges from chisel-iotesters drivers (and maybe others). This may be an issue with internal signals too,
-# but it depends on the specifics of how the VCD is dumped from verilator. Solution: sample with a clock after
-# the entire VCD parsing is done.
+# but it depends on the specifics of how the VCD is dumped from verilator. Solution: buffer the value changes of a
+# timestep and only make them visible at the next clock edge (see _sample_sorted).
 
 # There's another bug with signal_filter where a signal may have many aliases where a few have junk names (_T)
 # and one has a real name (wr_en). If we cut out the symbol too early when seeing an aliased name, we may not
-# record a signal which should have been recorded. Solution: strip signals after the VCD data is constructed.
+# record a signal which should have been recorded. Solution: only filter symbols once the entire $var header
+# has been read, at which point every alias of every symbol is known.
+def read_vcd_header(lines: Iterator[str]) -> Tuple[Module, Dict[str, List[Signal]]]:
+    """
+    Consumes lines up to and including $enddefinitions, and returns the module hierarchy and
+    a map from each VCD symbol to all the signals that are aliased to it.
+    """
+    symbols = defaultdict(list)  # type: Dict[str, List[Signal]]
+    path = list()       # type: List[str]
+    module_tree = []    # type: List[Module]
+    for line in lines:
+        tokens = line.split()
+        if not tokens or tokens[0][0] != "$":
+            continue
+        # module instance
+        if tokens[0] == "$scope":
+            assert tokens[1] == "module"
+            assert tokens[3] == "$end"
+            path.append(tokens[2])
+            if len(module_tree) > 0:
+                this_module = Module(module_tree[-1].name + "." + tokens[2])
+                module_tree[-1].children.append(this_module)
+                module_tree.append(this_module)
+            else:  # This is the top-level module
+                this_module = Module(tokens[2])
+                module_tree.append(this_module)
+        # move up to the upper module instance
+        elif tokens[0] == "$upscope":
+            path = path[:-1]
+            if len(module_tree) > 1:  # Don't remove the top-level module from the stack
+                module_tree = module_tree[:-1]
+        # signal definition
+        elif tokens[0] == "$var":
+            width = int(tokens[2])
+            symbol = tokens[3]
+            signal_name = tokens[4]
+            signal = ("%s.%s" % (".".join(path), signal_name))
+            symbols[symbol].append(Signal(sys.intern(signal), width))
+        # no more variable definitions
+        elif tokens[0] == "$enddefinitions":
+            assert tokens[1] == "$end"
+            break
+
+    assert len(module_tree) == 1
+    return module_tree[0], dict(symbols)
+
+
+def iter_value_changes(lines: Iterator[str], symbols: Optional[Set[str]] = None) -> Iterator[Tuple[int, str, int]]:
+    """
+    Yields (time, symbol, value) for every value change after the header, optionally only for the given symbols.
+    Values in the $dumpvars section (or before the first timestamp) are the initial values at time 0.
+    Unknown (x/z) and real values are skipped, so a symbol keeps its last known value.
+    """
+    time = 0
+    for line in lines:
+        head = line[:1]
+        if head == ' ' or head == '\t':
+            line = line.lstrip()
+            head = line[:1]
+        if head == '#':
+            time = int(line[1:])
+        elif head == '0' or head == '1':
+            # The symbol is looked at before anything else is parsed, so unwanted symbols cost very little
+            symbol = line[1:].rstrip()
+            if symbols is None or symbol in symbols:
+                yield time, symbol, int(head)
+        elif head == 'b' or head == 'B':
+            fields = line[1:].split()
+            if len(fields) == 2 and (symbols is None or fields[1] in symbols):
+                try:
+                    yield time, fields[1], int(fields[0], 2)
+                except ValueError:  # x or z bits
+                    pass
+        # Anything else ($dumpvars, $end, ..., x/z scalars, reals) carries no value change
+
+
+_COMPRESSED_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bzip2'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+
+def open_vcd(vcd_file_path: str) -> BinaryIO:
+    """
+    Opens a VCD for binary reading. Regular files compressed with gzip, bzip2, xz or zstd (which needs the zstandard
+    package) are recognized by their magic bytes and decompressed while they are read. '-' is standard input; pipes
+    and standard input are read as they are.
+    """
+    if vcd_file_path == '-':
+        return os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    if not os.path.isfile(vcd_file_path):
+        return open(vcd_file_path, 'rb')
+    with open(vcd_file_path, 'rb') as f:
+        magic = f.read(6)
+    compression = next((name for (prefix, name) in _COMPRESSED_MAGIC if magic.startswith(prefix)), None)
+    if compression == 'gzip':
+        return gzip.open(vcd_file_path, 'rb')
+    elif compression == 'bzip2':
+        return bz2.open(vcd_file_path, 'rb')
+    elif compression == 'xz':
+        return lzma.open(vcd_file_path, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Reading zstd-compressed VCDs ({}) needs the zstandard package".format(vcd_file_path))
+        reader = zstandard.ZstdDecompressor().stream_reader(open(vcd_file_path, 'rb'), closefd=True)
+        return io.BufferedReader(reader, buffer_size=1 << 20)
+    return open(vcd_file_path, 'rb')
+
+
+def _is_plain_file(f: BinaryIO) -> bool:
+    try:
+        return type(f) is io.BufferedReader and stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+
+def _vcd_blocks(f: BinaryIO, block_size: int = 1 << 24) -> Iterator[np.ndarray]:
+    """
+    The rest of a VCD opened with open_vcd, as uint8 arrays of whole lines. A plain file is memory-mapped and the
+    blocks are views of the map, a compressed file is decompressed block by block, and a pipe yields whatever has
+    arrived so far (so a live dump is tokenized as it is written).
+    """
+    if _is_plain_file(f):
+        offset, size = f.tell(), os.fstat(f.fileno()).st_size
+        if offset >= size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        while offset < size:
+            end = mm.rfind(b'\n', offset, min(offset + block_size, size)) + 1
+            if end == 0:
+                end = mm.find(b'\n', offset + block_size) + 1 or size
+            yield np.frombuffer(mm, dtype=np.uint8, count=end - offset, offset=offset)
+            offset = end
+        return
+
+    # Decompressors fill whole blocks, while a pipe is read as far as it has been written
+    live = not isinstance(f, (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile))
+    read = f.read1 if live and hasattr(f, 'read1') else f.read
+    carry = b''
+    while True:
+        data = read(block_size)
+        if not data:
+            break
+        data = carry + data
+        cut = data.rfind(b'\n') + 1
+        carry = data[cut:]
+        if cut > 0:
+            yield np.frombuffer(data, dtype=np.uint8, count=cut)
+    if len(carry) > 0:
+        yield np.frombuffer(carry, dtype=np.uint8)
+
+
+_BLANK = np.zeros(256, dtype=bool)
+_BLANK[[ord(' '), ord('\t'), ord('\r')]] = True
+
+
+def _digits(a: np.ndarray, lo: np.ndarray, hi: np.ndarray, base: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Parses the numbers in a[lo:hi] (one per row) digit position by digit position, and whether they are valid
+    n = hi - lo
+    value = np.zeros(len(lo), dtype=np.uint64)
+    valid = n > 0
+    for j in range(int(n.max()) if len(n) > 0 else 0):
+        rows = np.flatnonzero(j < n)
+        digit = a[lo[rows] + j].astype(np.uint64) - np.uint64(ord('0'))
+        valid[rows] &= digit < np.uint64(base)
+        value[rows] = value[rows] * np.uint64(base) + digit
+    return value, valid
+
+
+def _symbol_key(symbol: str) -> int:
+    # A symbol of up to 8 (printable, so nonzero) characters packed into an integer
+    return int.from_bytes(symbol.encode('latin-1'), 'big')
+
+
+def _symbol_keys(a: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    # _symbol_key of every a[lo:hi], or 0 for symbols that are empty or too long to be packed
+    n = hi - lo
+    keys = np.zeros(len(lo), dtype=np.uint64)
+    for j in range(min(int(n.max()), 8) if len(n) > 0 else 0):
+        rows = np.flatnonzero(j < n)
+        keys[rows] = (keys[rows] << np.uint64(8)) | a[lo[rows] + j].astype(np.uint64)
+    keys[(n <= 0) | (n > 8)] = 0
+    return keys
+
+
+def bulk_tokenizable(symbols: Dict[str, List[Signal]], wanted: Iterable[str]) -> bool:
+    # Whether iter_value_change_columns can tokenize the value changes of the wanted symbols
+    return all(len(s) <= 8 and symbols[s][0].width <= 64 for s in wanted)
+
+
+def iter_value_change_columns(blocks: Iterable[np.ndarray], symbols: List[str]) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    A bulk version of iter_value_changes over blocks of whole lines (see _vcd_blocks), for symbols that pass
+    bulk_tokenizable: yields the (times, symbol indices, values) of the value changes of the given symbols in every
+    block, in file order. Lines are split, classified and their times, symbols and binary values decoded with array
+    operations over the whole block, so no Python object is created per line.
+    """
+    keys = np.array([_symbol_key(s) for s in symbols], dtype=np.uint64)
+    key_order = np.argsort(keys)
+    sorted_keys = keys[key_order]
+
+    def lookup(found_keys: np.ndarray) -> np.ndarray:
+        if len(sorted_keys) == 0:
+            return np.full(len(found_keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(sorted_keys, found_keys), len(sorted_keys) - 1)
+        return np.where((sorted_keys[pos] == found_keys) & (found_keys != 0), key_order[pos], -1)
+
+    time = 0
+    for a in blocks:
+        newlines = np.flatnonzero(a == ord('\n'))
+        if len(a) > 0 and a[-1] != ord('\n'):
+            newlines = np.append(newlines, len(a))
+        starts = np.concatenate([[0], newlines[:-1] + 1]).astype(np.int64)
+        ends = newlines.astype(np.int64)
+        while True:
+            blank = (starts < ends) & _BLANK[a[np.minimum(starts, len(a) - 1)]]
+            if not blank.any():
+                break
+            starts[blank] += 1
+        while True:
+            blank = (ends > starts) & _BLANK[a[np.maximum(ends - 1, 0)]]
+            if not blank.any():
+                break
+            ends[blank] -= 1
+        head = np.zeros(len(starts), dtype=np.uint8)
+        nonempty = starts < ends
+        head[nonempty] = a[starts[nonempty]]
+
+        # Timestamps (#<decimal>)
+        time_lines = np.flatnonzero(head == ord('#'))
+        time_values, valid = _digits(a, starts[time_lines] + 1, ends[time_lines], 10)
+        time_lines, time_values = time_lines[valid], time_values[valid].astype(np.int64)
+
+        # Scalar changes (0<symbol>, 1<symbol>); x and z scalars are skipped
+        lines = np.flatnonzero((head == ord('0')) | (head == ord('1')))
+        ids = lookup(_symbol_keys(a, starts[lines] + 1, ends[lines]))
+        keep = ids >= 0
+        scalar = (lines[keep], ids[keep], (head[lines[keep]] - ord('0')).astype(np.uint64))
+
+        # Vector changes (b<binary> <symbol>, separated by any run of blanks); values with x or z bits are skipped
+        lines = np.flatnonzero((head == ord('b')) | (head == ord('B')))
+        spaces = np.append(np.flatnonzero(_BLANK[a]), len(a))
+        space = spaces[np.searchsorted(spaces, starts[lines])]
+        has_space = space < ends[lines]
+        lines, space = lines[has_space], space[has_space]
+        symbol_start = space + 1
+        while True:
+            blank = (symbol_start < ends[lines]) & _BLANK[a[np.minimum(symbol_start, len(a) - 1)]]
+            if not blank.any():
+                break
+            symbol_start[blank] += 1
+        ids = lookup(_symbol_keys(a, symbol_start, ends[lines]))
+        keep = ids >= 0
+        lines, space, ids = lines[keep], space[keep], ids[keep]
+        values, valid = _digits(a, starts[lines] + 1, space, 2)
+        vector = (lines[valid], ids[valid], values[valid])
+
+        lines = np.concatenate([scalar[0], vector[0]])
+        order = np.argsort(lines, kind='stable')
+        lines = lines[order]
+        ids = np.concatenate([scalar[1], vector[1]])[order].astype(np.int64)
+        values = np.concatenate([scalar[2], vector[2]])[order]
+        latest = np.searchsorted(time_lines, lines, side='right') - 1
+        times = np.append(time_values, time)[latest]  # latest == -1 picks the time carried from the last block
+        if len(time_values) > 0:
+            time = int(time_values[-1])
+        yield times.astype(np.int64), ids, values
+
+
 def read_vcd(vcd_filename: str) -> Tuple[Module, VCDData]:
     logging.info("VCD file: %s", vcd_filename)
     assert os.path.isfile(vcd_filename), "%s not found" % vcd_filename
 
-    time = -1               # type: int
-    # Maps a symbol to a set of aliased signals and the signal's delta event trace.
-    # The List[Signal] contains all the signals in the VCD that were aliased to one logical signal.
-    vcd_data = defaultdict(lambda: ([], []))  # type: Dict[str, Tuple[List[Signal], List[Event]]]
-
-    with open(vcd_filename, "r") as _f:
-        path = list()       # type: List[str]
-        module_tree = []    # type: List[Module]
-        for line in _f:
-            tokens = line.split()
-            if not tokens:
-                pass
-            elif tokens[0][0] == "$":
-                # module instance
-                if tokens[0] == "$scope":
-                    assert tokens[1] == "module"
-                    assert tokens[3] == "$end"
-                    assert tokens[3] == "$end"
-                    path.append(tokens[2])
-                    if len(module_tree) > 0:
-                        this_module = Module(module_tree[-1].name + "." + tokens[2])
-                        module_tree[-1].children.append(this_module)
-                        module_tree.append(this_module)
-                    else:  # This is the top-level module
-                        this_module = Module(tokens[2])
-                        module_tree.append(this_module)
-                # move up to the upper module instance
-                elif tokens[0] == "$upscope":
-                    path = path[:-1]
-                    if len(module_tree) > 1:  # Don't remove the top-level module from the stack
-                        module_tree = module_tree[:-1]
-                # signal definition
-                elif tokens[0] == "$var":
-                    width = int(tokens[2])
-                    symbol = tokens[3]
-                    signal_name = tokens[4]
-                    signal = ("%s.%s" % (".".join(path), signal_name))
-                    vcd_data[symbol][0].append(Signal(signal, width))
-                # no more variable definitions
-                elif tokens[0] == "$enddefinitions":
-                    assert tokens[1] == "$end"
-            # TODO: parse $dumpvars section for initial values of signals
-            elif tokens[0][0] == '#':
-                time = int(tokens[0][1:])
-            elif time >= 0 and tokens:
-                if len(tokens) == 2:
-                    assert tokens[0][0] == 'b'
-                    value = int(tokens[0][1:], 2)
-                    symbol = tokens[1]
-                else:  # len(tokens) == 1
-                    assert len(tokens) == 1
-                    value = int(tokens[0][0])
-                    symbol = tokens[0][1:]
-                vcd_data[symbol][1].append(Event(time, value))
+    with open_vcd(vcd_filename) as _f:
+        module_tree, symbols = read_vcd_header(line.decode('latin-1') for line in _f)
+        names = list(symbols)
+        if bulk_tokenizable(symbols, names):
+            parts = defaultdict(list)  # type: Dict[int, List[Tuple[np.ndarray, np.ndarray]]]
+            for (times, ids, values) in iter_value_change_columns(_vcd_blocks(_f), names):
+                order = np.argsort(ids, kind='stable')
+                times, ids, values = times[order], ids[order], values[order]
+                bounds = np.flatnonzero(np.diff(ids)) + 1
+                for (i, j) in zip(np.concatenate([[0], bounds]).tolist(), np.concatenate([bounds, [len(ids)]]).tolist()):
+                    if i < j:
+                        parts[int(ids[i])].append((times[i:j], values[i:j]))
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64))
+            traces = {symbol: DeltaTrace(*[np.concatenate([c[k] for c in parts[i]] + [empty[k]]) for k in (0, 1)])
+                      for (i, symbol) in enumerate(names)}
+        else:
+            # Maps a symbol to the times and values of its delta event trace
+            columns = {symbol: _trace_columns(signals[0].width) for (symbol, signals) in symbols.items()}
+            for (time, symbol, value) in iter_value_changes(line.decode('latin-1') for line in _f):
+                times, values = columns[symbol]
+                times.append(time)
+                values.append(value)
+            traces = {symbol: _trace_from_columns(*columns[symbol]) for symbol in names}
 
-    assert len(module_tree) == 1
-    final_module_tree = module_tree[0]
-    #print("Module hierarchy: \n{}".format(final_module_tree))
-    return final_module_tree, {frozenset(data[0]): data[1] for (symbol, data) in vcd_data.items()}
+    #print("Module hierarchy: \n{}".format(module_tree))
+    return module_tree, {SIGNAL_TABLE.intern(frozenset(signals)): traces[symbol]
+                         for (symbol, signals) in symbols.items()}
+
+
+# Compact append-only columns used to accumulate a trace while parsing
+def _trace_columns(width: int) -> Tuple[array, Any]:
+    return array('q'), (array('Q') if width <= 64 else [])
 
 
-def sample_signal(clock: List[Event], signal: List[Event]) -> List[Event]:
+def _trace_from_columns(times: array, values: Any) -> DeltaTrace:
+    return DeltaTrace(np.frombuffer(times, dtype=np.int64) if len(times) > 0 else [],
+                      np.frombuffer(values, dtype=np.uint64) if isinstance(values, array) and len(values) > 0 else values)
+
+
+def _sample_sorted(posedges: np.ndarray, ids: np.ndarray, times: np.ndarray, values: np.ndarray,
+                   initial: np.ndarray, initial_known: np.ndarray,
+                   sampled: np.ndarray, sampled_known: np.ndarray, edge_bounds: Optional[np.ndarray] = None,
+                   domains: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Samples a signal at the posedge of the clock. The rising edge of the clock will be internally
-    brought back by a nudge to sample signals that change on the clock edge.
+    Batched clock sampling of many signals at once. ids/times/values are the value changes of all signals,
+    sorted by (id, time). initial holds the value of each signal before its first change, and sampled holds the
+    last value each signal was sampled with (where known). A change at time t becomes visible at the first
+    posedge strictly after t, so a signal changing on the clock edge is logged with its value before the edge.
+    With several clock domains, posedges holds the posedges of domain d at posedges[edge_bounds[d]:edge_bounds[d+1]]
+    and signal i is sampled on those of domain domains[i].
+    Returns the (id, posedge index, value) of every sample that differs from the previous sample of its signal,
+    sorted by (id, posedge index).
     """
-    if (len(signal) == 0):
-        return []
-    posedges = list(filter(lambda e: e.value == 1, clock))
-    sig_value = signal[0].value
-    #assert signal[0].time == 0, "The signal to be sampled requires an initial value"
-    clk_idx, sig_idx = 0, 0
-    sampled_signal = []  # type: List[Event]
-
-    def add_event(time: int, value: int):
-        if len(sampled_signal) > 0 and sampled_signal[-1].value != value:
-            sampled_signal.append(Event(time, value))
-        elif len(sampled_signal) == 0:
-            sampled_signal.append(Event(time, value))
-
-    while sig_idx < len(signal) or clk_idx < len(posedges):
-        # signal and clock coincide, so log the signal before the clock edge
-        if sig_idx < len(signal) and clk_idx < len(posedges) and signal[sig_idx].time == posedges[clk_idx].time:
-            add_event(signal[sig_idx].time, sig_value)
-            sig_value = signal[sig_idx].value
-            sig_idx = sig_idx + 1
-            clk_idx = clk_idx + 1
-        # signal toggled 'before' a rising edge, just update the current signal value
-        elif (sig_idx < len(signal) and clk_idx < len(posedges) and signal[sig_idx].time < posedges[clk_idx].time) \
-                or (clk_idx == len(posedges) and sig_idx < len(signal)):
-            sig_value = signal[sig_idx].value
-            sig_idx = sig_idx + 1
-        # clock posedge has arrived before the next signal transition, so log an event now
-        elif (sig_idx < len(signal) and clk_idx < len(posedges) and signal[sig_idx].time > posedges[clk_idx].time) \
-                or (sig_idx == len(signal) and clk_idx < len(posedges)):
-            add_event(posedges[clk_idx].time, sig_value)
-            clk_idx = clk_idx + 1
-        else:
-            assert False
-    return sampled_signal
+    if domains is None:
+        first_edge, end_edge = np.zeros(len(initial), dtype=np.int64), np.full(len(initial), len(posedges))
+        k = np.searchsorted(posedges, times, side='right')
+    else:
+        first_edge, end_edge = edge_bounds[domains], edge_bounds[domains + 1]
+        k = np.empty(len(times), dtype=np.int64)
+        change_domains = domains[ids]
+        for d in range(len(edge_bounds) - 1):
+            changes = change_domains == d
+            k[changes] = edge_bounds[d] + np.searchsorted(posedges[edge_bounds[d]:edge_bounds[d + 1]], times[changes],
+                                                          side='right')
+    init_ids = np.nonzero(initial_known)[0]
+    k = np.concatenate([first_edge[init_ids], k])
+    ids = np.concatenate([init_ids, ids])
+    values = np.concatenate([initial[init_ids], values])
+    # Stable, so the initial value sorts before the real changes that become visible at the same posedge
+    order = np.lexsort((k, ids))
+    ids, k, values = ids[order], k[order], values[order]
 
+    # The last change before each posedge is the value sampled on it
+    last = np.ones(len(ids), dtype=bool)
+    last[:-1] = (ids[1:] != ids[:-1]) | (k[1:] != k[:-1])
+    keep = last & (k < end_edge[ids])
+    ids, k, values = ids[keep], k[keep], values[keep]
 
-# An extended version of read_vcd which performs common tasks on the raw VCD data after reading it
-# 1. Nudges delta events to occur on a rising clock edge (for consistent post-processing)
-# 2. Strips events before a given start_time
-# 3. Deletes Chisel temporary/junk signals
-# 4. Deletes signals that are wider than signal_bit_limit
-def read_vcd_clean(vcd_file_path: str, start_time: int, signal_bit_limit: int) -> Tuple[Module, VCDData]:
-    module_tree, vcd_data = read_vcd(vcd_file_path)
-
-    # TODO: Only pick out the top-level clock, this doesn't work for rocket-chip
-    clocks = list(filter(
-        lambda aliased_signals: any(['clk' in signal.name or 'clock' in signal.name for signal in aliased_signals]),
-        vcd_data.keys()))
-    assert len(clocks) == 1, "Found too many or no clocks. Got: {}".format(clocks)
-    assert all([c.width == 1 for c in clocks[0]]), "All clock signals better have a width of 1"
-    clock = clocks[0]
-    #print("Found clock {}".format(clock))
-
-    # Trim off events before the start_time commandline arg
-    for signal, events in vcd_data.items():
-        vcd_data[signal] = list(filter(lambda e: e.time > start_time, events))
-
-    # Delete keys entirely that consist of *only* Chisel temporary/junk signals
-    # Trim all other keys of signals which are Chisel temporary/junk signals
-    keys_to_delete = []  # type: List[FrozenSet[Signal]]
-    keys_to_trim = {}  # type: Dict[FrozenSet[Signal], Set[Signal]]
-
-    def ignore_sig(sig: Signal) -> bool:
-        signals_to_ignore = {'_RAND', '_GEN', '_T', 'reset'}
-        return any([ignore_str in sig.name for ignore_str in signals_to_ignore])
-
-    for signal_set in vcd_data.keys():
-        ignored_signals = set(filter(lambda sig: ignore_sig(sig), signal_set))
-        if len(ignored_signals) == len(signal_set):
-            # If all Signals in this key are junk, then delete the entire key
-            keys_to_delete.append(signal_set)
+    # Only log a sample if it differs from the previous sample of the same signal
+    first = np.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    prev = np.empty_like(values)
+    prev[1:] = values[:-1]
+    prev[first] = sampled[ids[first]]
+    prev_known = ~first | sampled_known[ids]
+    emit = ~prev_known | (values != prev)
+    return ids[emit], k[emit], values[emit]
+
+
+def _last_per_id(ids: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # ids must be sorted
+    last = np.ones(len(ids), dtype=bool)
+    last[:-1] = ids[1:] != ids[:-1]
+    return ids[last], values[last]
+
+
+def sample_signals(clock: DeltaTrace, signals: Dict[Any, DeltaTrace]) -> Dict[Any, DeltaTrace]:
+    """
+    Samples every signal at the posedges of the clock in one batched pass: the posedge times are computed once
+    and every value change of every signal is located among them with a single sorted search. A signal holds
+    the value of its first event before that event occurs, and signals without events are not sampled.
+    """
+    clock = as_delta_trace(clock)
+    posedges = clock.times[clock.values == 1]
+    keys = list(signals.keys())
+    traces = [as_delta_trace(signals[k]) for k in keys]
+    lengths = np.array([len(t) for t in traces], dtype=np.int64)
+    if len(keys) == 0 or lengths.sum() == 0:
+        return {k: DeltaTrace([], []) for k in keys}
+    ids = np.repeat(np.arange(len(keys)), lengths)
+    times = np.concatenate([t.times for t in traces])
+    values = np.concatenate([t.values for t in traces])
+    starts = np.cumsum(lengths) - lengths
+    initial = values[np.minimum(starts, len(values) - 1)]
+    ids, k, values = _sample_sorted(posedges, ids, times, values, initial, lengths > 0,
+                                    np.empty_like(initial), np.zeros(len(keys), dtype=bool))
+    bounds = np.searchsorted(ids, np.arange(len(keys) + 1))
+    return {key: DeltaTrace(posedges[k[bounds[i]:bounds[i+1]]], values[bounds[i]:bounds[i+1]])
+            for (i, key) in enumerate(keys)}
+
+
+def sample_column_chunks(columns: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]], num_symbols: int,
+                         start_time: int, dtype=np.uint64, chunk_size: int = 1 << 16,
+                         symbol_domains: Optional[np.ndarray] = None, domains: Optional[List[ClockDomain]] = None) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Samples a time-ordered stream of value changes, given as batches of (times, symbol indices, values) columns in
+    which index num_symbols + d is the clock of domain d, at each posedge after start_time of the clock of every
+    symbol's domain (symbol_domains, all 0 if not given). The posedges of every domain are appended to domains (when
+    given) as they are found. The stream is re-cut into chunks of about chunk_size changes at timestep boundaries, and
+    each chunk is sampled in one batched pass over all the domains. Yields (times, symbol indices, values) arrays of
+    the samples that differ from the previous sample of their symbol. Only the current value of each symbol is carried
+    between chunks, so memory is bounded by the number of symbols and the chunk size rather than the trace length.
+    """
+    current = np.zeros(num_symbols, dtype=dtype)
+    current_known = np.zeros(num_symbols, dtype=bool)
+    sampled = np.zeros(num_symbols, dtype=dtype)
+    sampled_known = np.zeros(num_symbols, dtype=bool)
+    num_domains = len(domains) if domains is not None else 1
+    clock_values = np.full(num_domains, 2, dtype=np.int64)  # Neither 0 nor 1 until each clock's first change
+
+    def sample(times: np.ndarray, ids: np.ndarray, values: np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # The posedges of every domain in this chunk, grouped by domain
+        is_clock = ids >= num_symbols
+        clocks = ids[is_clock] - num_symbols
+        order = np.argsort(clocks, kind='stable')
+        clocks, clock_times = clocks[order], times[is_clock][order]
+        clock_values_now = values[is_clock][order].astype(np.int64)
+        previous = np.empty_like(clock_values_now)
+        previous[1:] = clock_values_now[:-1]
+        first = np.ones(len(clocks), dtype=bool)
+        first[1:] = clocks[1:] != clocks[:-1]
+        previous[first] = clock_values[clocks[first]]
+        last = np.ones(len(clocks), dtype=bool)
+        last[:-1] = first[1:]
+        clock_values[clocks[last]] = clock_values_now[last]
+        rising = (clock_values_now == 1) & (previous != 1) & (clock_times > start_time)
+        posedges = clock_times[rising]
+        edge_bounds = np.searchsorted(clocks[rising], np.arange(num_domains + 1))
+        if domains is not None:
+            for (d, domain) in enumerate(domains):
+                domain.extend(posedges[edge_bounds[d]:edge_bounds[d + 1]])
+
+        chunk_ids = ids[~is_clock]
+        order = np.argsort(chunk_ids, kind='stable')
+        chunk_ids = chunk_ids[order]
+        chunk_values = values[~is_clock][order].astype(dtype)
+        s_ids, s_k, s_values = _sample_sorted(posedges, chunk_ids, times[~is_clock][order], chunk_values,
+                                              current, current_known, sampled, sampled_known,
+                                              edge_bounds, symbol_domains)
+        last_ids, last_values = _last_per_id(s_ids, s_values)
+        sampled[last_ids] = last_values
+        sampled_known[last_ids] = True
+        last_ids, last_values = _last_per_id(chunk_ids, chunk_values)
+        current[last_ids] = last_values
+        current_known[last_ids] = True
+        return posedges[s_k], s_ids, s_values
+
+    pending = None  # type: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+    for batch in itertools.chain(columns, [None]):
+        if batch is None:
+            if pending is None:
+                break
+            times, ids, values = pending
+        elif pending is None:
+            times, ids, values = batch
         else:
-            # Otherwise, only some Signals in this key need to be junked
-            keys_to_trim[signal_set] = ignored_signals
+            times, ids, values = [np.concatenate([pending[k], batch[k]]) for k in range(3)]
+        # Cut after the last timestep that reaches chunk_size changes; the trailing timestep waits for more changes
+        start = 0
+        while start < len(times):
+            if start + chunk_size < len(times):
+                cut = int(np.searchsorted(times, times[start + chunk_size - 1], side='right'))
+            elif batch is None:
+                cut = len(times)
+            else:
+                cut = int(np.searchsorted(times, times[-1], side='left'))
+            if cut <= start:
+                break
+            s_times, s_ids, s_values = sample(times[start:cut], ids[start:cut], values[start:cut])
+            if len(s_ids) > 0:
+                yield s_times, s_ids, s_values
+            start = cut
+        pending = (times[start:], ids[start:], values[start:])
+
+
+def sample_change_chunks(changes: Iterable[Tuple[int, str, int]], symbols: List[str], clock: Union[str, List[str]],
+                         start_time: int, dtype=np.uint64, chunk_size: int = 1 << 16,
+                         symbol_domains: Optional[np.ndarray] = None, domains: Optional[List[ClockDomain]] = None) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    sample_column_chunks over a time-ordered stream of (time, symbol, value) changes of the given symbols and the
+    clock symbol (or the clock symbol of every domain).
+    """
+    clocks = [clock] if isinstance(clock, str) else clock
+    index = {symbol: i for (i, symbol) in enumerate(symbols + clocks)}
+
+    def columns() -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        changes_iter = iter(changes)
+        while True:
+            batch = list(itertools.islice(changes_iter, chunk_size))
+            if len(batch) == 0:
+                return
+            times, batch_symbols, values = zip(*batch)
+            yield np.array(times, dtype=np.int64), np.array([index[s] for s in batch_symbols], dtype=np.int64), \
+                np.array(values, dtype=dtype)
+    yield from sample_column_chunks(columns(), len(symbols), start_time, dtype, chunk_size, symbol_domains, domains)
+
+
+def sample_changes(changes: Iterable[Tuple[int, str, int]], symbols: List[str], clock: str, start_time: int) \
+        -> Iterator[Tuple[int, str, int]]:
+    """
+    Like sample_change_chunks, but yields clock-sampled (time, symbol, value) events one at a time in time order.
+    """
+    for (times, ids, values) in sample_change_chunks(changes, symbols, clock, start_time, dtype=object):
+        order = np.argsort(times, kind='stable')
+        for (t, i, v) in zip(times[order].tolist(), ids[order].tolist(), values[order].tolist()):
+            yield t, symbols[i], v
 
-    for key_to_delete in keys_to_delete:
-        del vcd_data[key_to_delete]
 
-    for (key_to_trim, set_of_junk_signals) in keys_to_trim.items():
-        new_set = key_to_trim - set_of_junk_signals
-        vcd_data[new_set] = vcd_data.pop(key_to_trim)
+# Chisel temporary/junk signal names, excluded unless a SignalFilter is given other exclude patterns
+DEFAULT_EXCLUDE = ['_RAND', '_GEN', '_T', 'reset']
+
+
+class SignalFilter:
+    """
+    Selects signals by name while the $var header is read: a signal passes if it is inside the scope module (when one
+    is given), if one of the include regexes matches its full name (when any are given) and if none of the exclude
+    regexes does. Regexes match anywhere in the name (re.search).
+    """
+    def __init__(self, include: Optional[List[str]] = None, exclude: Optional[List[str]] = None,
+                 scope: Optional[str] = None) -> None:
+        self.include = list(include or [])
+        self.exclude = list(DEFAULT_EXCLUDE if exclude is None else exclude)
+        self.scope = scope
+        self._include = [re.compile(p) for p in self.include]
+        self._exclude = [re.compile(p) for p in self.exclude]
+
+    def __call__(self, signal: Signal) -> bool:
+        if self.scope is not None and not signal.name.startswith(self.scope + '.'):
+            return False
+        if len(self._include) > 0 and not any(p.search(signal.name) for p in self._include):
+            return False
+        return not any(p.search(signal.name) for p in self._exclude)
 
-    # Trim off signals that have no delta events or are too wide
-    vcd_data_cleaned = {signal_set: trace for (signal_set, trace) in vcd_data.items()
-                        if len(trace) > 0 and list(signal_set)[0].width <= signal_bit_limit}
+    def __repr__(self) -> str:
+        return "SignalFilter(include={}, exclude={}, scope={})".format(self.include, self.exclude, self.scope)
 
-    # Sample signals on the clock
-    vcd_data_sampled = {signal: sample_signal(vcd_data_cleaned[clock], data) for (signal, data) in vcd_data_cleaned.items()}
-    # Remove the clock from the vcd data
-    del vcd_data_sampled[clock]
+    @property
+    def is_default(self) -> bool:
+        return len(self.include) == 0 and self.exclude == DEFAULT_EXCLUDE and self.scope is None
 
+    def scope_tree(self, module_tree: Module) -> Module:
+        # The module named by scope, which becomes the root of the hierarchy
+        if self.scope is None:
+            return module_tree
+        module_queue = [module_tree]
+        while len(module_queue) > 0:
+            module = module_queue.pop()
+            if module.name == self.scope:
+                return module
+            module_queue.extend(module.children)
+        raise ValueError("Scope {} is not a module of the VCD".format(self.scope))
+
+
+# The names of clock signals (the last component of their hierarchical name), most preferred first
+CLOCK_NAMES = ('clock', 'clk')
+
+
+def find_clock_domains(symbols: Dict[str, List[Signal]], clock_names: Sequence[str] = CLOCK_NAMES) \
+        -> Tuple[Dict[str, ClockDomain], Dict[str, ClockDomain]]:
+    """
+    Discovers the clock domains of a design from its module hierarchy. Clocks are 1-bit signals named exactly one of
+    clock_names (so clock enables such as clk_en are ordinary signals). A module is clocked by the clock declared in
+    it (the first of clock_names, if it declares several), or else by the clock of its closest clocked ancestor, and
+    every other symbol belongs to the domain of the module of its first alias (or of the top-most clocked module, for
+    symbols outside every clocked subtree). Ports that alias the same clock share a VCD symbol, so a clock passed down
+    the hierarchy is one domain. Returns the ClockDomain of every clock symbol and of every other symbol.
+    """
+    module_clocks = {}  # type: Dict[str, Tuple[int, str, str]]
+    for (symbol, signals) in symbols.items():
+        for signal in signals:
+            leaf = signal.name[signal.name.rfind('.') + 1:]
+            if signal.width == 1 and leaf in clock_names:
+                module = module_of(signal.name)
+                candidate = (clock_names.index(leaf), signal.name, symbol)
+                module_clocks[module] = min(module_clocks.get(module, candidate), candidate)
+    assert len(module_clocks) > 0, "Found no clocks"
+
+    clocks = {}  # type: Dict[str, ClockDomain]
+    for module in sorted(module_clocks, key=lambda m: (m.count('.'), m)):
+        _, name, symbol = module_clocks[module]
+        if symbol not in clocks:
+            clocks[symbol] = ClockDomain(name)
+    top = clocks[module_clocks[min(module_clocks, key=lambda m: (m.count('.'), m))][2]]
+
+    module_domains = {}  # type: Dict[str, ClockDomain]
+
+    def module_domain(module: str) -> ClockDomain:
+        if module not in module_domains:
+            if module in module_clocks:
+                module_domains[module] = clocks[module_clocks[module][2]]
+            else:
+                module_domains[module] = module_domain(module_of(module)) if '.' in module else top
+        return module_domains[module]
+    domains = {symbol: module_domain(module_of(signals[0].name))
+               for (symbol, signals) in symbols.items() if symbol not in clocks}
+    return clocks, domains
+
+
+def _clean_symbols(symbols: Dict[str, List[Signal]], signal_bit_limit: int, signals_needed: Optional[Set[str]] = None,
+                   signal_filter: Optional[SignalFilter] = None) \
+        -> Tuple[Dict[str, ClockDomain], Dict[str, AliasedSignals], Dict[str, ClockDomain]]:
+    # Returns the domain of every clock symbol, the kept symbols and the domain of every kept symbol
+    clocks, domains = find_clock_domains(symbols)
+    if signal_filter is None:
+        # Symbols that properties name are kept even if only Chisel temporaries name them
+        signal_filter = SignalFilter() if signals_needed is None else SignalFilter(exclude=[])
+    junk = SignalFilter()
+
+    # Drop symbols whose aliases *all* fail the filter (by default: are Chisel temporary/junk signals) or that are
+    # too wide. Only the Chisel temporary/junk aliases are trimmed off the other symbols, whatever the filter, so that
+    # a signal is the same AliasedSignals however it was selected: properties mined with one filter match the
+    # signals read with another (or with signals_needed) when they are checked or merged.
+    kept = {}  # type: Dict[str, AliasedSignals]
+    for (symbol, signals) in symbols.items():
+        if symbol in clocks or signals[0].width > signal_bit_limit or not any(signal_filter(sig) for sig in signals):
+            continue
+        if signals_needed is None or any([sig.name in signals_needed for sig in signals]):
+            signal_set = frozenset(sig for sig in signals if junk(sig))
+            kept[symbol] = SIGNAL_TABLE.intern(signal_set if len(signal_set) > 0 else frozenset(signals))
+    return clocks, kept, {symbol: domains[symbol] for symbol in kept}
+
+
+def stream_vcd_clean(vcd_file_path: str, start_time: int, signal_bit_limit: int,
+                     signals_needed: Optional[Set[str]] = None, chunk_size: int = 1 << 16,
+                     signal_filter: Optional[SignalFilter] = None) \
+        -> Tuple[Module, Dict[str, AliasedSignals], Dict[str, ClockDomain],
+                 Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]]:
+    """
+    Reads the VCD header and returns the module hierarchy, the cleaned aliased signals of every kept symbol, the
+    clock domain of every kept symbol (see find_clock_domains) and a generator of clock-sampled (times, symbol indices,
+    values) chunks, where the indices follow the order of the kept symbols and every symbol is sampled on the clock of
+    its domain. The posedges of a domain are added to it before the chunks sampled on them are yielded. Value changes
+    of dropped symbols are skipped while parsing. The file is closed once the generator is exhausted. If signals_needed
+    is given, only symbols with one of those signal names are kept. Symbols are kept if any of their aliases passes
+    signal_filter, and its scope becomes the returned root module.
+    The VCD may also be a named pipe that a simulator is still writing, or '-' for standard input.
+    """
+    logging.info("VCD file: %s", vcd_file_path)
+    assert vcd_file_path == '-' or os.path.exists(vcd_file_path), "%s not found" % vcd_file_path
+    f = open_vcd(vcd_file_path)
+    try:
+        module_tree, symbols = read_vcd_header(line.decode('latin-1') for line in f)
+        clocks, kept, domains = _clean_symbols(symbols, signal_bit_limit, signals_needed, signal_filter)
+        if signal_filter is not None:
+            module_tree = signal_filter.scope_tree(module_tree)
+    except BaseException:
+        f.close()
+        raise
+    dtype = np.uint64 if all(next(iter(signals)).width <= 64 for signals in kept.values()) else object
+    PROFILE.count('symbols_dropped', len(symbols) - len(kept) - len(clocks))
+    PROFILE.count('clock_domains', len(clocks))
+    clock_domains = list(clocks.values())
+    domain_ids = {id(domain): d for (d, domain) in enumerate(clock_domains)}
+    symbol_domains = np.array([domain_ids[id(domains[symbol])] for symbol in kept], dtype=np.int64)
+    names = list(kept) + list(clocks)
+
+    def chunks() -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        with f:
+            if bulk_tokenizable(symbols, names):
+                blocks = _vcd_blocks(f)
+                if PROFILE.enabled:
+                    blocks = _profiled_blocks(blocks)
+                columns = iter_value_change_columns(blocks, names)
+                if PROFILE.enabled:
+                    columns = _profiled_columns(columns, len(kept))
+                yield from sample_column_chunks(columns, len(kept), start_time, dtype, chunk_size, symbol_domains,
+                                                clock_domains)
+            else:
+                lines = (line.decode('latin-1') for line in f)
+                if PROFILE.enabled:
+                    changes = _profiled_changes(iter_value_changes(PROFILE.counted(lines, 'lines_parsed'), set(names)),
+                                                set(clocks))
+                else:
+                    changes = iter_value_changes(lines, set(names))
+                yield from sample_change_chunks(changes, list(kept), list(clocks), start_time, dtype, chunk_size,
+                                                symbol_domains, clock_domains)
+    return module_tree, kept, domains, chunks()
+
+
+def _profiled_blocks(blocks: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+    for block in blocks:
+        PROFILE.count('lines_parsed', int(np.count_nonzero(block == ord('\n'))) + int(block[-1] != ord('\n')))
+        yield block
+
+
+def _profiled_columns(columns: Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]], num_symbols: int) \
+        -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    for (times, ids, values) in columns:
+        clock_changes = int(np.count_nonzero(ids >= num_symbols))
+        PROFILE.count('clock_changes', clock_changes)
+        PROFILE.count('value_changes', len(ids) - clock_changes)
+        yield times, ids, values
+
+
+def _profiled_changes(changes: Iterator[Tuple[int, str, int]], clocks: Set[str]) -> Iterator[Tuple[int, str, int]]:
+    clock_changes, value_changes = 0, 0
+    try:
+        for change in changes:
+            if change[1] in clocks:
+                clock_changes += 1
+            else:
+                value_changes += 1
+            yield change
+    finally:
+        PROFILE.count('clock_changes', clock_changes)
+        PROFILE.count('value_changes', value_changes)
+
+
+def sample_signal(clock: List[Event], signal: List[Event]) -> DeltaTrace:
+    """
+    Samples a signal at the posedge of the clock. The rising edge of the clock will be internally
+    brought back by a nudge to sample signals that change on the clock edge.
+    """
+    return sample_signals(clock, {0: signal})[0]
+
+
+# An extended version of read_vcd which performs common tasks on the VCD data while reading it
+# 1. Nudges delta events to occur on a rising clock edge (for consistent post-processing), of the clock of the
+#    signal's domain (each trace refers to its ClockDomain)
+# 2. Strips events before a given start_time (the values at start_time become the initial values)
+# 3. Deletes Chisel temporary/junk signals, or the signals none of whose names signal_filter accepts (applied to the
+#    header, so the value changes of deleted signals are skipped while parsing)
+# 4. Deletes signals that are wider than signal_bit_limit
+# 5. Optionally keeps only the signals named in signals_needed, skipping the value changes of all others
+def read_vcd_clean(vcd_file_path: str, start_time: int, signal_bit_limit: int,
+                   signals_needed: Optional[Set[str]] = None,
+                   signal_filter: Optional[SignalFilter] = None) -> Tuple[Module, VCDData]:
+    with PROFILE.timer('read_vcd_clean'):
+        value_changes_before = PROFILE.counters.get('value_changes', 0)
+        module_tree, kept, domains, chunks = stream_vcd_clean(vcd_file_path, start_time, signal_bit_limit,
+                                                              signals_needed, signal_filter=signal_filter)
+        symbols = list(kept)
+        parts = defaultdict(list)  # type: Dict[int, List[Tuple[np.ndarray, np.ndarray]]]
+        for (times, ids, values) in chunks:
+            bounds = np.flatnonzero(np.diff(ids)) + 1
+            for (i, j) in zip(np.concatenate([[0], bounds]).tolist(), np.concatenate([bounds, [len(ids)]]).tolist()):
+                parts[int(ids[i])].append((times[i:j], values[i:j]))
+
+        # Trim off signals that have no delta events after their initial value
+        vcd_data_sampled = {}  # type: VCDData
+        for (i, columns) in parts.items():
+            trace = DeltaTrace(np.concatenate([c[0] for c in columns]), np.concatenate([c[1] for c in columns]),
+                               domains[symbols[i]])
+            if len(trace) > 1:
+                vcd_data_sampled[kept[symbols[i]]] = trace
+        if PROFILE.enabled:
+            events_kept = sum(len(t) for t in vcd_data_sampled.values())
+            PROFILE.count('signals_kept', len(vcd_data_sampled))
+            PROFILE.count('signals_trimmed', len(kept) - len(vcd_data_sampled))
+            PROFILE.count('events_kept', events_kept)
+            PROFILE.count('events_dropped', PROFILE.counters.get('value_changes', 0) - value_changes_before - events_kept)
     return module_tree, vcd_data_sampled
 
 
 if __name__ == "__main__":
+    import pickle
     print("TESTING: sample_signal")
     # Case 1: data changes at same timestep as clock
     clock = [Event(0, 0), Event(1, 1), Event(2, 0), Event(3, 1), Event(4, 0), Event(5, 1)]
@@ -228,3 +1014,109 @@ if __name__ == "__main__":
     data = [Event(0, 100), Event(2, 200), Event(4, 300)]
     sampled_data = sample_signal(clock, data)
     assert sampled_data == [Event(1, 100), Event(3, 200), Event(5, 300)]
+
+    # Both cases sampled together in one batch
+    sampled = sample_signals(clock, {'edge': [Event(0, 100), Event(1, 200), Event(5, 300)], 'negedge': data, 'none': []})
+    assert sampled['edge'] == [Event(1, 100), Event(3, 200)]
+    assert sampled['negedge'] == [Event(1, 100), Event(3, 200), Event(5, 300)]
+    assert len(sampled['none']) == 0
+
+    # Streamed sampling in chunks of a single timestep carries values across chunks
+    changes = [(e.time, 'clk', e.value) for e in clock] + [(e.time, 'd', e.value) for e in data]
+    chunks = list(sample_change_chunks(sorted(changes, key=lambda c: c[0]), ['d'], 'clk', 0, chunk_size=1))
+    assert [(int(t), int(v)) for c in chunks for (t, v) in zip(c[0], c[2])] == [(1, 100), (3, 200), (5, 300)]
+
+    print("TESTING: find_clock_domains")
+    symbols = {'!': [Signal("TOP.clock", 1), Signal("TOP.core.clock", 1)], '"': [Signal("TOP.core.valid", 1)],
+               '#': [Signal("TOP.uart.clock", 1)], '$': [Signal("TOP.uart.tx.clk_en", 1), Signal("TOP.uart.tx.en", 1)],
+               '%': [Signal("TOP.uart.tx.data", 8)], '&': [Signal("TOP.ready", 1)]}
+    clocks, domains = find_clock_domains(symbols)
+    # TOP.core inherits the clock passed down to it, and TOP.uart.tx (whose clk_en is not a clock) that of TOP.uart
+    assert [d.clock for d in clocks.values()] == ["TOP.clock", "TOP.uart.clock"]
+    assert {s: d.clock for (s, d) in domains.items()} == \
+        {'"': "TOP.clock", '$': "TOP.uart.clock", '%': "TOP.uart.clock", '&': "TOP.clock"}
+    clocks, domains = find_clock_domains(symbols, clock_names=('clock', 'clk_en'))
+    assert [d.clock for d in clocks.values()] == ["TOP.clock", "TOP.uart.clock", "TOP.uart.tx.clk_en"]
+    assert domains['%'].clock == "TOP.uart.tx.clk_en"
+
+    print("TESTING: sample_change_chunks with two clock domains")
+    fast, slow = ClockDomain("TOP.clock"), ClockDomain("TOP.slow.clock")
+    changes = [(t, 'clk', t % 2) for t in range(12)] + [(t, 'slow_clk', int(t % 6 == 1)) for t in range(12)] + \
+        [(0, 'f', 0), (2, 'f', 1), (4, 's', 0), (6, 's', 1)]
+    chunks = list(sample_change_chunks(sorted(changes, key=lambda c: c[0]), ['f', 's'], ['clk', 'slow_clk'], 0,
+                                       chunk_size=3, symbol_domains=np.array([0, 1]), domains=[fast, slow]))
+    samples = sorted((int(t), int(i), int(v)) for c in chunks for (t, i, v) in zip(*c))
+    assert samples == [(1, 0, 0), (3, 0, 1), (7, 1, 1)]  # 's' has no known value before the first slow posedge
+    assert fast.posedges.tolist() == [1, 3, 5, 7, 9, 11] and slow.posedges.tolist() == [1, 7]
+    assert slow.previous_edges(np.array([1, 7, 9])).tolist() == [NO_EDGE, 1, 7]
+    assert pickle.loads(pickle.dumps(slow)).posedges.tolist() == [1, 7]
+
+    print("TESTING: DeltaTrace")
+    trace = DeltaTrace.from_events(data)
+    assert trace.times.dtype == np.int64 and trace.values.dtype == np.uint64
+    assert trace == data and list(trace) == data and trace[1] == Event(2, 200)
+    assert pickle.loads(pickle.dumps(trace)) == trace
+    wide = DeltaTrace.from_events([Event(0, 1 << 100)])
+    assert wide[0] == Event(0, 1 << 100)
+
+    print("TESTING: SignalTable")
+    assert pickle.loads(pickle.dumps(Signal("TOP.a", 4))) == Signal("TOP.a", 4)
+    group = frozenset([Signal("TOP.a", 1), Signal("TOP.b", 1)])
+    table = SignalTable()
+    assert table.intern(group) is group and len(table) == 1
+    assert table.intern(frozenset([Signal("TOP.b", 1), Signal("TOP.a", 1)])) is group and len(table) == 1
+    assert table.intern(frozenset([Signal("TOP.c", 1)])) is not group and len(table) == 2
+
+    print("TESTING: ModuleIndex")
+    index = ModuleIndex([frozenset([Signal("TOP.a", 1)]),
+                         frozenset([Signal("TOP.core.io_in", 1), Signal("TOP.core_io_in", 1)]),
+                         frozenset([Signal("TOP.core.b", 1)])])
+    assert index.module("TOP").tolist() == [0, 1] and index.module("TOP.core").tolist() == [1, 2]
+    assert index.module_ports("TOP.core").tolist() == [1] and index.module("TOP.other").tolist() == []
+
+    print("TESTING: SignalFilter")
+    top = Module("TOP")
+    top.children.append(Module("TOP.core"))
+    symbols = {'!': [Signal("TOP.clock", 1)], '"': [Signal("TOP.core._T_1", 1), Signal("TOP.core.wr_en", 1)],
+               '#': [Signal("TOP.core._GEN_2", 1)], '$': [Signal("TOP.io_out", 4)], '%': [Signal("TOP.core.data", 8)]}
+    assert _clean_symbols(symbols, 8)[1] == {'"': frozenset([Signal("TOP.core.wr_en", 1)]),
+                                             '$': frozenset([Signal("TOP.io_out", 4)]),
+                                             '%': frozenset([Signal("TOP.core.data", 8)])}
+    core_only = SignalFilter(scope="TOP.core")
+    assert list(_clean_symbols(symbols, 8, signal_filter=core_only)[1].keys()) == ['"', '%']
+    assert core_only.scope_tree(top).name == "TOP.core"
+    assert list(_clean_symbols(symbols, 8, signal_filter=SignalFilter(include=['_en$', 'io_']))[1].keys()) == ['"', '$']
+    assert list(_clean_symbols(symbols, 8, signal_filter=SignalFilter(exclude=['data']))[1].keys()) == ['"', '#', '$']
+    # Filters keep or drop whole symbols, and never change which aliases make up a kept signal
+    assert _clean_symbols(symbols, 8, signal_filter=SignalFilter(include=['_T_'], exclude=[]))[1] == \
+        {'"': frozenset([Signal("TOP.core.wr_en", 1)])}
+    assert _clean_symbols(symbols, 8, signal_filter=SignalFilter(exclude=[]))[1]['#'] == \
+        frozenset([Signal("TOP.core._GEN_2", 1)])
+    assert list(_clean_symbols(symbols, 8, {"TOP.core._GEN_2"})[1].keys()) == ['#']
+
+    print("TESTING: iter_value_change_columns")
+    body = b"$dumpvars\n0!\nb101 \"\nx#\n$end\n#2\n  1!  \r\nbx1 \"\nb11  \"\n1#\n#4\n0!\nb110\t\"\nb1 \t \"\n"
+    line_changes = list(iter_value_changes(body.decode('latin-1').splitlines(True), {'!', '"'}))
+    assert line_changes == [(0, '!', 0), (0, '"', 5), (2, '!', 1), (2, '"', 3), (4, '!', 0), (4, '"', 6), (4, '"', 1)]
+    for block_size in [1, 8, 1 << 10]:
+        blocks = _vcd_blocks(io.BufferedReader(io.BytesIO(body)), block_size)
+        assert [(int(t), ['!', '"'][i], int(v)) for (times, ids, values) in iter_value_change_columns(blocks, ['!', '"'])
+                for (t, i, v) in zip(times, ids, values)] == line_changes
+
+    print("TESTING: open_vcd")
+    import tempfile
+    text = "$scope module TOP $end\n$var wire 1 ! clock $end\n$var wire 2 \" data $end\n$upscope $end\n" \
+           "$enddefinitions $end\n#0\n0!\nb0 \"\n#1\n1!\n#2\n0!\nb1 \"\n#3\n1!\n#4\n0!\nb10 \"\n#5\n1!\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, 'plain.vcd')]
+        with open(paths[0], 'w') as f:
+            f.write(text)
+        for (extension, compressed_open) in [('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)]:
+            paths.append(os.path.join(tmp, 'trace.vcd' + extension))
+            with compressed_open(paths[-1], 'wt') as f:
+                f.write(text)
+        for path in paths:
+            with open_vcd(path) as f:
+                assert f.read().decode() == text
+            data = read_vcd_clean(path, 0, 4)[1]
+            assert data[frozenset([Signal("TOP.data", 2)])] == [Event(1, 0), Event(3, 1), Event(5, 2)]